@@ -0,0 +1,91 @@
+# -*- coding: utf-8-*-
+"""
+Module : FrameTimings
+Description :
+    Fixed-size ring buffer of per-phase frame timings for the Qt/Panda bridge
+    (task step, render + readback, QImage wrapping, drawing...).
+    Recording is skipped by the callers when the timings are disabled.
+"""
+from array import array
+import csv
+import json
+
+__all__ = ["FrameTimings"]
+
+
+class FrameTimings:
+    """
+    FrameTimings : per-phase timings (in seconds) of the last `capacity` frames
+    phases : names of the recorded phases, in display order
+    """
+
+    def __init__(self, phases, capacity=240):
+        self.enabled = False
+        self.phases = list(phases)
+        self.capacity = capacity
+        self.samples = {phase: array("d", [0.0]) * capacity for phase in self.phases}
+        # Total number of frames recorded, the current frame is frame % capacity
+        self.frame = 0
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def clear(self):
+        for samples in self.samples.values():
+            for i in range(self.capacity):
+                samples[i] = 0.0
+        self.frame = 0
+
+    def add(self, phase, seconds):
+        """
+        Adds time to a phase of the current frame (several widgets may paint per frame).
+        """
+        self.samples[phase][self.frame % self.capacity] += seconds
+
+    def end_frame(self):
+        self.frame += 1
+        index = self.frame % self.capacity
+        for samples in self.samples.values():
+            samples[index] = 0.0
+
+    def get_frame_count(self):
+        """
+        Number of complete frames held by the buffer.
+        """
+        return min(self.frame, self.capacity - 1)
+
+    def get(self, phase):
+        """
+        The timings of a phase for the complete frames, oldest first.
+        """
+        samples = self.samples[phase]
+        count = self.get_frame_count()
+        start = self.frame - count
+        return [samples[i % self.capacity] for i in range(start, self.frame)]
+
+    def get_averages(self):
+        count = self.get_frame_count()
+        if count == 0:
+            return {phase: 0.0 for phase in self.phases}
+        return {phase: sum(self.get(phase)) / count for phase in self.phases}
+
+    def to_rows(self):
+        columns = [self.get(phase) for phase in self.phases]
+        first_frame = self.frame - self.get_frame_count()
+        return [[first_frame + i] + [column[i] for column in columns] for i in range(self.get_frame_count())]
+
+    def export_csv(self, path):
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["frame"] + self.phases)
+            writer.writerows(self.to_rows())
+
+    def export_json(self, path):
+        data = {
+            "unit": "seconds",
+            "phases": self.phases,
+            "averages": self.get_averages(),
+            "frames": [dict(zip(["frame"] + self.phases, row)) for row in self.to_rows()],
+        }
+        with open(path, "w") as file:
+            json.dump(data, file, indent=2)
@@ -22,10 +22,14 @@ from panda3d.core import GraphicsOutput, Texture, ConfigVariableManager, WindowP
 
 # Set up Panda environment
 from direct.showbase.ShowBase import ShowBase
+from direct.interval.IntervalManager import ivalMgr
 import platform
+import time
 
 # Local imports
 from QPanda3D.QMouseWatcherNode import QMouseWatcherNode
+from QPanda3D.ViewportOutput import ViewportOutput
+from QPanda3D.FrameTimings import FrameTimings
 
 __all__ = ["Panda3DWorld"]
 
@@ -35,10 +39,17 @@ class Panda3DWorld(ShowBase):
     Panda3DWorld : A class to handle all panda3D world manipulation
     """
 
+    # With a draw thread, frame N is copied to RAM while the app thread runs frame N+1:
+    # one texture being written, one in flight, one finished for Qt to display.
+    min_threaded_readback_buffers = 3
+
     def __init__(self, width=800, height=600, is_fullscreen=False, size=1.0, clear_color=LVecBase4f(0.1, 0.1, 0.1, 1),
-                 name="qpanda3D"):
-        
-        
+                 name="qpanda3D", readback_buffers=1, threading_model=None):
+        """
+        readback_buffers : number of textures the buffers are copied into, see ViewportOutput
+        threading_model : Panda3D threading-model ("Cull/Draw", "/Draw"...) to pipeline
+            cull and draw on other threads. None keeps everything on the Qt thread.
+        """
 
         sort = -100
         self.parent = None
@@ -53,52 +64,284 @@ class Panda3DWorld(ShowBase):
         else:
             loadPrcFileData("", "window-type offscreen")  # Set Panda to draw its main window in an offscreen buffer
 
+        # Must be set before ShowBase opens the graphics engine
+        self.threading_model = threading_model
+        if threading_model:
+            loadPrcFileData("", "threading-model {}".format(threading_model))
+            readback_buffers = max(readback_buffers, self.min_threaded_readback_buffers)
+
         ShowBase.__init__(self)
-        self.screenTexture = Texture()
-        self.screenTexture.setMinfilter(Texture.FTLinear)
-        self.screenTexture.setFormat(Texture.FRgba32)
-        self.screenTexture.set_wrap_u(Texture.WM_clamp)
-        self.screenTexture.set_wrap_v(Texture.WM_clamp)
+        self.buffer_sort = sort
+        self.clear_color = clear_color
+        self.screenTexture = self.make_screen_texture()
 
         buff_size_x = int(self.win.get_x_size() * size)
         buff_size_y = int(self.win.get_y_size() * size)
+        self.buff = self.make_offscreen_buffer(name, buff_size_x, buff_size_y)
+
+        self.buff.addRenderTexture(self.screenTexture, GraphicsOutput.RTMCopyRam)
+        self.cam = self.makeCamera(self.buff)
+        self.camNode = self.cam.node()
+        self.camLens = self.camNode.get_lens()
+
+        # Create a display region for the 2D camera
+        self.make_2d_display_region(self.buff)
+
+        # The first widget displays the main buffer, the others get their own (see acquire_output)
+        self.main_output = ViewportOutput(self.buff, self.screenTexture, self.cam, self.make_screen_texture, size)
+        self.main_output_taken = False
+        self.outputs = [self.main_output]
+
+        # Pipelined readback: Qt displays frame N-1 while frame N renders (see ViewportOutput)
+        self.readback_buffers = readback_buffers
+        if readback_buffers > 1:
+            self.main_output.set_readback_buffers(readback_buffers)
+        self.taskMgr.add(self.advance_readback_task, "qpanda3d-advance-readback", sort=48)
+
+        # Dynamic resolution: while the camera moves or an interaction (gizmo drag,
+        # terrain brush...) is running, the buffers render below full resolution
+        # so that render_time stays under frame_time_target.
+        # size is the full resolution scale, resolution_scale the current one.
+        self.full_resolution_scale = size
+        self.dynamic_resolution = False
+        self.resolution_scale = size
+        self.min_resolution_scale = 0.25 * size
+        self.resolution_step = 0.125 * size
+        self.frame_time_target = 1.0 / 60.0
+        self.resolution_settle_frames = 15
+        self.interactions = set()
+        self.camera_moved = False
+        self.still_frames = 0
+        self.render_start = 0.0
+        self.render_time = 0.0
+        self.taskMgr.add(self.after_render_task, "qpanda3d-after-render", sort=51)
+
+        # Per-phase timings of the Qt/Panda bridge, filled by QPanda3DSynchronizer
+        # and QPanda3DWidget while enabled (see enable_frame_timings)
+        self.frame_timings = FrameTimings(["tasks", "render", "ram_image", "qimage", "draw"])
+        # name -> function returning the stats of an editor system, see add_stats_source
+        self.stats_sources = {}
+
+        dr = self.win.makeDisplayRegion()
+        dr.sort = 2000
+
+        # Render on demand state (used by QPanda3DSynchronizer when on_demand is set)
+        self.dirty = True
+        self.frame_changed = True
+        self.animations = set()
+        self.last_cam_transform = None
+        # Runs right before igLoop (sort 50) so it sees the changes made by this frame's tasks
+        self.taskMgr.add(self.check_dirty_task, "qpanda3d-check-dirty", sort=49)
+
+    def make_screen_texture(self):
+        texture = Texture()
+        texture.setMinfilter(Texture.FTLinear)
+        texture.setFormat(Texture.FRgba32)
+        texture.set_wrap_u(Texture.WM_clamp)
+        texture.set_wrap_v(Texture.WM_clamp)
+        return texture
+
+    def make_offscreen_buffer(self, name, size_x, size_y):
         winprops = WindowProperties()
-        winprops.set_size(buff_size_x, buff_size_y)
+        winprops.set_size(size_x, size_y)
 
         props = FrameBufferProperties()
         props.set_rgb_color(True)
         props.set_rgba_bits(8, 8, 8, 8)
         props.set_depth_bits(8)
 
-        self.buff = self.graphicsEngine.make_output(
-            self.pipe, name, sort,
+        buff = self.graphicsEngine.make_output(
+            self.pipe, name, self.buffer_sort,
             props, winprops,
             GraphicsPipe.BF_resizeable,
             self.win.get_gsg(), self.win)
+        buff.set_sort(self.buffer_sort)
 
-        self.buff.addRenderTexture(self.screenTexture, GraphicsOutput.RTMCopyRam)
-        self.buff.set_sort(sort)
-        self.cam = self.makeCamera(self.buff)
-        self.camNode = self.cam.node()
-        self.camLens = self.camNode.get_lens()
+        if self.clear_color is None:
+            buff.set_clear_active(GraphicsOutput.RTPColor, False)
+        else:
+            buff.set_clear_color(self.clear_color)
+            buff.set_clear_active(GraphicsOutput.RTPColor, True)
+        return buff
 
-        # Create a display region for the 2D camera
-        dr2d = self.buff.make_display_region()
+    def make_2d_display_region(self, buff):
+        dr2d = buff.make_display_region()
         dr2d.setDimensions(0, 1, 0, 1)         # Cover entire buffer
         dr2d.setSort(1)                      # Higher sort value to overlay on top of 3D
         dr2d.setCamera(self.cam2d)
-        if clear_color is None:
-            self.buff.set_clear_active(GraphicsOutput.RTPColor, False)
-        else:
-            self.buff.set_clear_color(clear_color)
-            self.buff.set_clear_active(GraphicsOutput.RTPColor, True)
+        return dr2d
 
-        dr = self.win.makeDisplayRegion()
-        dr.sort = 2000
+    def make_output(self, name, size_x, size_y):
+        """
+        Creates an extra buffer with its own texture and lens.
+        Its camera is parented to self.cam, so it follows the main camera.
+        """
+        texture = self.make_screen_texture()
+        buff = self.make_offscreen_buffer(name, size_x, size_y)
+        buff.addRenderTexture(texture, GraphicsOutput.RTMCopyRam)
+
+        cam = self.cam.attachNewNode(Camera(name, self.camLens.makeCopy()))
+        dr = buff.make_display_region()
+        dr.setSort(self.camNode.getDisplayRegion(0).getSort())
+        dr.setCamera(cam)
+        self.make_2d_display_region(buff)
+
+        output = ViewportOutput(buff, texture, cam, self.make_screen_texture)
+        output.set_resolution_scale(self.resolution_scale)
+        if self.readback_buffers > 1:
+            output.set_readback_buffers(self.readback_buffers)
+        self.outputs.append(output)
+        return output
+
+    def set_readback_buffers(self, count):
+        """
+        Switches every output between synchronous (1) and pipelined (2 or 3) readback.
+        """
+        if self.threading_model:
+            count = max(count, self.min_threaded_readback_buffers)
+        self.readback_buffers = count
+        for output in self.outputs:
+            output.set_readback_buffers(count)
+
+    def advance_readback_task(self, task):
+        if self.readback_buffers > 1:
+            for output in self.outputs:
+                output.advance_readback()
+        return task.cont
+
+    def acquire_output(self, widget):
+        """
+        Returns the output a new QPanda3DWidget should display.
+        """
+        if not self.main_output_taken:
+            self.main_output_taken = True
+            return self.main_output
+        return self.make_output("qpanda3D-{}".format(len(self.outputs)),
+                                max(1, widget.width()), max(1, widget.height()))
 
     def set_parent(self, parent: QWidget):
         self.parent = parent
-        self.mouseWatcherNode = QMouseWatcherNode(parent)
+        # One mouse watcher shared by all the widgets, its parent follows the mouse
+        if isinstance(getattr(self, "mouseWatcherNode", None), QMouseWatcherNode):
+            self.mouseWatcherNode.parent = parent
+        else:
+            self.mouseWatcherNode = QMouseWatcherNode(parent)
+
+    def mark_dirty(self):
+        """
+        Requests a new frame when rendering on demand.
+        """
+        self.dirty = True
+
+    def begin_animation(self, key):
+        """
+        Keeps rendering at full frame rate until end_animation is called with the same key.
+        Use this for tasks that animate the scene without touching the scene graph.
+        """
+        self.animations.add(key)
+
+    def end_animation(self, key):
+        self.animations.discard(key)
+
+    def begin_interaction(self, key):
+        """
+        Marks a user interaction (gizmo drag, terrain brush stroke...) as running.
+        Interactions keep the frame rate up and allow dynamic resolution to kick in.
+        """
+        self.interactions.add(key)
+
+    def end_interaction(self, key):
+        self.interactions.discard(key)
+
+    def is_animating(self):
+        return bool(self.animations) or bool(self.interactions) or ivalMgr.getNumIntervals() > 0
+
+    def consume_dirty(self):
+        """
+        Returns True if the scene graph, the camera, the input or a running
+        animation changed anything since the last call.
+        """
+        changed = self.dirty or self.is_animating()
+        self.dirty = False
+
+        cam_transform = self.cam.getNetTransform()
+        self.camera_moved = cam_transform != self.last_cam_transform
+        if self.camera_moved:
+            self.last_cam_transform = cam_transform
+            changed = True
+
+        # Any transform, state or hierarchy change below the roots marks their bounds stale
+        # until the next cull traversal recomputes them
+        if self.render.node().isBoundsStale() or self.render2d.node().isBoundsStale():
+            changed = True
+        return changed
+
+    def check_dirty_task(self, task):
+        self.frame_changed = self.consume_dirty()
+        self.render_start = time.perf_counter()
+        return task.cont
+
+    def enable_dynamic_resolution(self, enabled=True, frame_time_target=None):
+        self.dynamic_resolution = enabled
+        if frame_time_target is not None:
+            self.frame_time_target = frame_time_target
+        if not enabled:
+            self.set_resolution_scale(self.full_resolution_scale)
+
+    def set_resolution_scale(self, scale):
+        self.resolution_scale = scale
+        for output in self.outputs:
+            output.set_resolution_scale(scale)
+
+    def enable_frame_timings(self, enabled=True):
+        self.frame_timings.enable(enabled)
+
+    def after_render_task(self, task):
+        # Time spent in igLoop: rendering and RAM readback of this frame
+        self.render_time = time.perf_counter() - self.render_start
+        if self.frame_timings.enabled:
+            self.frame_timings.add("render", self.render_time)
+        if self.dynamic_resolution:
+            self.update_dynamic_resolution()
+        return task.cont
+
+    def update_dynamic_resolution(self):
+        scale = self.resolution_scale
+        if self.camera_moved or self.interactions:
+            self.still_frames = 0
+            if self.render_time > self.frame_time_target:
+                scale = max(self.min_resolution_scale, scale - self.resolution_step)
+            elif self.render_time < self.frame_time_target * 0.5:
+                scale = min(self.full_resolution_scale, scale + self.resolution_step)
+        else:
+            self.still_frames += 1
+            if self.still_frames >= self.resolution_settle_frames:
+                scale = self.full_resolution_scale
+        if scale != self.resolution_scale:
+            self.set_resolution_scale(scale)
+            # Make sure the settled full resolution frame gets rendered
+            self.mark_dirty()
+
+    def get_stats(self):
+        """
+        Render statistics of the world and of each of its outputs.
+        """
+        return {
+            "render_time": self.render_time,
+            "frame_time_target": self.frame_time_target,
+            "threading_model": self.threading_model,
+            "dynamic_resolution": self.dynamic_resolution,
+            "resolution_scale": self.resolution_scale,
+            "frame_timings": self.frame_timings.get_averages() if self.frame_timings.enabled else None,
+            "outputs": [output.get_stats() for output in self.outputs],
+            **{name: get_stats() for name, get_stats in self.stats_sources.items()},
+        }
+
+    def add_stats_source(self, name, get_stats):
+        """
+        Adds the result of get_stats() to get_stats() under name.
+        """
+        self.stats_sources[name] = get_stats
 
     def getAspectRatio(self, win = None):
         if win is None and self.parent is not None:
@@ -5,6 +5,8 @@ Author : Niklas Mevenkamp
 Description :
     This is a MouseWatcherNode implementation that accesses
     mouse position and button states through a parent QWidget.
+    The position is fed by the widget's mouse events and served as one
+    snapshot per frame, so every caller agrees on where the mouse was.
 """
 
 # PyQt imports
@@ -23,19 +25,61 @@ class QMouseWatcherNode(MouseWatcher):
         super().__init__()
 
         self.parent = parent
+        # Latest position given by the widget events, in Panda's [-1, 1] range
+        self.mouse_pos = LPoint2(0, 0)
+        # Position served to getMouse() during the current frame
+        self.frame_mouse = LPoint2(0, 0)
+        self.has_position = False
+        # Positions received since the last snapshot, and the ones frozen by it
+        self.mouse_path = []
+        self.frame_path = []
+        # Positions kept per frame, older ones are dropped
+        self.max_path_length = 64
 
-    def getMouse(self, *args, **kwargs):
-        # map global QCursor pixel position to parent Widget coordinates
-        pos = self.parent.mapFromGlobal(QCursor.pos())
-
+    def to_relative(self, widget, x, y):
         # map absolute pixel positions to relative ones
-        rel_x = -1 + 2 * pos.x() / self.parent.width()
-        rel_y = -1 + 2 * pos.y() / self.parent.height()
+        rel_x = -1 + 2 * x / max(1, widget.width())
+        rel_y = -1 + 2 * y / max(1, widget.height())
 
         # invert y
-        rel_y = -rel_y
+        return LPoint2(rel_x, -rel_y)
+
+    def update_mouse(self, widget, x, y):
+        """
+        Called by the QPanda3DWidget mouse events with widget pixel coordinates.
+        The widget the mouse is over becomes the parent.
+        """
+        self.parent = widget
+        self.mouse_pos = self.to_relative(widget, x, y)
+        self.has_position = True
+        self.mouse_path.append(self.mouse_pos)
+        if len(self.mouse_path) > self.max_path_length:
+            del self.mouse_path[0]
+
+    def snapshot(self):
+        """
+        Freezes the position returned by getMouse() until the next snapshot,
+        called once per frame before the tasks run.
+        """
+        if not self.has_position and isinstance(self.parent, QWidget):
+            # no mouse event yet, ask Qt once
+            pos = self.parent.mapFromGlobal(QCursor.pos())
+            self.mouse_pos = self.to_relative(self.parent, pos.x(), pos.y())
+            self.has_position = True
+        self.frame_mouse = LPoint2(self.mouse_pos)
+        self.frame_path = self.mouse_path or [self.frame_mouse]
+        self.mouse_path = []
+
+    def getMouse(self, *args, **kwargs):
+        # copy, callers keep it around to compute deltas
+        return LPoint2(self.frame_mouse)
 
-        return LPoint2(rel_x, rel_y)
+    def getMousePath(self):
+        """
+        Every position the mouse went through since the previous frame, in
+        order; the last one is getMouse(). Lets strokes follow fast moves.
+        """
+        return [LPoint2(pos) for pos in self.frame_path]
 
     def hasMouse(self):
         return isinstance(self.parent, QWidget)
@@ -22,52 +22,149 @@ from QPanda3D.QPanda3D_Keys_Translation import QPanda3D_Key_translation
 from QPanda3D.QPanda3D_Modifiers_Translation import QPanda3D_Modifier_translation
 import builtins
 import os
+import time
 
 __all__ = ["QPanda3DWidget"]
 
 panda_widgets = []
 widget_started = False
+active_synchronizer = None
 
 
 class QPanda3DSynchronizer(QTimer):
-    def __init__(self, qPanda3DWidget, FPS=60):
+    """
+    Steps Panda's task manager and repaints the widgets.
+    With on_demand set, the timer drops to idle_FPS once the world stops
+    changing and goes back to FPS as soon as something is marked dirty.
+    """
+
+    # Number of unchanged frames before dropping to the idle rate
+    settle_frames = 10
+
+    def __init__(self, qPanda3DWidget, FPS=60, on_demand=False, idle_FPS=2):
         QTimer.__init__(self)
         panda_widgets.append(qPanda3DWidget)
+        self.panda3DWorld = qPanda3DWidget.panda3DWorld
         dt = 1000 // FPS
-        self.setInterval(int(round(dt)))
+        self.active_interval = int(round(dt))
+        self.idle_interval = int(round(1000 // idle_FPS))
+        self.on_demand = on_demand
+        self.idle_frames = 0
+        self.setInterval(self.active_interval)
         self.timeout.connect(self.tick)
 
+    def wake(self):
+        self.idle_frames = 0
+        if self.interval() != self.active_interval:
+            self.setInterval(self.active_interval)
+
     def tick(self):
         if self.isActive():
+            timings = self.panda3DWorld.frame_timings
+            if timings.enabled:
+                timings.end_frame()
+                step_start = time.perf_counter()
+            # Hidden widgets (inactive tabs, minimized windows) are neither
+            # rendered nor read back, nor repainted
+            visible_widgets = []
+            for widget in panda_widgets:
+                visible = widget.is_render_visible()
+                widget.output.set_active(visible)
+                if visible:
+                    widget.apply_pending_resize()
+                    visible_widgets.append(widget)
+            # Every task of this frame sees the same mouse position
+            self.panda3DWorld.mouseWatcherNode.snapshot()
+            for widget in panda_widgets:
+                widget.flush_mouse_move()
             try:
                 builtins.base.taskMgr.step()
             except:
                 pass
-            if panda_widgets:
-                for widget in panda_widgets:
-                    widget.update()
+            if timings.enabled:
+                step_time = time.perf_counter() - step_start
+                timings.add("tasks", max(0.0, step_time - self.panda3DWorld.render_time))
+            if self.on_demand:
+                if self.panda3DWorld.frame_changed:
+                    self.wake()
+                else:
+                    self.idle_frames += 1
+                    if self.idle_frames == self.settle_frames:
+                        self.setInterval(self.idle_interval)
+                    # A pipelined readback displays the last changed frame
+                    # readback_buffers - 1 ticks after it was rendered
+                    if self.idle_frames > max(1, self.panda3DWorld.readback_buffers - 1):
+                        # Same image as the last repaint
+                        return
+            for widget in visible_widgets:
+                widget.update()
 
     def __del__(self):
         self.stop()
 
 
+# Translated modifier bits and their Panda names, in QPanda3D_Modifier_translation order
+# (NoModifier is 0 and never part of a prefix)
+modifier_table = [(int(qt_mod), panda_mod) for qt_mod, panda_mod in QPanda3D_Modifier_translation.items()
+                  if panda_mod is not None]
+modifier_mask = 0
+for bit, _ in modifier_table:
+    modifier_mask |= bit
+
+# Panda modifier names of every combination of the translated modifier bits
+modifier_names = {}
+for combination in range(1 << len(modifier_table)):
+    mask = 0
+    for i, (bit, _) in enumerate(modifier_table):
+        if combination & (1 << i):
+            mask |= bit
+    modifier_names[mask] = tuple(name for bit, name in modifier_table if mask & bit == bit)
+
+# (modifier mask, panda key) -> event prefix, filled on first use
+modifier_prefixes = {}
+# (modifier mask, panda key, suffix) -> full Panda event name, filled on first use
+panda_event_names = {}
+
+
+def get_modifier_prefix(mask, key):
+    """
+    Returns the "shift-control-" like prefix of a Panda event for a Qt modifier
+    bitmask and the translated key/button name.
+    """
+    mask &= modifier_mask
+    prefix = modifier_prefixes.get((mask, key))
+    if prefix is None:
+        mods = list(modifier_names[mask])
+        # Fix the case where the modifier key is pressed
+        # alone without other things
+        # if not things like control-control would be possible
+        if key in mods:
+            mods.remove(key)
+        prefix = "-".join(mods)
+        # if the prefix is not empty, append a '-'
+        if prefix:
+            prefix += "-"
+        modifier_prefixes[(mask, key)] = prefix
+    return prefix
+
+
+def get_panda_event_name(mask, key, suffix=""):
+    """
+    Returns the Panda event sent for a translated key/button with the Qt modifier
+    bitmask `mask`, e.g. (ControlModifier, "mouse1", "-up") -> "control-mouse1-up".
+    """
+    name = panda_event_names.get((mask, key, suffix))
+    if name is None:
+        name = get_modifier_prefix(mask, key) + key + suffix
+        panda_event_names[(mask, key, suffix)] = name
+    return name
+
+
 def get_panda_key_modifiers(evt):
-    panda_mods = []
-    qt_mods = evt.modifiers()
-    for qt_mod, panda_mod in QPanda3D_Modifier_translation.items():
-        if (qt_mods & qt_mod) == qt_mod:
-            panda_mods.append(panda_mod)
-    return panda_mods
+    return list(modifier_names[int(evt.modifiers()) & modifier_mask])
 
 
 def get_panda_key_modifiers_prefix(evt):
-    # join all modifiers (except NoModifier, which is None) with '-'
-    mods = [mod for mod in get_panda_key_modifiers(evt) if mod is not None]
-    prefix = "-".join(mods)
-
-    # Fix the case where the modifier key is pressed
-    # alone without other things
-    # if not things like control-control would be possible
     if isinstance(evt, QtGui.QMouseEvent):
         key = QPanda3D_Button_translation[evt.button()]
     elif isinstance(evt, QtGui.QKeyEvent):
@@ -76,18 +173,7 @@ def get_panda_key_modifiers_prefix(evt):
         key = "wheel"
     else:
         raise NotImplementedError("Unknown event type")
-
-    if key in mods:
-        mods.remove(key)
-        prefix = "-".join(mods)
-
-    # if the prefix is not empty, append a '-'
-    if prefix == "-":
-        prefix = ""
-    if prefix:
-        prefix += "-"
-
-    return prefix
+    return get_modifier_prefix(int(evt.modifiers()), key)
 
 
 class QPanda3DWidget(QWidget):
@@ -96,9 +182,10 @@ class QPanda3DWidget(QWidget):
     Parent : Parent QT Widget
     FPS : Number of frames per socond to refresh the screen
     debug: Switch printing key events to console on/off
+    on_demand: Only render at full FPS while the scene, camera or input changes
     """
 
-    def __init__(self, panda3DWorld, parent=None, FPS=60, debug=False):
+    def __init__(self, panda3DWorld, parent=None, FPS=60, debug=False, on_demand=False):
         QWidget.__init__(self, parent)
 
         # set fixed geometry
@@ -117,24 +204,53 @@ class QPanda3DWidget(QWidget):
         # redrawTimer.start(1000/FPS)
 
         self.paintSurface = QPainter()
-        self.rotate = QTransform()
-        self.rotate.rotate(180)
+        # Panda stores the texture bottom-up, so the image is flipped
+        # vertically when it is drawn instead of copying it with mirrored()
+        self.flip = QTransform()
         self.out_image = QImage()
+        # Keeps the texture RAM image alive while out_image points into it
+        self.out_image_buffer = None
+        self.out_image_texture = None
+        self.out_image_modified = None
+
+        # Latest size given to resizeEvent, not applied yet
+        self.pending_size = None
+        # Latest "mouse-move" position not sent yet
+        self.pending_mouse_move = None
+
+        # Draws the frame_timings graph over the viewport (see set_timings_overlay)
+        self.show_timings_overlay = False
+        # Selection rectangle drawn over the viewport, (left, top, width, height) or None
+        self.marquee_rect = None
+
+        # The buffer, texture and lens this widget displays
+        self.output = self.panda3DWorld.acquire_output(self)
 
-        size = self.panda3DWorld.cam.node().get_lens().get_film_size()
+        size = self.output.lens.get_film_size()
         self.initial_film_size = QSizeF(size.x, size.y)
         self.initial_size = self.size()
 
-        self.synchronizer = QPanda3DSynchronizer(self, FPS)
+        self.synchronizer = QPanda3DSynchronizer(self, FPS, on_demand)
 
-        global widget_started
+        global widget_started, active_synchronizer
         if not widget_started:
             widget_started = True
+            active_synchronizer = self.synchronizer
             self.synchronizer.start()
 
         self.debug = debug
 
         self.setAcceptDrops(True)  # Enable drag-and-drop for this widget
+        # Move events without a pressed button keep the cached mouse position current
+        self.setMouseTracking(True)
+
+    def request_frame(self):
+        """
+        Marks the world dirty and brings the synchronizer back to full frame rate.
+        """
+        self.panda3DWorld.mark_dirty()
+        if active_synchronizer is not None:
+            active_synchronizer.wake()
 
     def dragEnterEvent(self, event: QDragEnterEvent):
         """
@@ -192,9 +308,15 @@ class QPanda3DWidget(QWidget):
 
 
     def mousePressEvent(self, evt):
+        self.request_frame()
+        # Keep the moves that happened before the click in order
+        self.flush_mouse_move()
+        # The click handlers read the position of this event
+        self.panda3DWorld.mouseWatcherNode.update_mouse(self, evt.x(), evt.y())
+        self.panda3DWorld.mouseWatcherNode.snapshot()
         button = evt.button()
         try:
-            b = f"{get_panda_key_modifiers_prefix(evt)}{QPanda3D_Button_translation[button]}"
+            b = get_panda_event_name(int(evt.modifiers()), QPanda3D_Button_translation[button])
             if self.debug:
                 print(b)
             messenger.send(b, [{"x": evt.x(), "y": evt.y()}])
@@ -203,20 +325,38 @@ class QPanda3DWidget(QWidget):
             print(e)
 
     def mouseMoveEvent(self, evt: QtGui.QMouseEvent):
-        button = evt.button()
+        self.request_frame()
+        self.panda3DWorld.mouseWatcherNode.update_mouse(self, evt.x(), evt.y())
+        # Sent once per frame with the latest position, see flush_mouse_move
+        self.pending_mouse_move = {"x": evt.x(), "y": evt.y()}
+
+    def flush_mouse_move(self):
+        """
+        Sends the "mouse-move" event coalesced since the last call, if any.
+        """
+        if self.pending_mouse_move is None:
+            return
+        pos = self.pending_mouse_move
+        self.pending_mouse_move = None
         try:
             b = "mouse-move"
             if self.debug:
                 print(b)
-            messenger.send(b, [{"x": evt.x(), "y": evt.y()}])
+            messenger.send(b, [pos])
         except Exception as e:
             print("Unimplemented button. Please send an issue on github to fix this problem")
             print(e)
 
     def mouseReleaseEvent(self, evt):
+        self.request_frame()
+        # Keep the moves that happened before the click in order
+        self.flush_mouse_move()
+        # The click handlers read the position of this event
+        self.panda3DWorld.mouseWatcherNode.update_mouse(self, evt.x(), evt.y())
+        self.panda3DWorld.mouseWatcherNode.snapshot()
         button = evt.button()
         try:
-            b = f"{get_panda_key_modifiers_prefix(evt)}{QPanda3D_Button_translation[button]}-up"
+            b = get_panda_event_name(int(evt.modifiers()), QPanda3D_Button_translation[button], "-up")
             if self.debug:
                 print(b)
             messenger.send(b, [{"x": evt.x(), "y": evt.y()}])
@@ -225,9 +365,10 @@ class QPanda3DWidget(QWidget):
             print(e)
 
     def wheelEvent(self, evt):
+        self.request_frame()
         delta = evt.angleDelta().y()
         try:
-            w = f"{get_panda_key_modifiers_prefix(evt)}wheel"
+            w = get_panda_event_name(int(evt.modifiers()), "wheel")
             if self.debug:
                 print(f"{w} {delta}")
             messenger.send(w, [{"delta": delta}])
@@ -236,9 +377,10 @@ class QPanda3DWidget(QWidget):
             print(e)
 
     def keyPressEvent(self, evt):
+        self.request_frame()
         key = evt.key()
         try:
-            k = f"{get_panda_key_modifiers_prefix(evt)}{QPanda3D_Key_translation[key]}"
+            k = get_panda_event_name(int(evt.modifiers()), QPanda3D_Key_translation[key])
             if self.debug:
                 print(k)
             messenger.send(k)
@@ -247,9 +389,10 @@ class QPanda3DWidget(QWidget):
             print(e)
 
     def keyReleaseEvent(self, evt):
+        self.request_frame()
         key = evt.key()
         try:
-            k = f"{get_panda_key_modifiers_prefix(evt)}{QPanda3D_Key_translation[key]}-up"
+            k = get_panda_event_name(int(evt.modifiers()), QPanda3D_Key_translation[key], "-up")
             if self.debug:
                 print(k)
             messenger.send(k)
@@ -258,29 +401,170 @@ class QPanda3DWidget(QWidget):
             print(e)
 
     def resizeEvent(self, evt):
-        lens = self.panda3DWorld.cam.node().get_lens()
+        self.request_frame()
+        # Applied once per frame by the synchronizer, see apply_pending_resize
+        self.pending_size = (evt.size().width(), evt.size().height())
+
+    def apply_pending_resize(self):
+        """
+        Resizes the lens and the output to the last size given to resizeEvent.
+        """
+        if self.pending_size is None:
+            return
+        width, height = self.pending_size
+        self.pending_size = None
+        lens = self.output.lens
         lens.set_film_size(
-            self.initial_film_size.width() * evt.size().width()
+            self.initial_film_size.width() * width
             / self.initial_size.width(),
-            self.initial_film_size.height() * evt.size().height()
+            self.initial_film_size.height() * height
             / self.initial_size.height()
         )
-        self.panda3DWorld.buff.setSize(evt.size().width(), evt.size().height())
+        self.output.set_size(width, height)
+
+    def is_render_visible(self):
+        """
+        True if the widget is shown on screen: not hidden, not on an inactive tab
+        and not in a minimized window.
+        """
+        if not self.isVisible() or self.window().isMinimized():
+            return False
+        return not self.visibleRegion().isEmpty()
+
+    def showEvent(self, evt):
+        self.request_frame()
 
     def minimumSizeHint(self):
         return QSize(400, 300)
 
+    def get_blit_image(self):
+        """
+        Wraps the texture RAM image in a QImage without copying it.
+        The cached image is reused until Panda writes a new frame into the texture.
+        """
+        texture = self.output.texture
+        if not texture.mightHaveRamImage():
+            return None
+        modified = texture.getImageModified()
+        if (self.out_image_texture is texture and self.out_image_modified == modified
+                and not self.out_image.isNull()):
+            return self.out_image
+
+        timings = self.panda3DWorld.frame_timings
+        if timings.enabled:
+            start = time.perf_counter()
+        x_size = texture.getXSize()
+        y_size = texture.getYSize()
+        ram_image = texture.getRamImage()
+        if len(ram_image) < x_size * y_size * 4:
+            return None
+        if timings.enabled:
+            ram_time = time.perf_counter()
+            timings.add("ram_image", ram_time - start)
+
+        self.out_image_buffer = memoryview(ram_image)
+        self.out_image = QImage(self.out_image_buffer, x_size, y_size, x_size * 4, QImage.Format_ARGB32)
+        if timings.enabled:
+            timings.add("qimage", time.perf_counter() - ram_time)
+        self.out_image_texture = texture
+        self.out_image_modified = modified
+        return self.out_image
+
     # Use the paint event to pull the contents of the panda texture to the widget
     def paintEvent(self, event):
-        if self.panda3DWorld.screenTexture.mightHaveRamImage():
-            self.panda3DWorld.screenTexture.setFormat(Texture.FRgba32)
-            data = self.panda3DWorld.screenTexture.getRamImage().getData()
-            img = QImage(data, self.panda3DWorld.screenTexture.getXSize(), self.panda3DWorld.screenTexture.getYSize(),
-                         QImage.Format_ARGB32).mirrored()
-            self.paintSurface.begin(self)
-            self.paintSurface.drawImage(0, 0, img)
-
-            self.paintSurface.end()
+        img = self.get_blit_image()
+        if img is None:
+            return
+        timings = self.panda3DWorld.frame_timings
+        if timings.enabled:
+            start = time.perf_counter()
+        # Only the bottom-left part of the buffer may have been rendered
+        image_width, image_height = self.output.get_image_size()
+        image_width = min(image_width, img.width())
+        image_height = min(image_height, img.height())
+        self.paintSurface.begin(self)
+        self.flip = QTransform(1, 0, 0, -1, 0, self.height())
+        self.paintSurface.setTransform(self.flip)
+        if image_width == self.width() and image_height == self.height():
+            self.paintSurface.drawImage(QPointF(0, 0), img, QRectF(0, 0, image_width, image_height))
+        else:
+            # The buffer renders below the widget size (dynamic resolution), upscale it
+            self.paintSurface.setRenderHint(QPainter.SmoothPixmapTransform)
+            self.paintSurface.drawImage(QRectF(0, 0, self.width(), self.height()), img,
+                                        QRectF(0, 0, image_width, image_height))
+        if self.marquee_rect is not None:
+            self.draw_marquee()
+        if timings.enabled:
+            timings.add("draw", time.perf_counter() - start)
+            if self.show_timings_overlay:
+                self.draw_timings_overlay(timings)
+        self.paintSurface.end()
+
+    def set_marquee(self, rect):
+        """
+        Shows a selection rectangle, (left, top, width, height) in widget
+        pixels, over the viewport, or hides it with None.
+        """
+        if rect != self.marquee_rect:
+            self.marquee_rect = rect
+            self.request_frame()
+
+    def draw_marquee(self):
+        painter = self.paintSurface
+        painter.resetTransform()
+        rect = QRectF(*self.marquee_rect)
+        painter.fillRect(rect, QColor(80, 160, 255, 50))
+        painter.setPen(QColor(80, 160, 255, 220))
+        painter.drawRect(rect)
+        # The timings overlay expects the flipped transform
+        painter.setTransform(self.flip)
+
+    # Colors of the phases in the timings overlay, in FrameTimings.phases order
+    timings_colors = [QColor(80, 160, 255), QColor(255, 170, 40), QColor(230, 70, 70),
+                      QColor(180, 90, 220), QColor(90, 210, 120)]
+
+    def set_timings_overlay(self, enabled=True):
+        """
+        Shows a graph of the per-phase frame timings over the viewport.
+        """
+        self.show_timings_overlay = enabled
+        if enabled:
+            self.panda3DWorld.enable_frame_timings()
+
+    def draw_timings_overlay(self, timings, graph_height=60, full_scale=1.0 / 30.0):
+        painter = self.paintSurface
+        painter.resetTransform()
+        columns = [timings.get(phase) for phase in timings.phases]
+        x0 = 4
+        y0 = self.height() - 4
+        painter.fillRect(QRectF(x0, y0 - graph_height, timings.capacity, graph_height), QColor(0, 0, 0, 160))
+
+        # One stacked bar per frame, full_scale seconds at the top of the graph
+        scale = graph_height / full_scale
+        for i in range(len(columns[0])):
+            y = y0
+            for phase_index, column in enumerate(columns):
+                h = min(column[i] * scale, y - (y0 - graph_height))
+                if h > 0:
+                    painter.setPen(self.timings_colors[phase_index % len(self.timings_colors)])
+                    painter.drawLine(QLineF(x0 + i, y, x0 + i, y - h))
+                    y -= h
+        # 60 FPS budget
+        painter.setPen(QColor(255, 255, 255, 120))
+        target_y = y0 - scale / 60.0
+        painter.drawLine(QLineF(x0, target_y, x0 + timings.capacity, target_y))
+
+        averages = timings.get_averages()
+        for phase_index, phase in enumerate(timings.phases):
+            painter.setPen(self.timings_colors[phase_index % len(self.timings_colors)])
+            painter.drawText(x0 + timings.capacity + 6, y0 - graph_height + 12 * (phase_index + 1),
+                             "{} {:.2f} ms".format(phase, averages[phase] * 1000))
+
+    def get_stats(self):
+        """
+        Render statistics of this widget's output (size, resolution scale...).
+        """
+        return self.output.get_stats()
 
     def movePointer(self, device, x, y):
         # device: #FIXME not used yet, just to keep in same style of
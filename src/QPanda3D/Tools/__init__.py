@@ -1,2 +1,2 @@
 name="QPanda3D"
-__all__ = ["generate_qt_to_pd3d_translator"]
\ No newline at end of file
+__all__ = ["generate_qt_to_pd3d_translator", "benchmark_pipeline"]
\ No newline at end of file
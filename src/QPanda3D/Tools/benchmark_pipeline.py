@@ -0,0 +1,121 @@
+# -*- coding: utf-8-*-
+"""
+Module : benchmark_pipeline
+Description :
+    Compares the frame time of a QPanda3DWidget with and without the
+    pipelined cull/draw threads (Panda3DWorld threading_model).
+    The scene is a grid of several thousand separate nodes spinning around,
+    so that cull has real work to do every frame.
+
+    Each threading model runs in its own process, since threading-model has
+    to be set before the graphics engine is created.
+
+    usage (from src/): python -m QPanda3D.Tools.benchmark_pipeline --nodes 5000
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+# None is the single threaded mode
+threading_models = [None, "Cull/Draw", "Cull/Cull/Draw"]
+
+
+def run_child(threading_model, nodes, seconds, width, height):
+    from panda3d.core import loadPrcFileData
+    from PyQt5.QtCore import QTimer
+    from PyQt5.QtWidgets import QApplication
+    from QPanda3D.Panda3DWorld import Panda3DWorld
+    from QPanda3D.QPanda3DWidget import QPanda3DWidget
+
+    loadPrcFileData("", "audio-library-name null")
+    app = QApplication(sys.argv)
+    world = Panda3DWorld(width, height, threading_model=threading_model or None)
+
+    root = world.render.attachNewNode("benchmark-root")
+    model = world.loader.loadModel("models/smiley")
+    side = int(nodes ** 0.5) + 1
+    # Some nodes also change their own transform every frame
+    moving = []
+    for i in range(nodes):
+        instance = model.copyTo(root)
+        instance.setPos((i % side - side / 2) * 3, (i // side) * 3 + 20, -10)
+        instance.setScale(0.5)
+        if i % 50 == 0:
+            moving.append(instance)
+    world.cam.setPos(0, -side, side)
+    world.cam.lookAt(0, side * 1.5, -10)
+
+    widget = QPanda3DWidget(world, FPS=1000)
+    widget.resize(width, height)
+    widget.show()
+
+    samples = []
+
+    def spin(task):
+        root.setH(task.time * 20)
+        for instance in moving:
+            instance.setR(task.time * 90)
+        samples.append((time.perf_counter(), world.render_time))
+        return task.cont
+
+    world.taskMgr.add(spin, "benchmark-spin")
+    QTimer.singleShot(int(seconds * 1000), app.quit)
+    app.exec_()
+
+    # Skip the warm up frames
+    samples = samples[len(samples) // 5:]
+    frames = len(samples) - 1
+    elapsed = samples[-1][0] - samples[0][0]
+    result = {
+        "threading_model": threading_model,
+        "readback_buffers": world.readback_buffers,
+        "nodes": nodes,
+        "frames": frames,
+        "frame_time_ms": 1000.0 * elapsed / max(1, frames),
+        "render_time_ms": 1000.0 * sum(r for _, r in samples) / max(1, len(samples)),
+    }
+    print("RESULT " + json.dumps(result))
+    sys.stdout.flush()
+    # Don't wait for the threads to be torn down cleanly
+    world.graphicsEngine.removeAllWindows()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=5000)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_child(args.child, args.nodes, args.seconds, args.width, args.height)
+        return
+
+    results = []
+    for threading_model in threading_models:
+        command = [sys.executable, "-m", "QPanda3D.Tools.benchmark_pipeline",
+                   "--nodes", str(args.nodes), "--seconds", str(args.seconds),
+                   "--width", str(args.width), "--height", str(args.height),
+                   "--child", threading_model or ""]
+        output = subprocess.run(command, capture_output=True, text=True).stdout
+        for line in output.splitlines():
+            if line.startswith("RESULT "):
+                results.append(json.loads(line[len("RESULT "):]))
+                break
+        else:
+            print("{} failed:\n{}".format(threading_model or "single threaded", output))
+
+    print("{:<18}{:>10}{:>10}{:>16}{:>16}".format("threading model", "buffers", "frames", "frame time ms",
+                                               "app render ms"))
+    for result in results:
+        print("{:<18}{:>10}{:>10}{:>16.2f}{:>16.2f}".format(result["threading_model"] or "single threaded",
+                                                        result["readback_buffers"], result["frames"],
+                                                        result["frame_time_ms"], result["render_time_ms"]))
+
+
+if __name__ == "__main__":
+    main()
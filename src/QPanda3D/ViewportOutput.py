@@ -0,0 +1,157 @@
+# -*- coding: utf-8-*-
+"""
+Module : ViewportOutput
+Description :
+    The offscreen buffer, RAM texture and camera that a QPanda3DWidget
+    displays. Every widget gets its own output so viewports of different
+    sizes don't fight over a single buffer, and the output of a hidden
+    widget can be switched off.
+
+    With more than one readback buffer, the buffer is copied into a ring of
+    textures: Panda renders into the next texture of the ring while Qt
+    displays the one finished the frame before.
+
+    The buffer may render below the widget size (resolution_scale < 1),
+    the widget then upscales the image when painting it.
+
+    The buffer allocation only grows: a smaller render size is served by
+    shrinking the display regions to the bottom-left corner of the buffer,
+    and the widget draws that sub-rectangle of the texture.
+"""
+
+# Panda imports
+from panda3d.core import *
+
+__all__ = ["ViewportOutput"]
+
+
+class ViewportOutput:
+    """
+    ViewportOutput : One render target of a Panda3DWorld
+    buff : The offscreen GraphicsOutput
+    texture : The texture the buffer is copied into (RTMCopyRam)
+    cam : The camera NodePath rendering into the buffer
+    make_texture : Creates the extra textures of the readback ring
+    resolution_scale : The scale the buffer was created at
+    """
+
+    def __init__(self, buff, texture, cam, make_texture=None, resolution_scale=1.0):
+        self.buff = buff
+        # The texture to display, always a finished frame
+        self.texture = texture
+        self.cam = cam
+        self.lens = cam.node().get_lens()
+        self.active = True
+
+        # Widget size and the fraction of it the buffer renders at
+        self.width = int(buff.getXSize() / resolution_scale)
+        self.height = int(buff.getYSize() / resolution_scale)
+        self.resolution_scale = resolution_scale
+        # Size the buffer is allocated at, at least the render size
+        self.alloc_width = buff.getXSize()
+        self.alloc_height = buff.getYSize()
+        self.reallocations = 0
+
+        self.make_texture = make_texture
+        self.textures = [texture]
+        # Render size each texture of the ring was last written at
+        self.texture_sizes = [self.get_render_size()]
+        self.write_index = 0
+
+    def set_active(self, active):
+        """
+        An inactive output is neither rendered nor copied back to RAM.
+        """
+        if active != self.active:
+            self.active = active
+            self.buff.setActive(active)
+
+    def set_size(self, width, height):
+        if (width, height) != (self.width, self.height):
+            self.width = width
+            self.height = height
+            self.fit_render_size()
+
+    def set_resolution_scale(self, scale):
+        if scale != self.resolution_scale:
+            self.resolution_scale = scale
+            self.fit_render_size()
+
+    def get_render_size(self):
+        return (max(1, int(self.width * self.resolution_scale)),
+                max(1, int(self.height * self.resolution_scale)))
+
+    def fit_render_size(self):
+        """
+        Makes the display regions cover the render size, reallocating the buffer
+        only if it doesn't fit, or if the widget became much smaller than the
+        allocation (a quarter of its area).
+        """
+        render_width, render_height = self.get_render_size()
+        too_small = render_width > self.alloc_width or render_height > self.alloc_height
+        too_large = self.width * self.height * 4 < self.alloc_width * self.alloc_height
+        if too_small or too_large:
+            if too_small:
+                self.alloc_width = max(self.alloc_width, render_width)
+                self.alloc_height = max(self.alloc_height, render_height)
+            else:
+                self.alloc_width = max(1, self.width)
+                self.alloc_height = max(1, self.height)
+            self.buff.setSize(self.alloc_width, self.alloc_height)
+            self.reallocations += 1
+        right = render_width / self.alloc_width
+        top = render_height / self.alloc_height
+        for region in self.buff.getDisplayRegions():
+            region.setDimensions(0, right, 0, top)
+        if len(self.textures) == 1:
+            self.texture_sizes[0] = (render_width, render_height)
+
+    def get_image_size(self):
+        """
+        Size of the rendered part of self.texture, which starts at its first row
+        (Panda images are bottom-up).
+        """
+        return self.texture_sizes[self.textures.index(self.texture)]
+
+    def get_stats(self):
+        return {
+            "active": self.active,
+            "size": (self.width, self.height),
+            "render_size": self.get_render_size(),
+            "buffer_size": (self.alloc_width, self.alloc_height),
+            "reallocations": self.reallocations,
+            "resolution_scale": self.resolution_scale,
+            "readback_buffers": len(self.textures),
+        }
+
+    def set_readback_buffers(self, count):
+        """
+        Sets the number of textures in the readback ring.
+        1 is the synchronous mode: the displayed texture is the one being written.
+        2 displays frame N-1 while frame N renders, 3 leaves room for a
+        pipelined draw thread (see Panda3DWorld threading_model).
+        """
+        count = max(1, int(count))
+        while len(self.textures) < count:
+            self.textures.append(self.make_texture())
+        del self.textures[count:]
+        self.texture_sizes = [self.get_render_size()] * count
+        self.write_index = 0
+        self.texture = self.textures[0]
+        self.buff.clearRenderTextures()
+        self.buff.addRenderTexture(self.textures[0], GraphicsOutput.RTMCopyRam)
+
+    def advance_readback(self):
+        """
+        Called once per frame before rendering: moves the copy target to the
+        next texture of the ring and displays the oldest one, which is the
+        newest frame that can no longer be written by the pipeline.
+        """
+        count = len(self.textures)
+        if count == 1 or not self.active:
+            return
+        self.write_index = (self.write_index + 1) % count
+        self.texture = self.textures[(self.write_index + 1) % count]
+        self.texture_sizes[self.write_index] = self.get_render_size()
+        self.buff.clearRenderTextures()
+        self.buff.addRenderTexture(self.textures[self.write_index], GraphicsOutput.RTMCopyRam)
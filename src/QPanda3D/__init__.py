@@ -1,2 +1,2 @@
 name="QPanda3D"
-__all__ = ["QPanda3DWidget", "Panda3DWorld", "QPanda3D_Keys_Translation"]
\ No newline at end of file
+__all__ = ["QPanda3DWidget", "Panda3DWorld", "ViewportOutput", "FrameTimings", "QPanda3D_Keys_Translation"]
\ No newline at end of file
@@ -1,12 +1,477 @@
-import terrainEditor
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+
+from heightfield import Heightfield
+
+# Gradients of the lattice noise, picked by hash. Using a fixed table instead
+# of angles keeps the noise free of sin/cos, whose SIMD versions may round
+# differently depending on where a value lands in an array.
+gradients = np.array([[1, 1], [-1, 1], [1, -1], [-1, -1], [1, 0], [-1, 0], [0, 1], [0, -1]], dtype=np.float64)
+
+neighbours = ((-1, 0), (1, 0), (0, -1), (0, 1))
+
+# Worker processes used by default: the generator runs inside the editor,
+# leave a core to the GUI and don't start a pool the width of a big machine
+default_workers = max(1, min(4, (os.cpu_count() or 1) - 1))
+
+
+def hash_lattice(ix, iy, seed):
+    """
+    32-bit hash of integer lattice coordinates (int64 arrays) and a seed.
+    """
+    h = (ix * 0x27d4eb2d + iy * 0x165667b1 + ((seed * 0x9e3779b1) & 0xffffffff)) & 0xffffffff
+    h ^= h >> 15
+    h = (h * 0x2c1b3c6d) & 0xffffffff
+    h ^= h >> 12
+    h = (h * 0x297a2d39) & 0xffffffff
+    h ^= h >> 15
+    return h
+
+
+def gradient_noise(x, y, seed):
+    """
+    Gradient (Perlin style) noise in about [-1, 1] at float64 coordinates.
+    Each value only depends on its own coordinates, so tiles can be computed
+    separately and still match.
+    """
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+    fx = x - x0
+    fy = y - y0
+    ix = x0.astype(np.int64)
+    iy = y0.astype(np.int64)
+    u = fx * fx * fx * (fx * (fx * 6 - 15) + 10)
+    v = fy * fy * fy * (fy * (fy * 6 - 15) + 10)
+
+    def corner(dx, dy):
+        g = gradients[hash_lattice(ix + dx, iy + dy, seed) & 7]
+        return g[..., 0] * (fx - dx) + g[..., 1] * (fy - dy)
+
+    top = corner(0, 0) + u * (corner(1, 0) - corner(0, 0))
+    bottom = corner(0, 1) + u * (corner(1, 1) - corner(0, 1))
+    return top + v * (bottom - top)
+
+
+def fbm(x, y, seed, octaves, lacunarity, gain):
+    total = np.zeros_like(x)
+    amplitude, frequency, norm = 1.0, 1.0, 0.0
+    for octave in range(octaves):
+        total += amplitude * gradient_noise(x * frequency, y * frequency, seed + octave * 1013)
+        norm += amplitude
+        amplitude *= gain
+        frequency *= lacunarity
+    return total / norm
+
+
+def ridged(x, y, seed, octaves, lacunarity, gain):
+    """
+    Ridged multifractal: sharp crests where the noise crosses zero, with each
+    octave weighted by the previous one so detail gathers on the ridges.
+    """
+    total = np.zeros_like(x)
+    weight = np.ones_like(x)
+    amplitude, frequency, norm = 1.0, 1.0, 0.0
+    for octave in range(octaves):
+        signal = 1.0 - np.abs(gradient_noise(x * frequency, y * frequency, seed + octave * 1013))
+        signal = signal * signal * weight
+        weight = np.clip(signal * 2.0, 0.0, 1.0)
+        total += amplitude * signal
+        norm += amplitude
+        amplitude *= gain
+        frequency *= lacunarity
+    return total / norm * 2.0 - 1.0
+
+
+def warped(x, y, seed, octaves, lacunarity, gain, warp):
+    """
+    fBm sampled at coordinates displaced by two other fBm fields.
+    """
+    qx = fbm(x, y, seed + 17, octaves, lacunarity, gain)
+    qy = fbm(x + 5.2, y + 1.3, seed + 31, octaves, lacunarity, gain)
+    return fbm(x + warp * qx, y + warp * qy, seed, octaves, lacunarity, gain)
+
+
+def noise_tile(rect, settings):
+    """
+    Noise heights of the samples in rect (x0, y0, x1, y1), float32.
+    """
+    x0, y0, x1, y1 = rect
+    y, x = np.mgrid[y0:y1, x0:x1].astype(np.float64)
+    x = (x + 0.5) / settings["feature_size"]
+    y = (y + 0.5) / settings["feature_size"]
+    args = (settings["seed"], settings["octaves"], settings["lacunarity"], settings["gain"])
+    if settings["noise"] == "fbm":
+        heights = fbm(x, y, *args)
+    elif settings["noise"] == "ridged":
+        heights = ridged(x, y, *args)
+    elif settings["noise"] == "warped":
+        heights = warped(x, y, *args, settings["warp"])
+    else:
+        raise ValueError("Unknown noise {}".format(settings["noise"]))
+    return heights.astype(np.float32)
+
+
+def get_window(array, rect, halo):
+    """
+    array[rect] with `halo` samples around it; outside the array the border
+    samples are repeated, the same way whichever tile asks.
+    """
+    x0, y0, x1, y1 = rect
+    height, width = array.shape
+    window = array[max(0, y0 - halo):min(height, y1 + halo), max(0, x0 - halo):min(width, x1 + halo)]
+    return np.pad(window, ((max(0, halo - y0), max(0, y1 + halo - height)),
+                           (max(0, halo - x0), max(0, x1 + halo - width))), mode="edge")
+
+
+def thermal_step(heights, talus, rate):
+    """
+    One thermal erosion step on a window with a 1 sample halo: material slides
+    between neighbours whose difference is over the talus. Transfers are
+    computed from both sides of each pair, so the result is a pure function
+    of the window and mass is conserved.
+    """
+    center = heights[1:-1, 1:-1]
+    delta = np.zeros_like(center)
+    for dy, dx in neighbours:
+        diff = heights[1 + dy:heights.shape[0] - 1 + dy, 1 + dx:heights.shape[1] - 1 + dx] - center
+        delta += rate * (np.maximum(diff - talus, 0.0) - np.maximum(-diff - talus, 0.0))
+    return center + delta
+
+
+def hydraulic_step(heights, water, sediment, settings):
+    """
+    One hydraulic erosion step on windows with a 2 sample halo. Water runs to
+    the lower neighbours carrying its sediment, picks up more where its flow
+    can carry it and drops it where it can't, then evaporates.
+    Returns the new heights, water and sediment of the window without halo.
+    """
+    water = water + settings["rain"]
+    total = heights + water
+    # Outflows of the cells with a 1 sample halo, toward each neighbour
+    inner = total[1:-1, 1:-1]
+    rows, columns = inner.shape
+    diffs = [np.maximum(inner - total[1 + dy:1 + dy + rows, 1 + dx:1 + dx + columns], 0.0) for dy, dx in neighbours]
+    total_diff = diffs[0] + diffs[1] + diffs[2] + diffs[3]
+    inner_water = water[1:-1, 1:-1]
+    # Moving half the difference levels two cells
+    moved = np.minimum(inner_water, total_diff * 0.5)
+    share = np.where(total_diff > 0, moved / np.maximum(total_diff, 1e-12), 0.0)
+    carried = sediment[1:-1, 1:-1] * moved / np.maximum(inner_water, 1e-12)
+
+    center = (slice(1, -1), slice(1, -1))
+    new_water = inner_water[center] - moved[center]
+    new_sediment = sediment[2:-2, 2:-2] - carried[center]
+    for dy, dx in neighbours:
+        # What the neighbour at (dy, dx) sends back toward this cell
+        opposite = neighbours.index((-dy, -dx))
+        area = (slice(1 + dy, rows - 1 + dy), slice(1 + dx, columns - 1 + dx))
+        inflow = share[area] * diffs[opposite][area]
+        new_water += inflow
+        new_sediment += inflow * carried[area] / np.maximum(moved[area], 1e-12)
+
+    new_heights = heights[2:-2, 2:-2].copy()
+    capacity = settings["capacity"] * moved[center]
+    excess = new_sediment - capacity
+    change = np.where(excess > 0, settings["deposition"] * excess, settings["erosion"] * excess)
+    new_heights += change
+    new_sediment -= change
+    new_water *= 1.0 - settings["evaporation"]
+    return new_heights, new_water, new_sediment
+
+
+# Arrays of the pool workers, attached to the generator's shared memory,
+# and the (names, shape) they were attached for
+worker_arrays = {}
+worker_memory = []
+worker_shared = None
+
+
+def attach_shared(names, shape):
+    """
+    Attaches the worker to the generator's current buffers; the pool outlives
+    them, they are replaced when the terrain size changes.
+    """
+    global worker_shared
+    if worker_shared == (names, shape):
+        return
+    worker_arrays.clear()
+    for memory in worker_memory:
+        memory.close()
+    worker_memory.clear()
+    for key, name in names.items():
+        memory = shared_memory.SharedMemory(name=name)
+        worker_memory.append(memory)
+        worker_arrays[key] = np.ndarray(shape, dtype=np.float32, buffer=memory.buf)
+    worker_shared = (names, shape)
+
+
+def run_tile(stage, rect, settings, source, target, arrays=None, shared=None):
+    """
+    Runs one stage over one tile, reading the `source` buffers and writing
+    the `target` ones: in arrays, or in the shared buffers described by
+    shared, (names, shape), on a pool worker.
+    """
+    if arrays is None:
+        attach_shared(*shared)
+        arrays = worker_arrays
+    x0, y0, x1, y1 = rect
+    area = (slice(y0, y1), slice(x0, x1))
+    if stage == "noise":
+        arrays["heights" + target][area] = noise_tile(rect, settings)
+    elif stage == "thermal":
+        window = get_window(arrays["heights" + source], rect, 1)
+        arrays["heights" + target][area] = thermal_step(window, settings["talus"], settings["thermal_rate"])
+    elif stage == "hydraulic":
+        windows = [get_window(arrays[key + source], rect, 2) for key in ("heights", "water", "sediment")]
+        heights, water, sediment = hydraulic_step(*windows, settings)
+        arrays["heights" + target][area] = heights
+        arrays["water" + target][area] = water
+        arrays["sediment" + target][area] = sediment
+    elif stage == "settle":
+        # Whatever sediment is still in the water settles where it is
+        arrays["heights" + target][area] = np.clip(arrays["heights" + source][area] + arrays["sediment" + source][area],
+                                                   0.0, 1.0)
+    return rect
+
 
 class GenerateTerrain():
-    def __init__(self):
+    """
+    Procedural terrain: fBm, ridged or domain-warped noise, followed by
+    thermal and hydraulic erosion.
+
+    The heights are computed over tile_size tiles, on a process pool sharing
+    the buffers through shared memory when workers > 1. Every sample only
+    depends on the seed and the previous pass, never on the tiling, so a
+    seed gives the same terrain for any number of workers.
+
+    The pool and the buffers are kept between runs (the buffers until the
+    size changes); close() releases them.
+    """
+
+    noises = ("fbm", "ridged", "warped")
+
+    def __init__(self, terrain_painter=None, seed=0, noise="fbm", feature_size=None, octaves=6,
+                 lacunarity=2.0, gain=0.5, warp=1.5, thermal_iterations=20, talus=0.002, thermal_rate=0.1,
+                 hydraulic_iterations=30, rain=0.001, capacity=1.0, erosion=0.3, deposition=0.3,
+                 evaporation=0.05, workers=None, tile_size=256):
+        self.terrain_painter = terrain_painter
+        self.seed = seed
+        self.noise = noise
+        # Size of the largest noise features in samples, a quarter of the terrain if None
+        self.feature_size = feature_size
+        self.octaves = octaves
+        self.lacunarity = lacunarity
+        self.gain = gain
+        self.warp = warp
+        self.thermal_iterations = thermal_iterations
+        self.talus = talus
+        self.thermal_rate = thermal_rate
+        self.hydraulic_iterations = hydraulic_iterations
+        self.rain = rain
+        self.capacity = capacity
+        self.erosion = erosion
+        self.deposition = deposition
+        self.evaporation = evaporation
+        self.workers = workers if workers is not None else default_workers
+        self.tile_size = tile_size
+        # Seconds spent in each stage by the last generate()
+        self.timings = {}
+        self.pool = None
+        # Shared buffers of the pool and the shape they were made for
+        self.memory = {}
+        self.memory_shape = None
+        # Runs generate() for apply_async, one at a time
+        self.thread = None
+
+    def get_settings(self, width, height):
+        return {
+            "seed": self.seed, "noise": self.noise,
+            "feature_size": float(self.feature_size or max(width, height) / 4.0),
+            "octaves": self.octaves, "lacunarity": self.lacunarity, "gain": self.gain, "warp": self.warp,
+            "talus": self.talus, "thermal_rate": self.thermal_rate,
+            "rain": self.rain, "capacity": self.capacity, "erosion": self.erosion,
+            "deposition": self.deposition, "evaporation": self.evaporation,
+        }
+
+    def get_tiles(self, width, height):
+        return [(x, y, min(x + self.tile_size, width), min(y + self.tile_size, height))
+                for y in range(0, height, self.tile_size) for x in range(0, width, self.tile_size)]
+
+    def generate(self, width=512, height=None):
+        """
+        Generates a width x height Heightfield.
+        """
+        height = height or width
+        shape = (height, width)
+        keys = [key + index for key in ("heights", "water", "sediment") for index in ("0", "1")]
+        if self.workers > 1:
+            if self.memory_shape != shape:
+                self.release_memory()
+                self.memory = {key: shared_memory.SharedMemory(create=True, size=width * height * 4) for key in keys}
+                self.memory_shape = shape
+            arrays = {key: np.ndarray(shape, dtype=np.float32, buffer=self.memory[key].buf) for key in keys}
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(self.workers, mp_context=get_context("spawn"))
+            shared = ({key: self.memory[key].name for key in keys}, shape)
+        else:
+            arrays = {key: np.empty(shape, dtype=np.float32) for key in keys}
+            shared = None
+        return Heightfield(width, height, self.run_stages(arrays, shared, width, height))
+
+    def release_memory(self):
+        for memory in self.memory.values():
+            memory.close()
+            memory.unlink()
+        self.memory = {}
+        self.memory_shape = None
+
+    def close(self):
+        """
+        Stops the worker processes and frees the shared buffers.
+        """
+        if self.thread is not None:
+            self.thread.shutdown()
+            self.thread = None
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.release_memory()
+
+    def run_stages(self, arrays, shared, width, height):
+        settings = self.get_settings(width, height)
+        tiles = self.get_tiles(width, height)
+
+        def run(stage, source, target):
+            if shared is None:
+                for rect in tiles:
+                    run_tile(stage, rect, settings, source, target, arrays)
+            else:
+                # Every tile of a pass finishes before the next pass reads its neighbours
+                list(self.pool.map(run_tile, *zip(*[(stage, rect, settings, source, target, None, shared)
+                                                    for rect in tiles])))
+
+        self.timings = {}
+        start = time.perf_counter()
+        run("noise", "0", "0")
+        heights = arrays["heights0"]
+        # Min and max are exact, normalizing doesn't depend on the tiling
+        low, high = heights.min(), heights.max()
+        heights -= low
+        heights /= max(high - low, 1e-12)
+        self.timings["noise"] = time.perf_counter() - start
+
+        # Passes read one buffer and write the other, then swap
+        source, target = "0", "1"
+        start = time.perf_counter()
+        for _ in range(self.thermal_iterations):
+            run("thermal", source, target)
+            source, target = target, source
+        self.timings["thermal"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        arrays["water" + source][:] = 0.0
+        arrays["sediment" + source][:] = 0.0
+        for _ in range(self.hydraulic_iterations):
+            run("hydraulic", source, target)
+            source, target = target, source
+        run("settle", source, target)
+        self.timings["hydraulic"] = time.perf_counter() - start
+        return np.array(arrays["heights" + target])
+
+    def get_painter(self, terrain_painter=None):
+        painter = terrain_painter or self.terrain_painter
+        if getattr(painter, "paged_terrain", None) is not None:
+            # The buffers and the undo record would hold the whole terrain in memory
+            raise ValueError("Paged terrains can't be generated")
+        return painter
+
+    def apply(self, terrain_painter=None):
+        """
+        Generates heights the size of the painter's terrain and puts them in
+        place as one undoable edit.
+        """
+        painter = self.get_painter(terrain_painter)
+        heights = painter.get_heights()
+        generated = self.generate(heights.width, heights.height)
+        self.put_heights(painter, generated)
+        return generated
+
+    def apply_async(self, terrain_painter=None, on_done=None):
+        """
+        apply() with the heights generated on a background thread, so the
+        editor keeps running meanwhile; they are put in place from a task of
+        the painter's world once ready, then on_done(heights or None) is called.
+        """
+        painter = self.get_painter(terrain_painter)
+        heights = painter.get_heights()
+        if self.thread is None:
+            self.thread = ThreadPoolExecutor(1, thread_name_prefix="GenerateTerrain")
+        future = self.thread.submit(self.generate, heights.width, heights.height)
+
+        def finish_task(task):
+            if not future.done():
+                return task.cont
+            generated = None
+            try:
+                generated = future.result()
+                if painter.get_heights() is heights and not painter.is_loading():
+                    self.put_heights(painter, generated)
+                else:
+                    print("⚠️ The terrain changed while generating, heights dropped")
+                    generated = None
+            except Exception as e:
+                print(f"❌ Terrain generation failed: {e}")
+            if on_done is not None:
+                on_done(generated)
+            return task.done
+
+        painter.world.add_task(finish_task, "terrain-generation")
+        return future
+
+    def put_heights(self, painter, generated):
+        """
+        Writes generated heights over the painter's as one undoable edit and
+        uploads them.
+        """
+        heights = painter.get_heights()
+        rect = (0, 0, heights.width, heights.height)
+        painter.history.begin("generate")
+        painter.history.record(heights, rect)
+        heights.write_rect(rect, generated.data)
+        painter.history.commit(heights)
+        painter.refresh_heights(rect)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the terrain generator and checks it is deterministic.")
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--noise", default="fbm", choices=GenerateTerrain.noises)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    parser.add_argument("--thermal", type=int, default=20)
+    parser.add_argument("--hydraulic", type=int, default=30)
+    args = parser.parse_args()
+
+    reference = None
+    for workers in args.workers:
+        generator = GenerateTerrain(seed=args.seed, noise=args.noise, workers=workers,
+                                    thermal_iterations=args.thermal, hydraulic_iterations=args.hydraulic)
+        start = time.perf_counter()
+        heights = generator.generate(args.size).data
+        elapsed = time.perf_counter() - start
+        stages = ", ".join("{} {:.2f}s".format(stage, seconds) for stage, seconds in generator.timings.items())
+        if reference is None:
+            reference = heights
+        same = "same as first run" if np.array_equal(heights, reference) else "DIFFERS from first run"
+        print("{}x{} {} with {} worker(s): {:.2f}s ({}), {}".format(args.size, args.size, args.noise, workers,
+                                                                  elapsed, stages, same))
+        generator.close()
 
-        self.terrain_painter = terrainEditor.TerrainPainterApp()
 
-    def set_hold(self):
-        self.terrain_painter.start_holding()
-    
-    def stop_hold(self):
-        self.terrain_painter.stop_holding()
+if __name__ == "__main__":
+    main()
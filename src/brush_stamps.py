@@ -0,0 +1,70 @@
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+
+class BrushStampCache:
+    """
+    Keeps terrain brush stamps in memory: float32 weight arrays in [0, 1],
+    already scaled to the brush size and multiplied by the intensity.
+    Stamps are keyed by (brush file, size, intensity, falloff) and the least
+    recently used ones are evicted past `capacity`.
+    """
+
+    def __init__(self, capacity=32, intensity_steps=64):
+        self.capacity = capacity
+        # Intensities are rounded to 1/intensity_steps, so a stroke whose
+        # intensity ramps up reuses a handful of stamps
+        self.intensity_steps = intensity_steps
+        self.stamps = OrderedDict()
+        # Decoded alpha channel of each brush file, at its native size
+        self.masks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_mask(self, brush_file):
+        mask = self.masks.get(brush_file)
+        if mask is None:
+            brush_image = Image.open(brush_file).convert('RGBA')
+            mask = np.asarray(brush_image, dtype=np.float32)[:, :, 3] / 255.0
+            self.masks[brush_file] = mask
+        return mask
+
+    def get_native_size(self, brush_file):
+        return self.get_mask(brush_file).shape[1]
+
+    def make_key(self, brush_file, size, intensity, falloff):
+        intensity = round(intensity * self.intensity_steps) / self.intensity_steps
+        return (brush_file, max(1, int(size)), intensity, float(falloff))
+
+    def get_stamp(self, brush_file, size, intensity, falloff=1.0):
+        """
+        Returns the size x size weights of the brush, alpha ** falloff * intensity.
+        The array is shared, don't modify it.
+        """
+        key = self.make_key(brush_file, size, intensity, falloff)
+        stamp = self.stamps.get(key)
+        if stamp is not None:
+            self.stamps.move_to_end(key)
+            self.hits += 1
+            return stamp
+
+        self.misses += 1
+        _, size, intensity, falloff = key
+        mask = self.get_mask(brush_file)
+        if mask.shape != (size, size):
+            # Pillow infers mode "F" from the float32 dtype
+            mask = np.asarray(Image.fromarray(np.ascontiguousarray(mask, dtype=np.float32)).resize((size, size), Image.BILINEAR))
+        stamp = np.clip(mask, 0.0, 1.0) ** falloff * intensity
+        stamp = np.clip(stamp, 0.0, 1.0).astype(np.float32)
+        stamp.flags.writeable = False
+
+        self.stamps[key] = stamp
+        if len(self.stamps) > self.capacity:
+            self.stamps.popitem(last=False)
+        return stamp
+
+    def clear(self):
+        self.stamps.clear()
+        self.masks.clear()
@@ -11,9 +11,127 @@ from panda3d.core import NodePath  # Assuming NodePath is from panda3d.core
 
 from panda3d.core import PointLight, Spotlight, DirectionalLight, AmbientLight, Vec4, Vec3
 
+import shutil
+import time
+import zlib
+import numpy as np
+
+from panda3d.core import Point3
+from paged_terrain import TileFile
+from raycasting import get_pick_service
+
+
+def find_terrain_painter(root_node: NodePath):
+    """
+    Returns the TerrainPainterApp of the first terrain under root_node, or None.
+    """
+    for node in root_node.find_all_matches("**"):
+        if node.has_python_tag("terrain_painter"):
+            return node.get_python_tag("terrain_painter")
+    return None
+
+
+# Sample formats of the saved terrain tiles: numpy type and largest value
+terrain_formats = {"uint16": ("<u2", 65535.0), "float32": ("<f4", 1.0)}
+
+
+class TerrainTileStreamer:
+    """
+    Loads the tiles of a saved terrain into a painter a few at a time, the
+    ones nearest to the camera first, spending at most frame_budget seconds
+    per frame so the editor stays responsive while a large terrain loads.
+
+    The painter knows its streamer (painter.terrain_streamer) and doesn't
+    paint until it is done; a new streamer for the same painter, or closing
+    the painter, stops the previous one.
+    """
+
+    def __init__(self, world, painter, terrain_folder, header, frame_budget=0.004):
+        self.world = world
+        self.painter = painter
+        self.terrain_folder = terrain_folder
+        self.header = header
+        self.frame_budget = frame_budget
+        self.dtype, self.max_value = terrain_formats[header.get("format", "uint16")]
+        tile_size = header["tile_size"]
+        width, height = header["width"], header["height"]
+        self.tiles = [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+                      for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+        self.loaded = 0
+        if painter.terrain_streamer is not None:
+            painter.terrain_streamer.stop()
+        painter.terrain_streamer = self
+        # Loading isn't an edit, and the strokes before it don't apply to the loaded heights
+        painter.history.clear()
+        self.task = self.world.taskMgr.add(self.stream_task, "terrain-tile-streaming")
+
+    def get_tile_path(self, rect):
+        tile_size = self.header["tile_size"]
+        return os.path.join(self.terrain_folder, "tiles", f"{rect[0] // tile_size}_{rect[1] // tile_size}.tile")
+
+    def load_tile(self, rect):
+        x0, y0, x1, y1 = rect
+        path = self.get_tile_path(rect)
+        if not os.path.exists(path):
+            print(f"⚠️ Terrain tile missing: {path}")
+            return
+        with open(path, "rb") as file:
+            samples = np.frombuffer(zlib.decompress(file.read()), dtype=self.dtype)
+        heights = samples.reshape(y1 - y0, x1 - x0).astype(np.float32) / self.max_value
+        self.painter.get_heights().write_rect(rect, heights)
+        self.painter.upload_heights(rect)
+
+    def stream_task(self, task):
+        # Nearest tiles to where the camera is now, it may move while loading
+        camera_x, camera_y = self.painter.world_to_heightmap(self.world.camera.get_pos(self.world.render))
+        self.tiles.sort(key=lambda rect: ((rect[0] + rect[2]) / 2 - camera_x) ** 2 + ((rect[1] + rect[3]) / 2 - camera_y) ** 2,
+                        reverse=True)
+        start = time.perf_counter()
+        while self.tiles:
+            self.load_tile(self.tiles.pop())
+            self.loaded += 1
+            if time.perf_counter() - start >= self.frame_budget:
+                break
+        if self.tiles:
+            return task.cont
+        self.complete()
+        return task.done
+
+    def complete(self):
+        self.painter.finish_stroke()
+        if self.painter.paged_terrain is None:
+            self.painter.regenerate_terrain()
+        self.painter.update_collision()
+        self.painter.terrain_streamer = None
+        print(f"🏔️ Terrain loaded ({self.loaded} tiles)")
+
+    def finish(self):
+        """
+        Loads the remaining tiles right away, e.g. before the terrain is saved.
+        """
+        if not self.tiles:
+            return
+        self.world.taskMgr.remove(self.task)
+        while self.tiles:
+            self.load_tile(self.tiles.pop())
+            self.loaded += 1
+        self.complete()
+
+    def is_done(self):
+        return not self.tiles
+
+    def stop(self):
+        """
+        Stops loading, the tiles not loaded yet are left as they are.
+        """
+        self.world.taskMgr.remove(self.task)
+        if self.painter.terrain_streamer is self:
+            self.painter.terrain_streamer = None
+
 class MapLoader:
     def __init__(self, world):
         self.world = world
+        self.terrain_streamer = None
 
     def extract_map(self, map_file, extract_to):
         """
@@ -50,10 +168,16 @@ class MapLoader:
         # For example, if map_file is .../saves/tttttt/tttttt.map, extract to .../saves/tttttt/tttttt
         extract_dir = os.path.join(project_folder, os.path.basename(map_file).replace('.map', ''))
 
+        # The previous map must not keep streaming into the terrain
+        if self.terrain_streamer is not None:
+            self.terrain_streamer.stop()
+            self.terrain_streamer = None
         if self.extract_map(map_file, extract_dir):
             print("✅ Map extraction successful, loading scene...")
             loader_instance = Load(self.world)
             loader_instance.load_project_from_folder_toml(extract_dir, self.world.render)
+            # The terrain tiles keep streaming in after this returns
+            self.terrain_streamer = loader_instance.load_terrain_from_folder(extract_dir)
             print("🎮 Scene loaded successfully!")
         else:
             print("❌ Failed to load map.")
@@ -152,11 +276,67 @@ class Load:
                 entity_node.setPos(pos["x"], pos["y"], pos["z"])
                 entity_node.setHpr(rot["h"], rot["p"], rot["r"])
                 entity_node.setScale(scale["x"], scale["y"], scale["z"])
+                get_pick_service(self.world).node_moved(entity_node)
                 entities.append(entity_node)
                 print(f"✅ Entity '{name}' loaded from {file_name}")
 
         return entities
 
+    def load_terrain_from_folder(self, input_folder: str):
+        """
+        Loads terrain/terrain.toml and its tiles into the scene's terrain painter.
+        The tiles are streamed in over the next frames, nearest to the camera
+        first; returns the TerrainTileStreamer, or None if there is nothing to load.
+        """
+        terrain_folder = os.path.join(input_folder, "terrain")
+        header_path = os.path.join(terrain_folder, "terrain.toml")
+        if not os.path.exists(header_path):
+            return None
+        with open(header_path, "r") as file:
+            header = toml.load(file)["terrain"]
+        if isinstance(header.get("paged"), dict):
+            self.load_paged_terrain(header["paged"])
+            return None
+        painter = find_terrain_painter(self.world.render)
+        if painter is None:
+            print("⚠️ The map has a terrain but the scene has no terrain painter")
+            return None
+
+        heights = painter.get_heights()
+        if (header["width"], header["height"]) != (heights.width, heights.height):
+            if painter.paged_terrain is not None:
+                print(f"❌ Saved terrain is {header['width']}x{header['height']}, "
+                      f"the paged terrain is {heights.width}x{heights.height}")
+                return None
+            painter.resize_heightfield(header["width"], header["height"])
+        transform = header.get("transform")
+        if transform and painter.paged_terrain is None:
+            position, scale = transform["position"], transform["scale"]
+            painter.terrain_np.set_pos(position["x"], position["y"], position["z"])
+            painter.terrain_np.set_scale(scale["x"], scale["y"], scale["z"])
+            get_pick_service(self.world).node_moved(painter.terrain_np)
+        return TerrainTileStreamer(self.world, painter, terrain_folder, header)
+
+    def load_paged_terrain(self, paged):
+        """
+        Opens the tile file a paged terrain was saved with, unless the scene's
+        terrain already pages from it; the heights are read from it as the
+        camera moves, nothing is copied.
+        """
+        path = paged["tile_file"]
+        painter = find_terrain_painter(self.world.render)
+        if (painter is not None and painter.paged_terrain is not None and
+                os.path.abspath(painter.paged_terrain.tile_file.path) == os.path.abspath(path)):
+            return painter
+        if not os.path.exists(path):
+            print(f"❌ Paged terrain tile file not found: {path}")
+            return None
+        origin = paged["origin"]
+        return self.world.make_paged_terrain(TileFile(path), spacing=paged["spacing"],
+                                             height_scale=paged["height_scale"],
+                                             origin=Point3(origin["x"], origin["y"], origin["z"]),
+                                             chunk_size=paged["chunk_size"])
+
     def load_script(self, script_path: str, node: NodePath):
         """
         Dynamically load a script from a Python file and attach it to a node.
@@ -269,8 +449,7 @@ class Load:
                     "model": model_path
                 })
 
-                self.world.hierarchy_tree1.clear()
-                self.world.populate_hierarchy(self.world.hierarchy_tree1, self.world.render2d)
+                self.world.hierarchy_model1.sync()
                 
                 print(f"Entity '{name}' with ID '{entity_id}' loaded.")
 
@@ -370,8 +549,7 @@ class Load:
                     "model": model_path
                 })
 
-                self.world.hierarchy_tree1.clear()
-                self.world.populate_hierarchy(self.world.hierarchy_tree1, self.world.render2d)
+                self.world.hierarchy_model1.sync()
                 
                 print(f"Entity '{name}' with ID '{entity_id}' loaded.")
 
@@ -484,18 +662,111 @@ class Save:
                     toml.dump(entity_data, file)
                 print(f"Saved {file_name} to {output_folder}")
 
-    def zip_toml_files(self, source_dir, output_zip):
+        self.save_terrain_to_folder(root_node, output_folder)
+
+    def save_terrain_to_folder(self, root_node: NodePath, output_folder: str, tile_size=256, sample_format="uint16"):
+        """
+        Saves the heights of the scene's terrain painter into output_folder/terrain:
+        terrain.toml describes the heightfield, tiles/<x>_<y>.tile hold its
+        tile_size x tile_size tiles as zlib compressed little endian samples
+        (uint16 or float32). A paged terrain is already on disk: its tile file
+        is flushed and referenced from terrain.toml instead of being copied.
+        """
+        painter = find_terrain_painter(root_node)
+        if painter is None:
+            return
+        # Half loaded heights would replace the good saved ones
+        if painter.terrain_streamer is not None:
+            painter.terrain_streamer.finish()
+        terrain_folder = os.path.join(output_folder, "terrain")
+        # Written next to the old save and swapped in once complete, so a
+        # failed save leaves the last good terrain in place
+        new_folder = terrain_folder + ".tmp"
+        if os.path.exists(new_folder):
+            shutil.rmtree(new_folder)
+        try:
+            if painter.paged_terrain is not None:
+                self.save_paged_terrain(painter.paged_terrain, new_folder)
+            else:
+                self.save_terrain_tiles(painter, new_folder, tile_size, sample_format)
+        except Exception:
+            shutil.rmtree(new_folder, ignore_errors=True)
+            raise
+        # Tiles of a previous save may not match anymore
+        old_folder = terrain_folder + ".old"
+        if os.path.exists(old_folder):
+            shutil.rmtree(old_folder)
+        if os.path.exists(terrain_folder):
+            os.replace(terrain_folder, old_folder)
+        os.replace(new_folder, terrain_folder)
+        shutil.rmtree(old_folder, ignore_errors=True)
+        print(f"Saved terrain to {terrain_folder}")
+
+    def save_terrain_tiles(self, painter, terrain_folder, tile_size, sample_format):
+        heights = painter.get_heights()
+        dtype, max_value = terrain_formats[sample_format]
+        os.makedirs(os.path.join(terrain_folder, "tiles"), exist_ok=True)
+        for y in range(0, heights.height, tile_size):
+            for x in range(0, heights.width, tile_size):
+                rect = (x, y, min(x + tile_size, heights.width), min(y + tile_size, heights.height))
+                samples = np.asarray(heights.read_rect(rect), dtype=np.float32)
+                if max_value != 1.0:
+                    samples = np.round(np.clip(samples, 0.0, 1.0) * max_value)
+                tile_path = os.path.join(terrain_folder, "tiles", f"{x // tile_size}_{y // tile_size}.tile")
+                with open(tile_path, "wb") as file:
+                    file.write(zlib.compress(samples.astype(dtype).tobytes(), 6))
+
+        position = painter.terrain_np.get_pos()
+        scale = painter.terrain_np.get_scale()
+        header = {
+            "width": heights.width,
+            "height": heights.height,
+            "tile_size": tile_size,
+            "format": sample_format,
+            "compression": "zlib",
+            "transform": {
+                "position": {"x": position.x, "y": position.y, "z": position.z},
+                "scale": {"x": scale.x, "y": scale.y, "z": scale.z},
+            },
+        }
+        with open(os.path.join(terrain_folder, "terrain.toml"), "w") as file:
+            toml.dump({"terrain": header}, file)
+        print(f"Saved terrain ({heights.width}x{heights.height})")
+
+    def save_paged_terrain(self, paged_terrain, terrain_folder):
+        paged_terrain.tile_file.flush()
+        origin = paged_terrain.origin
+        header = {
+            "width": paged_terrain.width,
+            "height": paged_terrain.height,
+            "paged": {
+                "tile_file": os.path.abspath(paged_terrain.tile_file.path),
+                "spacing": paged_terrain.spacing,
+                "height_scale": paged_terrain.height_scale,
+                "origin": {"x": origin.x, "y": origin.y, "z": origin.z},
+                "chunk_size": paged_terrain.chunk_size,
+            },
+        }
+        os.makedirs(terrain_folder, exist_ok=True)
+        with open(os.path.join(terrain_folder, "terrain.toml"), "w") as file:
+            toml.dump({"terrain": header}, file)
+        print(f"Saved paged terrain ({paged_terrain.width}x{paged_terrain.height}) "
+              f"referencing {paged_terrain.tile_file.path}")
+
+    def zip_toml_files(self, source_dir, output_zip, extensions=(".toml", ".tile")):
         """
-        Zips all .toml files from the source directory (and its subdirectories) into a single ZIP file.
+        Zips all .toml files (and terrain .tile files) from the source directory (and its subdirectories) into a single ZIP file.
         """
         with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
             for foldername, subfolders, filenames in os.walk(source_dir):
                 for filename in filenames:
-                    if filename.endswith('.toml'):
+                    if filename.endswith(extensions):
                         filepath = os.path.join(foldername, filename)
                         # Get relative path for zip archive
                         arcname = os.path.relpath(filepath, source_dir)
-                        zipf.write(filepath, arcname=arcname)
+                        # Terrain tiles are compressed already
+                        compression = zipfile.ZIP_STORED if filename.endswith(".tile") else zipfile.ZIP_DEFLATED
+                        zipf.write(filepath, arcname=arcname, compress_type=compression)
         print(f"Zipped TOML files into: {output_zip}")
 
     def save_scene_to_map(self, toml_folder: str, output_map: str):
@@ -8,6 +8,7 @@ import math
 
 from direct.showbase.DirectObject import DirectObject
 from QPanda3D.Panda3DWorld import Panda3DWorld  # Make sure this returns a proper ShowBase-derived object
+from raycasting import get_pick_service
 
 class GizmoDemo(DirectObject):
     def __init__(self, world: Panda3DWorld):
@@ -54,7 +55,9 @@ class GizmoDemo(DirectObject):
         }
         
         # --- Collision Setup for Picking ---
-        self.pickerMask = BitMask32.bit(10)
+        # The world's pick service casts the mouse ray; it gives the gizmo mask.
+        self.pick_service = get_pick_service(world)
+        self.pickerMask = self.pick_service.register_category("gizmo")
         for axis, arrow in self.gizmos.items():
             # Compute tight bounds and create a collision sphere.
             min_bound, max_bound = arrow.getTightBounds()
@@ -68,17 +71,6 @@ class GizmoDemo(DirectObject):
             cnode.setIntoCollideMask(self.pickerMask)
             arrow.attachNewNode(cnode)
         
-        # --- Picking Ray Setup ---
-        self.picker = CollisionTraverser()
-        self.pq = CollisionHandlerQueue()
-        self.pickerNode = CollisionNode('mouseRay')
-        self.pickerNode.setFromCollideMask(self.pickerMask)
-        # Attach the picker node to render so that the ray is global.
-        self.pickerNP = world.render.attachNewNode(self.pickerNode)
-        self.pickerRay = CollisionRay()
-        self.pickerNode.addSolid(self.pickerRay)
-        self.picker.addCollider(self.pickerNP, self.pq)
-        
         # --- Dragging State Variables ---
         self.dragAxis = None           # Vec3: the axis along which movement is constrained
         self.initialGizmoPos = None    # Point3: gizmo_root's position at mouse down
@@ -215,25 +207,17 @@ class GizmoDemo(DirectObject):
         
         
         mpos = position
-        nearPoint = Point3()
-        farPoint = Point3()
-        pMouse = base.mouseWatcherNode.getMouse()
-        base.camLens.extrude(pMouse, nearPoint, farPoint)
-        r0 = render.getRelativePoint(self.world.camera, nearPoint)
-        rFar = render.getRelativePoint(self.world.camera, farPoint)
+        ray = self.pick_service.get_mouse_ray()
+        if ray is None:
+            return
+        r0, rFar = ray
         rdir = (rFar - r0).normalized()
-        self.pickerRay.setOrigin(r0)
-        self.pickerRay.setDirection(rdir)
         
-        self.picker.traverse(self.gizmo_root)
-        
-        if self.pq.getNumEntries() > 0:
-
-            self.pq.sortEntries()
-            entry = self.pq.getEntry(0)
-            pickedObj = self.pq.getEntry(0).getIntoNodePath()
-            pickedObj = pickedObj.findNetTag('gizmo')
+        # Nearest gizmo hit that belongs to this gizmo (other tools use the category too)
+        for hit in self.pick_service.pick(("gizmo",)):
+            pickedObj = hit.node_path.findNetTag('gizmo')
             if not pickedObj.isEmpty():
+                entry = hit.entry
                 nodeName = entry.getIntoNode().getName()  # e.g., "gizmo_x"
                 if nodeName.startswith("gizmo_"):
                     print("Picked gizmo:", nodeName)
@@ -252,9 +236,12 @@ class GizmoDemo(DirectObject):
                         linePoint = self.initialGizmoPos
                         lineDir = self.dragAxis
                         self.initialDragParam = self.computeDragParameter(r0, rdir, linePoint, lineDir)
+                        self.world.begin_interaction("gizmo-drag")
                         print("Dragging axis:", axis, "initial param =", self.initialDragParam)
+                break
     
     def onMouseUp(self, position):
+        self.world.end_interaction("gizmo-drag")
         self.dragAxis = None
         self.initialGizmoPos = None
         self.initialDragParam = None
@@ -275,6 +262,7 @@ class GizmoDemo(DirectObject):
             deltaParam = currentParam - self.initialDragParam
             newPos = self.initialGizmoPos + self.dragAxis * deltaParam
             self.gizmo_root.setPos(render, newPos)
+            self.pick_service.node_moved(self.gizmo_root)
             # Debug: print updated position.
             # print("New gizmo pos:", newPos)
         return Task.cont
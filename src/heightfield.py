@@ -0,0 +1,373 @@
+import numpy as np
+from panda3d.core import Filename, PNMImage, StringStream, Texture
+
+
+class Heightfield:
+    """
+    Terrain heights held as a float32 NumPy array in [0, 1].
+    data[y, x] follows the PNMImage layout: row 0 is the top row.
+
+    Brush operations only touch the window covered by the stamp and return
+    the dirty rectangle (x0, y0, x1, y1), end exclusive. Conversion to
+    PNMImage/Texture only happens when uploading.
+    """
+
+    modes = ("raise", "lower", "smooth", "flatten", "noise", "set_height")
+
+    def __init__(self, width, height=None, data=None, seed=0):
+        if data is None:
+            data = np.zeros((height or width, width), dtype=np.float32)
+        self.data = np.ascontiguousarray(data, dtype=np.float32)
+        self.rng = np.random.default_rng(seed)
+
+    @classmethod
+    def from_image(cls, image: PNMImage):
+        """
+        Builds a heightfield from the gray levels of a PNMImage.
+        """
+        gray = PNMImage(image)
+        gray.make_grayscale()
+        gray.remove_alpha()
+        gray.set_maxval(65535)
+        stream = StringStream()
+        gray.write(stream, "heightfield.pgm")
+        data = stream.get_data()
+        # P5 header: magic, width, height, maxval, then big endian samples
+        header_end = 0
+        for _ in range(4):
+            while data[header_end:header_end + 1].isspace():
+                header_end += 1
+            while not data[header_end:header_end + 1].isspace():
+                header_end += 1
+        samples = np.frombuffer(data, dtype=">u2", offset=header_end + 1,
+                                count=gray.get_x_size() * gray.get_y_size())
+        heights = samples.reshape(gray.get_y_size(), gray.get_x_size()).astype(np.float32) / 65535.0
+        return cls(gray.get_x_size(), gray.get_y_size(), heights)
+
+    @classmethod
+    def from_file(cls, path):
+        image = PNMImage()
+        if not image.read(Filename(path)):
+            raise IOError("Could not read heightmap {}".format(path))
+        return cls.from_image(image)
+
+    @property
+    def width(self):
+        return self.data.shape[1]
+
+    @property
+    def height(self):
+        return self.data.shape[0]
+
+    def get_height(self, x, y):
+        return float(self.data[min(max(y, 0), self.height - 1), min(max(x, 0), self.width - 1)])
+
+    def read_rect(self, rect):
+        x0, y0, x1, y1 = rect
+        return self.data[y0:y1, x0:x1]
+
+    def write_rect(self, rect, heights):
+        x0, y0, x1, y1 = rect
+        self.data[y0:y1, x0:x1] = heights
+
+    def get_stamps_rect(self, stamp, centers):
+        """
+        The rectangle apply_stamps would change, clipped to the borders, or None.
+        """
+        rect = None
+        for center_x, center_y in centers:
+            window = self.get_window(stamp, center_x, center_y)
+            if window is None:
+                continue
+            area = window[2]
+            if rect is None:
+                rect = area
+            else:
+                rect = (min(rect[0], area[0]), min(rect[1], area[1]), max(rect[2], area[2]), max(rect[3], area[3]))
+        return rect
+
+    def get_window(self, stamp, center_x, center_y):
+        """
+        Returns the heightfield and stamp slices of a stamp centered on
+        (center_x, center_y), clipped to the borders, or None if it is outside.
+        """
+        stamp_height, stamp_width = stamp.shape
+        x0 = center_x - stamp_width // 2
+        y0 = center_y - stamp_height // 2
+        x1, y1 = x0 + stamp_width, y0 + stamp_height
+        cx0, cy0 = max(0, x0), max(0, y0)
+        cx1, cy1 = min(self.width, x1), min(self.height, y1)
+        if cx0 >= cx1 or cy0 >= cy1:
+            return None
+        return ((slice(cy0, cy1), slice(cx0, cx1)),
+                (slice(cy0 - y0, cy1 - y0), slice(cx0 - x0, cx1 - x0)),
+                (cx0, cy0, cx1, cy1))
+
+    def apply_brush(self, mode, stamp, center_x, center_y, strength=1.0, target=None):
+        """
+        Applies a brush stamp (float weights in [0, 1]) centered on (center_x, center_y).
+        mode : raise, lower, smooth, flatten, noise or set_height
+        strength : scale of the height change for raise, lower and noise
+        target : height flatten and set_height move toward
+            (flatten defaults to the height under the brush center)
+        Returns the dirty rectangle, or None if the stamp is outside the heightfield.
+        """
+        window = self.get_window(stamp, center_x, center_y)
+        if window is None:
+            return None
+        area, stamp_area, rect = window
+        weights = stamp[stamp_area]
+        heights = self.data[area]
+
+        if mode == "raise":
+            heights += weights * strength
+        elif mode == "lower":
+            heights -= weights * strength
+        elif mode == "smooth":
+            heights += weights * (self.blur(rect) - heights)
+        elif mode == "flatten":
+            if target is None:
+                target = self.get_height(center_x, center_y)
+            heights += weights * (target - heights)
+        elif mode == "noise":
+            heights += weights * strength * self.rng.uniform(-1.0, 1.0, heights.shape).astype(np.float32)
+        elif mode == "set_height":
+            heights += weights * ((1.0 if target is None else target) - heights)
+        else:
+            raise ValueError("Unknown brush mode {}".format(mode))
+        np.clip(heights, 0.0, 1.0, out=heights)
+        return rect
+
+    def apply_stamps(self, mode, stamp, centers, strength=1.0, target=None):
+        """
+        Applies the same stamp at each of centers in turn, as one batch.
+        Returns the rectangle covering all the changes, or None.
+        """
+        area = None
+        for center_x, center_y in centers:
+            rect = self.apply_brush(mode, stamp, center_x, center_y, strength, target)
+            if rect is None:
+                continue
+            if area is None:
+                area = rect
+            else:
+                area = (min(area[0], rect[0]), min(area[1], rect[1]), max(area[2], rect[2]), max(area[3], rect[3]))
+        return area
+
+    def blur(self, rect):
+        """
+        3x3 box blur of the heights inside rect, reading one pixel around it.
+        """
+        x0, y0, x1, y1 = rect
+        padded = self.data[max(0, y0 - 1):y1 + 1, max(0, x0 - 1):x1 + 1]
+        # Repeat the border where the window touches the heightfield edges
+        padded = np.pad(padded, ((1 if y0 == 0 else 0, 1 if y1 == self.height else 0),
+                                 (1 if x0 == 0 else 0, 1 if x1 == self.width else 0)), mode="edge")
+        height, width = y1 - y0, x1 - x0
+        total = np.zeros((height, width), dtype=np.float32)
+        for dy in range(3):
+            for dx in range(3):
+                total += padded[dy:dy + height, dx:dx + width]
+        return total / 9.0
+
+    def to_uint16(self, rect=None):
+        data = self.data if rect is None else self.data[rect[1]:rect[3], rect[0]:rect[2]]
+        return np.round(data * 65535.0).astype(np.uint16)
+
+    def to_image(self, rect=None):
+        """
+        A 16-bit grayscale PNMImage of the heights, or of the rectangle rect.
+        """
+        heights = self.to_uint16(rect)
+        header = "P5\n{} {}\n65535\n".format(heights.shape[1], heights.shape[0]).encode()
+        image = PNMImage()
+        image.read(StringStream(header + heights.astype(">u2").tobytes()), "heightfield.pgm")
+        return image
+
+    def to_texture(self, texture=None):
+        """
+        Loads the heights into a 16-bit single channel texture (a new one if
+        none is given), the format ShaderTerrainMesh expects.
+        """
+        if texture is None:
+            texture = Texture("heightfield")
+        texture.setup_2d_texture(self.width, self.height, Texture.T_unsigned_short, Texture.F_r16)
+        # Texture rows are bottom-up
+        texture.set_ram_image(np.ascontiguousarray(self.to_uint16()[::-1]).tobytes())
+        return texture
+
+    def upload_to_texture(self, texture, rect):
+        """
+        Writes only the heights inside rect into the RAM image of a texture
+        made by to_texture; other textures are fully reloaded.
+        """
+        if (texture.get_x_size() != self.width or texture.get_y_size() != self.height
+                or texture.get_format() != Texture.F_r16 or not texture.has_ram_image()):
+            self.to_texture(texture)
+            return
+        x0, y0, x1, y1 = rect
+        ram = np.frombuffer(memoryview(texture.modify_ram_image()), dtype=np.uint16)
+        ram = ram.reshape(self.height, self.width)
+        # Texture rows are bottom-up: heightfield rows y0..y1 are texture rows height-y1..height-y0
+        ram[self.height - y1:self.height - y0, x0:x1] = self.to_uint16(rect)[::-1]
+
+    def get_cell_bounds(self, cell_size):
+        """
+        Min and max height of each cell_size x cell_size cell, as two arrays.
+        """
+        rows = -(-self.height // cell_size)
+        columns = -(-self.width // cell_size)
+        padded = np.pad(self.data, ((0, rows * cell_size - self.height), (0, columns * cell_size - self.width)),
+                        mode="edge")
+        cells = padded.reshape(rows, cell_size, columns, cell_size)
+        return cells.min(axis=(1, 3)), cells.max(axis=(1, 3))
+
+
+class HeightPyramid:
+    """
+    Min/max mip pyramid of a Heightfield, for ray casts against the heights.
+    Level 0 cell (x, y) holds the min and max of the sample quad x..x+1,
+    y..y+1; each level above holds the min and max of 2x2 cells of the one
+    below, up to a single cell. A ray skips every cell whose box it misses
+    and only tests the triangles of the level 0 cells it reaches.
+
+    Ray coordinates are in samples: (x, y, height) with height in [0, 1].
+    """
+
+    def __init__(self, heightfield):
+        self.heightfield = heightfield
+        self.mins = []
+        self.maxs = []
+        self.update()
+
+    def update(self, rect=None):
+        """
+        Recomputes the cells covering the samples of rect (x0, y0, x1, y1),
+        or the whole pyramid.
+        """
+        data = self.heightfield.data
+        height, width = data.shape
+        cells_x, cells_y = max(1, width - 1), max(1, height - 1)
+        if rect is None or not self.mins or self.mins[0].shape != (cells_y, cells_x):
+            self.mins, self.maxs = [], []
+            shape = (cells_y, cells_x)
+            while True:
+                self.mins.append(np.empty(shape, dtype=np.float32))
+                self.maxs.append(np.empty(shape, dtype=np.float32))
+                if shape == (1, 1):
+                    break
+                shape = (-(-shape[0] // 2), -(-shape[1] // 2))
+            x0, y0, x1, y1 = 0, 0, cells_x, cells_y
+        else:
+            # A sample belongs to the cells on both of its sides
+            x0, y0 = max(0, rect[0] - 1), max(0, rect[1] - 1)
+            x1, y1 = min(cells_x, rect[2]), min(cells_y, rect[3])
+            if x0 >= x1 or y0 >= y1:
+                return
+
+        rows = np.arange(y0, y1)
+        columns = np.arange(x0, x1)
+        corners = [data[np.ix_(np.minimum(rows + dy, height - 1), np.minimum(columns + dx, width - 1))]
+                   for dy in (0, 1) for dx in (0, 1)]
+        self.mins[0][y0:y1, x0:x1] = np.minimum.reduce(corners)
+        self.maxs[0][y0:y1, x0:x1] = np.maximum.reduce(corners)
+
+        for level in range(1, len(self.mins)):
+            child_rows, child_columns = self.mins[level - 1].shape
+            x0, y0, x1, y1 = x0 // 2, y0 // 2, -(-x1 // 2), -(-y1 // 2)
+            rows = np.arange(y0, y1) * 2
+            columns = np.arange(x0, x1) * 2
+            children = [np.ix_(np.minimum(rows + dy, child_rows - 1), np.minimum(columns + dx, child_columns - 1))
+                        for dy in (0, 1) for dx in (0, 1)]
+            self.mins[level][y0:y1, x0:x1] = np.minimum.reduce([self.mins[level - 1][child] for child in children])
+            self.maxs[level][y0:y1, x0:x1] = np.maximum.reduce([self.maxs[level - 1][child] for child in children])
+
+    @staticmethod
+    def intersect_box(origin, direction, low, high, max_t):
+        """
+        Entry distance of the ray into the box low..high, or None.
+        """
+        t_near, t_far = 0.0, max_t
+        for axis in range(3):
+            if direction[axis] == 0.0:
+                if origin[axis] < low[axis] or origin[axis] > high[axis]:
+                    return None
+                continue
+            t0 = (low[axis] - origin[axis]) / direction[axis]
+            t1 = (high[axis] - origin[axis]) / direction[axis]
+            if t0 > t1:
+                t0, t1 = t1, t0
+            t_near, t_far = max(t_near, t0), min(t_far, t1)
+            if t_near > t_far:
+                return None
+        return t_near
+
+    @staticmethod
+    def intersect_triangle(origin, direction, a, b, c):
+        """
+        Möller–Trumbore ray/triangle test, returns the distance or None.
+        """
+        e1 = (b[0] - a[0], b[1] - a[1], b[2] - a[2])
+        e2 = (c[0] - a[0], c[1] - a[1], c[2] - a[2])
+        p = (direction[1] * e2[2] - direction[2] * e2[1],
+             direction[2] * e2[0] - direction[0] * e2[2],
+             direction[0] * e2[1] - direction[1] * e2[0])
+        det = e1[0] * p[0] + e1[1] * p[1] + e1[2] * p[2]
+        if abs(det) < 1e-12:
+            return None
+        s = (origin[0] - a[0], origin[1] - a[1], origin[2] - a[2])
+        u = (s[0] * p[0] + s[1] * p[1] + s[2] * p[2]) / det
+        if u < 0.0 or u > 1.0:
+            return None
+        q = (s[1] * e1[2] - s[2] * e1[1], s[2] * e1[0] - s[0] * e1[2], s[0] * e1[1] - s[1] * e1[0])
+        v = (direction[0] * q[0] + direction[1] * q[1] + direction[2] * q[2]) / det
+        if v < 0.0 or u + v > 1.0:
+            return None
+        t = (e2[0] * q[0] + e2[1] * q[1] + e2[2] * q[2]) / det
+        return t if t >= 0.0 else None
+
+    def intersect_cell(self, origin, direction, x, y):
+        data = self.heightfield.data
+        x1, y1 = min(x + 1, data.shape[1] - 1), min(y + 1, data.shape[0] - 1)
+        p00 = (x, y, float(data[y, x]))
+        p10 = (x + 1, y, float(data[y, x1]))
+        p01 = (x, y + 1, float(data[y1, x]))
+        p11 = (x + 1, y + 1, float(data[y1, x1]))
+        hits = [t for t in (self.intersect_triangle(origin, direction, p00, p10, p11),
+                            self.intersect_triangle(origin, direction, p00, p11, p01)) if t is not None]
+        return min(hits) if hits else None
+
+    def intersect(self, origin, direction, max_t=float("inf")):
+        """
+        Distance along direction (in units of direction) of the first hit of
+        the ray with the heights, or None.
+        """
+        origin = tuple(float(v) for v in origin)
+        direction = tuple(float(v) for v in direction)
+        top = len(self.mins) - 1
+        # Cells are visited front to back, so the first triangle hit is the nearest
+        stack = [(top, 0, 0)]
+        while stack:
+            level, cell_x, cell_y = stack.pop()
+            if level == 0:
+                t = self.intersect_cell(origin, direction, cell_x, cell_y)
+                if t is not None and t <= max_t:
+                    return t
+                continue
+            children = []
+            child_level = level - 1
+            child_rows, child_columns = self.mins[child_level].shape
+            size = 1 << child_level
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    child_x, child_y = cell_x * 2 + dx, cell_y * 2 + dy
+                    if child_x >= child_columns or child_y >= child_rows:
+                        continue
+                    low = (child_x * size, child_y * size, float(self.mins[child_level][child_y, child_x]))
+                    high = ((child_x + 1) * size, (child_y + 1) * size, float(self.maxs[child_level][child_y, child_x]))
+                    t = self.intersect_box(origin, direction, low, high, max_t)
+                    if t is not None:
+                        children.append((t, child_level, child_x, child_y))
+            children.sort(reverse=True)
+            stack.extend(child[1:] for child in children)
+        return None
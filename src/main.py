@@ -17,6 +17,7 @@ import node
 from shader_editor import ShaderEditor
 from file_explorer import FileExplorer
 import terrainEditor
+from paged_terrain import PagedTerrain, TileFile
 import importlib
 import os
 import entity_editor
@@ -32,6 +33,8 @@ from input_manager import NetworkManager, InputManager
 import uuid
 import sequence_editor as sequenceEditorTab
 import raycasting
+import selection
+from scene_hierarchy import SceneGraphModel
 import Preview_build
 from terrain_control_widget import TerrainControlWidget
 import gizmos
@@ -39,6 +42,8 @@ import gizmos
 class PandaTest(Panda3DWorld):
     def __init__(self, width=1024, height=768, script_inspector=None):
         Panda3DWorld.__init__(self, width=width, height=height)
+        # Render below full resolution while the camera moves or a drag is running
+        self.enable_dynamic_resolution()
         
         self.setupRender2d()
         global network_manager
@@ -94,6 +99,10 @@ class PandaTest(Panda3DWorld):
         self.grid.setLightOff()  # THE GRID SHOULD NOT BE LIT
         
         self.selected_node = None
+        # Multi-selection, selected_node follows its active node
+        self.selection = selection.SelectionSet(self)
+        # TerrainPainterApp of the scene's terrain, see set_terrain_painter
+        self.terrain_painter = None
 
         # Now create some lights to apply to everything in the scene.
 
@@ -132,8 +141,13 @@ class PandaTest(Panda3DWorld):
     def recreate_button(self, text, frameColor, text_fg, scale, pos, parent):
         return uiEditor_inst.button(text, scale, pos, parent, frameColor, text_fg)
     def make_hierarchy(self):
-        self.hierarchy_tree = QTreeWidget()
-        self.hierarchy_tree1 = QTreeWidget()
+        # Lazy models over the scene graph; rows are only read when expanded
+        self.hierarchy_model = SceneGraphModel(render)
+        self.hierarchy_model1 = SceneGraphModel(self.render2d)
+        self.hierarchy_tree = QTreeView()
+        self.hierarchy_tree.setModel(self.hierarchy_model)
+        self.hierarchy_tree1 = QTreeView()
+        self.hierarchy_tree1.setModel(self.hierarchy_model1)
         
     
     def make_ray_caster(self):
@@ -144,6 +158,7 @@ class PandaTest(Panda3DWorld):
         nodepath.set_python_tag("script_paths", [])
         nodepath.set_python_tag("script_properties", [])
         nodepath.set_python_tag("id", str(uuid.uuid4())[:8])
+        raycasting.get_pick_service(self).add_pickable(nodepath)
 
     def jump(self):
         self.jump_seq.start()
@@ -152,35 +167,38 @@ class PandaTest(Panda3DWorld):
         self.roll_seq.start()
         
     def refresh(self):
-        self.hierarchy_tree.clear()
-        self.populate_hierarchy(self.hierarchy_tree, render)
-        self.hierarchy_tree1.clear()
-        self.populate_hierarchy(self.hierarchy_tree1, self.render2d)
+        self.hierarchy_model.sync()
+        self.hierarchy_model1.sync()
+        raycasting.get_pick_service(self).invalidate_pickables()
 
     def add_model(self, model):
-
-
-        self.hierarchy_tree.clear()
-        self.populate_hierarchy(self.hierarchy_tree, render)
-        self.hierarchy_tree1.clear()
-        self.populate_hierarchy(self.hierarchy_tree1, self.render2d)
+        self.hierarchy_model.node_added(model)
         world.selected_node = model
         self.assign_id(model)
 
     def make_terrain(self):
+        self.set_terrain_painter(terrainEditor.TerrainPainterApp(world, pandaWidget))
 
+        world.selected_node = self.terrain_painter.terrain_node
 
-        self.hierarchy_tree.clear()
-        self.hierarchy_tree1.clear()
-
-        self.terrain_generate = terrainEditor.TerrainPainterApp(world, pandaWidget)
-
-        world.selected_node = self.terrain_generate.terrain_node
-        
-        self.populate_hierarchy(self.hierarchy_tree, render)
-        self.populate_hierarchy(self.hierarchy_tree1, self.render2d)
+    def make_paged_terrain(self, tile_file, **options):
+        """
+        Replaces the terrain by one streamed from tile_file (a TileFile), for
+        terrains too large to keep in memory. options go to PagedTerrain.
+        """
+        paged_terrain = PagedTerrain(self, tile_file, **options)
+        return self.set_terrain_painter(terrainEditor.TerrainPainterApp(self, pandaWidget, paged_terrain=paged_terrain))
 
-        selected_node = self.terrain_generate.terrain_node
+    def set_terrain_painter(self, painter):
+        """
+        Makes painter the scene's terrain, closing the one it replaces.
+        """
+        if self.terrain_painter is not None and self.terrain_painter is not painter:
+            self.terrain_painter.close()
+        self.terrain_painter = painter
+        self.messenger.send("terrain-painter-changed", [painter])
+        self.refresh()
+        return painter
     #def ui_editor_script_to_canvas(self):
     #    inspector.set_script(os.path.relpath("D:/000PANDA3d-EDITOR/PANDA3D-EDITOR/ui_editor_properties.py"), self.canvas, inspector.prop)
     def reset_render(self):
@@ -207,24 +225,11 @@ class PandaTest(Panda3DWorld):
         self.win.setClearColor(VBase4(0, 0, 0, 1))
         self.cam.node().getDisplayRegion(0).setSort(20)
 
-        self.hierarchy_tree.clear()
-        self.hierarchy_tree1.clear()
-        
-        self.populate_hierarchy(self.hierarchy_tree, self.render)
-        self.populate_hierarchy(self.hierarchy_tree1, self.render2d)
+        self.hierarchy_model.set_root(self.render)
+        self.hierarchy_model1.sync()
     #TODO make each object from toml load up with a function that runs on load
 
 
-    def populate_hierarchy(self, hierarchy_widget, node, parent_item=None):
-
-        # Create a new item for the current node
-        item = QTreeWidgetItem(parent_item or hierarchy_widget, [node.getName()])
-        item.setData(0, Qt.UserRole, node)  # Store the NodePath in the item data
-        # Recursively add child nodes
-        for child in node.getChildren():
-            self.populate_hierarchy(hierarchy_widget, child, item)
-
-
 
 class properties:
     def __init__():
@@ -254,6 +259,7 @@ class properties:
             scale = list(world.selected_node.getScale())
             scale[coord[1]] = value
             world.selected_node.setScale(*scale)
+        raycasting.get_pick_service(world).node_moved(world.selected_node)
 class properties_ui_editor:
     def __init__():
         pass
@@ -282,13 +288,14 @@ class properties_ui_editor:
             scale = list(world.selected_node.getScale())
             scale[coord[1]] = value
             world.selected_node.setScale(*scale)
+        uiEditor_inst.widget_index.mark_dirty(world.selected_node)
 
-def on_item_clicked(item, column):
+def on_item_clicked(index):
     #global selected_node
-    node = item.data(0, Qt.UserRole)  # Retrieve the NodePath stored in the item
+    node = index.data(Qt.UserRole)  # Retrieve the NodePath stored in the row
 
     if node:
-        world.selected_node = node
+        world.selection.set([node])
         # Update input boxes with node's properties
         input_boxes[(0, 0)].setText(str(node.getX()))
         input_boxes[(0, 1)].setText(str(node.getY()))
@@ -306,21 +313,13 @@ def on_item_clicked(item, column):
             if widget:
                 widget.setParent(None)
                 
-<<<<<<< Updated upstream
         if node.get_python_tag("isTerrain"):
             control_widget.show()
         else:
             control_widget.hide()
-                
-        
-=======
-        if node.get_python_tag("isTerrain") == True:
-            control_widget.show()
-        else:
-            control_widget.hide()
->>>>>>> Stashed changes
         
         world.gizmos.gizmo_root.set_pos(node.get_pos())
+        raycasting.get_pick_service(world).node_moved(world.gizmos.gizmo_root)
 
         
         inspector.recreate_property_box_for_node(node)
@@ -335,9 +334,9 @@ def on_item_clicked(item, column):
         #    inspector.scripts = {}  # Initialize script storage for the node
     else:
         print("No node selected.")
-def on_item_clicked1(item, column):
+def on_item_clicked1(index):
     #global selected_node
-    node = item.data(0, Qt.UserRole)  # Retrieve the NodePath stored in the item
+    node = index.data(Qt.UserRole)  # Retrieve the NodePath stored in the row
 
     if node:
         world.selected_node = node
@@ -360,6 +359,7 @@ def on_item_clicked1(item, column):
                 
         
         world.gizmos.gizmo_root.set_pos(node.get_pos())
+        raycasting.get_pick_service(world).node_moved(world.gizmos.gizmo_root)
         
         uiEditor_inst.inspector_ui_tab.recreate_property_box_for_node(node)
 
@@ -379,22 +379,16 @@ def on_item_clicked1(item, column):
 def new_tab(index):
     if index == 1:
         shader_editor.show_nodes()
-        pandaWidget.resizeEvent(pandaWidget)
-        pandaWidget1.resizeEvent(pandaWidget1)
         world.cam.setPos(0, -55, 30)
         world.cam.lookAt(0, 0, 0)
     elif index == 2:
         shader_editor.hide_nodes()
-        panda_widget_2.resizeEvent(panda_widget_2)
         world.cam.setPos(0, -55, 30)
         world.cam.lookAt(0, 0, 0)
 
     elif index == 3:
         print("!")
         shader_editor.show_nodes()
-        pandaWidget.resizeEvent(pandaWidget)
-        pandaWidget1.resizeEvent(pandaWidget1)
-        panda_widget_2.resizeEvent(panda_widget_2)
         world.cam.setPos(0,-3, 255)
         world.cam.lookAt(world.canvas)
 class Node:
@@ -826,6 +820,28 @@ def gen_terrain():
     world.make_terrain()
 
 
+def new_paged_terrain():
+    path, _ = QFileDialog.getSaveFileName(appw, "New Paged Terrain", "", "Terrain tiles (*.tiles)")
+    if not path:
+        return
+    size, ok = QInputDialog.getInt(appw, "New Paged Terrain", "Samples per side:", 4097, 257, 65537)
+    if not ok:
+        return
+    world.make_paged_terrain(TileFile.create(path, size, size))
+
+
+def open_paged_terrain():
+    path, _ = QFileDialog.getOpenFileName(appw, "Open Paged Terrain", "", "Terrain tiles (*.tiles)")
+    if not path:
+        return
+    try:
+        tile_file = TileFile(path)
+    except (OSError, ValueError) as e:
+        QMessageBox.warning(appw, "Open Paged Terrain", str(e))
+        return
+    world.make_paged_terrain(tile_file)
+
+
 #-------------------
 
 sw = None
@@ -869,13 +885,12 @@ def save_map(map_name):
 
 def delete_selection():
     global world
-    selected_items = world.hierarchy_tree.selectedItems()
-    if not selected_items:
+    selected_indexes = world.hierarchy_tree.selectionModel().selectedIndexes()
+    if not selected_indexes:
         print("No item selected.")
         return
 
-    item = selected_items[0]
-    node = item.data(0, Qt.UserRole)
+    node = selected_indexes[0].data(Qt.UserRole)
     
     if not node:
         print("Selected item has no associated node.")
@@ -890,11 +905,13 @@ def delete_selection():
     node_name = node.getName()
 
     # Proceed with deletion if not the main render
+    world.selection.remove([node])
+    world.hierarchy_model.node_about_to_be_removed(node)
+    raycasting.get_pick_service(world).node_removed(node)
     node.removeNode()
     world.selected_node = None
     del node
     
-    world.refresh()
     print(f"Node '{node_name}' deleted successfully.")
 
 
@@ -981,6 +998,14 @@ if __name__ == "__main__":
     action = QAction("Generate Terrain", appw)
     action.triggered.connect(gen_terrain)
     terrain_3d.addAction(action)
+
+    action = QAction("New Paged Terrain...", appw)
+    action.triggered.connect(new_paged_terrain)
+    terrain_3d.addAction(action)
+
+    action = QAction("Open Paged Terrain...", appw)
+    action.triggered.connect(open_paged_terrain)
+    terrain_3d.addAction(action)
     #--------------------------
 
     # Create a tool button for the menu
@@ -1055,6 +1080,10 @@ if __name__ == "__main__":
     # 3D Viewport
     pandaWidget = QPanda3DWidget(world)
     viewport_inner_splitter.addWidget(pandaWidget)
+    # Shift-drag selects the entities inside a rectangle
+    world.marquee_select = selection.MarqueeSelect(world, pandaWidget, world.selection)
+    # Tints the entity under the mouse
+    world.hover_highlight = selection.HoverHighlight(world)
  
     
     # Drag-and-Drop File System
@@ -1068,14 +1097,16 @@ if __name__ == "__main__":
     
     #world.make_hierarchy()
     
-    world.hierarchy_tree.setHeaderLabel("Scene Hierarchy")
+    world.hierarchy_model.set_header_label("Scene Hierarchy")
     world.hierarchy_tree.setDragEnabled(True)
     world.hierarchy_tree.setAcceptDrops(True)
     
     right_panel.layout().addWidget(world.hierarchy_tree)
-    terrain_painter_app = terrainEditor.TerrainPainterApp(world, pandaWidget)
+    terrain_painter_app = world.set_terrain_painter(terrainEditor.TerrainPainterApp(world, pandaWidget))
     terrain_painter_app.terrain_np.set_python_tag("isTerrain", True)
     control_widget = TerrainControlWidget(terrain_painter_app)
+    # Terrains created or opened from the menu replace this one
+    world.accept("terrain-painter-changed", control_widget.set_painter)
     right_panel.layout().addWidget(control_widget)
     # Create a QWidget to hold the grid layout
     grid_widget = QWidget()
@@ -1141,12 +1172,8 @@ if __name__ == "__main__":
     # Set the main widget as the central widget
     appw.setCentralWidget(main_widget)
 
-    # Populate the hierarchy tree with actual scene data
-    world.populate_hierarchy(world.hierarchy_tree, render)  # This will populate the hierarchy panel
-    world.populate_hierarchy(world.hierarchy_tree1, world.render2d)  # This will populate the hierarchy panel
-
-    world.hierarchy_tree.itemClicked.connect(lambda item, column: on_item_clicked(item, column))
-    world.hierarchy_tree1.itemClicked.connect(lambda item, column: on_item_clicked1(item, column))
+    world.hierarchy_tree.clicked.connect(on_item_clicked)
+    world.hierarchy_tree1.clicked.connect(on_item_clicked1)
     
     #world.ui_editor_script_to_canvas()
     
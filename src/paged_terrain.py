@@ -0,0 +1,472 @@
+import math
+import queue
+import struct
+import threading
+
+import numpy as np
+from panda3d.core import NodePath, Point3, ShaderTerrainMesh, Texture
+from panda3d.bullet import BulletWorld, BulletRigidBodyNode, BulletHeightfieldShape, ZUp
+
+from heightfield import Heightfield, HeightPyramid
+from raycasting import get_pick_service
+
+
+class TileFile:
+    """
+    A heightfield stored on disk as fixed-size square tiles and memory-mapped.
+
+    Layout: a 64 byte header (magic, width, height, tile size, sample type),
+    then the tiles row by row, each tile_size x tile_size samples with its
+    rows top to bottom. Tiles on the right/bottom edges are padded.
+    uint16 samples are heights * 65535, float32 samples are heights in [0, 1].
+    """
+
+    magic = b"P3DTILES"
+    header_format = "<8sIIII"
+    header_size = 64
+    sample_types = {1: np.uint16, 2: np.float32}
+
+    def __init__(self, path, mode="r+"):
+        with open(path, "rb") as file:
+            header = file.read(self.header_size)
+        magic, self.width, self.height, self.tile_size, sample_type = struct.unpack_from(self.header_format, header)
+        if magic != self.magic:
+            raise ValueError("{} is not a terrain tile file".format(path))
+        self.path = path
+        self.dtype = np.dtype(self.sample_types[sample_type])
+        self.tiles_x = -(-self.width // self.tile_size)
+        self.tiles_y = -(-self.height // self.tile_size)
+        self.tiles = np.memmap(path, dtype=self.dtype, mode=mode, offset=self.header_size,
+                               shape=(self.tiles_y, self.tiles_x, self.tile_size, self.tile_size))
+
+    @classmethod
+    def create(cls, path, width, height, tile_size=256, dtype=np.uint16):
+        """
+        Creates a flat (zero) tile file; the file is sparse where the OS allows it.
+        """
+        dtype = np.dtype(dtype)
+        sample_type = {np.dtype(t): code for code, t in cls.sample_types.items()}[dtype]
+        tiles = -(-width // tile_size) * -(-height // tile_size)
+        with open(path, "wb") as file:
+            file.write(struct.pack(cls.header_format, cls.magic, width, height, tile_size, sample_type)
+                       .ljust(cls.header_size, b"\0"))
+            file.truncate(cls.header_size + tiles * tile_size * tile_size * dtype.itemsize)
+        return cls(path)
+
+    @classmethod
+    def from_heightfield(cls, path, heightfield, tile_size=256, dtype=np.uint16):
+        tile_file = cls.create(path, heightfield.width, heightfield.height, tile_size, dtype)
+        tile_file.write_rect((0, 0, heightfield.width, heightfield.height), heightfield.data)
+        tile_file.flush()
+        return tile_file
+
+    def to_heights(self, samples):
+        if self.dtype == np.uint16:
+            return samples.astype(np.float32) / 65535.0
+        return samples.astype(np.float32)
+
+    def to_samples(self, heights):
+        if self.dtype == np.uint16:
+            return np.round(np.clip(heights, 0.0, 1.0) * 65535.0).astype(np.uint16)
+        return heights.astype(np.float32)
+
+    def iter_tiles(self, rect):
+        """
+        Yields (tile_x, tile_y, tile slices, rect slices) of the tiles overlapping rect.
+        """
+        x0, y0, x1, y1 = rect
+        size = self.tile_size
+        for tile_y in range(y0 // size, (y1 - 1) // size + 1):
+            for tile_x in range(x0 // size, (x1 - 1) // size + 1):
+                tx0, ty0 = max(x0, tile_x * size), max(y0, tile_y * size)
+                tx1, ty1 = min(x1, (tile_x + 1) * size), min(y1, (tile_y + 1) * size)
+                yield (tile_x, tile_y,
+                       (slice(ty0 - tile_y * size, ty1 - tile_y * size), slice(tx0 - tile_x * size, tx1 - tile_x * size)),
+                       (slice(ty0 - y0, ty1 - y0), slice(tx0 - x0, tx1 - x0)))
+
+    def read_rect(self, rect):
+        """
+        Heights (float32) of the rectangle (x0, y0, x1, y1), end exclusive.
+        """
+        x0, y0, x1, y1 = rect
+        heights = np.empty((y1 - y0, x1 - x0), dtype=np.float32)
+        for tile_x, tile_y, tile_area, area in self.iter_tiles(rect):
+            heights[area] = self.to_heights(self.tiles[tile_y, tile_x][tile_area])
+        return heights
+
+    def write_rect(self, rect, heights):
+        """
+        Writes heights into the mapped tiles, in place.
+        """
+        for tile_x, tile_y, tile_area, area in self.iter_tiles(rect):
+            self.tiles[tile_y, tile_x][tile_area] = self.to_samples(heights[area])
+
+    def flush(self):
+        self.tiles.flush()
+
+
+class TerrainChunk:
+    """
+    A resident part of a PagedTerrain: its mesh, heights, texture and collider.
+    """
+
+    def __init__(self, key, node_path, heightfield, texture, collider_np):
+        self.key = key
+        self.node_path = node_path
+        self.heightfield = heightfield
+        self.texture = texture
+        self.collider_np = collider_np
+        # Min/max pyramid of the chunk's samples, built on the first ray cast
+        self.pyramid = None
+
+
+class PagedTerrain:
+    """
+    Terrain streamed from a TileFile: only the chunks within load_radius of
+    the camera are resident as ShaderTerrainMesh nodes and Bullet heightfields.
+    Chunk data is read and converted on a background thread; the scene graph
+    is only touched from the paging task, a few chunks per frame.
+
+    Chunks are chunk_size samples wide (a power of two, as ShaderTerrainMesh
+    requires) and neighbours share their edge samples; chunks on the far
+    edges are padded with their last samples.
+
+    Sample (x, y) of the file is at world (origin.x + x * spacing,
+    origin.y + (height - 1 - y) * spacing), heights 0..1 map to
+    origin.z..origin.z + height_scale.
+    """
+
+    def __init__(self, world, tile_file, spacing=1.0, height_scale=100.0, origin=None,
+                 chunk_size=256, load_radius=2, collide_mask=None):
+        self.world = world
+        self.tile_file = tile_file
+        self.width = tile_file.width
+        self.height = tile_file.height
+        self.spacing = spacing
+        self.height_scale = height_scale
+        if origin is None:
+            origin = Point3(-(self.width - 1) * spacing / 2.0, -(self.height - 1) * spacing / 2.0, 0)
+        self.origin = origin
+        self.chunk_size = chunk_size
+        self.chunk_stride = chunk_size - 1
+        self.chunks_x = max(1, -(-(self.width - 1) // self.chunk_stride))
+        self.chunks_y = max(1, -(-(self.height - 1) // self.chunk_stride))
+        self.load_radius = load_radius
+        self.pick_service = get_pick_service(world)
+        if collide_mask is None:
+            # The chunk colliders are picked as the terrain
+            collide_mask = self.pick_service.register_category("terrain")
+        self.collide_mask = collide_mask
+        self.target_triangle_width = 10.0
+        # Chunks attached per frame, to spread the generate() cost
+        self.max_attach_per_frame = 2
+
+        self.root = world.render.attach_new_node("PagedTerrain")
+        self.bullet_world = BulletWorld()
+        self.bullet_world.setGravity((0, 0, -9.81))
+
+        self.chunks = {}
+        self.pending = set()
+        # Edit count of each chunk, loads started before an edit are thrown away
+        self.versions = {}
+        self.dirty_chunks = set()
+        self.stroke_chunks = set()
+
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self.worker, name="PagedTerrain", daemon=True)
+        self.thread.start()
+        self.paging = world.taskMgr.add(self.paging_task, "paged-terrain-paging", sort=45)
+
+    # Coordinates
+
+    def get_chunk_rect(self, key):
+        """
+        File samples (x0, y0, x1, y1), end exclusive, covered by a chunk.
+        """
+        chunk_x, chunk_y = key
+        x0 = chunk_x * self.chunk_stride
+        y0 = chunk_y * self.chunk_stride
+        return x0, y0, min(x0 + self.chunk_size, self.width), min(y0 + self.chunk_size, self.height)
+
+    def get_chunks_in_rect(self, rect):
+        x0, y0, x1, y1 = rect
+        stride = self.chunk_stride
+        # A sample on a chunk edge belongs to both chunks
+        for chunk_y in range(max(0, (y0 - 1) // stride), min(self.chunks_y, (y1 - 1) // stride + 1)):
+            for chunk_x in range(max(0, (x0 - 1) // stride), min(self.chunks_x, (x1 - 1) // stride + 1)):
+                yield chunk_x, chunk_y
+
+    def world_to_sample(self, pos):
+        """
+        File sample (x, y) under a world position, may be out of bounds.
+        """
+        return (int((pos.x - self.origin.x) / self.spacing),
+                int(self.height - 1 - (pos.y - self.origin.y) / self.spacing))
+
+    def get_camera_chunk(self):
+        x, y = self.world_to_sample(self.world.cam.get_pos(self.world.render))
+        return (min(max(x // self.chunk_stride, 0), self.chunks_x - 1),
+                min(max(y // self.chunk_stride, 0), self.chunks_y - 1))
+
+    # Paging
+
+    def paging_task(self, task):
+        center_x, center_y = self.get_camera_chunk()
+        radius = self.load_radius
+        for chunk_y in range(max(0, center_y - radius), min(self.chunks_y, center_y + radius + 1)):
+            for chunk_x in range(max(0, center_x - radius), min(self.chunks_x, center_x + radius + 1)):
+                self.request_chunk((chunk_x, chunk_y))
+
+        # Unload one ring further out than the load radius, so the camera
+        # moving back and forth over a chunk border doesn't thrash
+        for key in list(self.chunks):
+            if max(abs(key[0] - center_x), abs(key[1] - center_y)) > radius + 1:
+                self.unload_chunk(key)
+
+        for _ in range(self.max_attach_per_frame):
+            try:
+                key, version, heightfield, texture, image = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending.discard(key)
+            if heightfield is None:
+                continue
+            if version != self.versions.get(key, 0):
+                # Edited while loading
+                self.request_chunk(key)
+                continue
+            if max(abs(key[0] - center_x), abs(key[1] - center_y)) <= radius + 1:
+                self.attach_chunk(key, heightfield, texture, image)
+        return task.cont
+
+    def request_chunk(self, key):
+        if key in self.chunks or key in self.pending:
+            return
+        self.pending.add(key)
+        self.requests.put(("load", key, self.versions.get(key, 0)))
+
+    def worker(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            kind, key, version = request
+            if kind == "flush":
+                self.tile_file.flush()
+                continue
+            try:
+                self.results.put((key, version) + self.load_chunk_data(key))
+            except Exception as e:
+                print(f"Failed to load terrain chunk {key}: {e}")
+                self.results.put((key, version, None, None, None))
+
+    def load_chunk_data(self, key):
+        """
+        Reads a chunk from the tile file (background thread): its padded
+        heights, heightfield texture and collision image.
+        """
+        x0, y0, x1, y1 = self.get_chunk_rect(key)
+        heights = self.tile_file.read_rect((x0, y0, x1, y1))
+        padded = np.pad(heights, ((0, self.chunk_size - (y1 - y0)), (0, self.chunk_size - (x1 - x0))), mode="edge")
+        heightfield = Heightfield(self.chunk_size, self.chunk_size, padded)
+        texture = heightfield.to_texture(Texture("paged-terrain-{}-{}".format(*key)))
+        image = Heightfield(x1 - x0, y1 - y0, heights).to_image()
+        return heightfield, texture, image
+
+    def attach_chunk(self, key, heightfield, texture, image):
+        x0, y0, x1, y1 = self.get_chunk_rect(key)
+        mesh = ShaderTerrainMesh()
+        mesh.heightfield = texture
+        mesh.target_triangle_width = self.target_triangle_width
+        mesh.generate()
+        node_path = self.root.attach_new_node(mesh)
+        # The texture's bottom row is the chunk's last sample row
+        size = self.chunk_stride * self.spacing
+        node_path.set_pos(self.origin.x + x0 * self.spacing,
+                          self.origin.y + (self.height - y0 - self.chunk_size) * self.spacing,
+                          self.origin.z)
+        node_path.set_scale(size, size, self.height_scale)
+        self.chunks[key] = TerrainChunk(key, node_path, heightfield, texture, None)
+        self.build_collider(key, image)
+
+    def build_collider(self, key, image=None):
+        """
+        (Re)builds the Bullet heightfield of a resident chunk, attaching the new
+        body before removing the old one so rays always hit one of them.
+        """
+        chunk = self.chunks[key]
+        x0, y0, x1, y1 = self.get_chunk_rect(key)
+        if image is None:
+            image = Heightfield(x1 - x0, y1 - y0, self.tile_file.read_rect((x0, y0, x1, y1))).to_image()
+        node = BulletRigidBodyNode("PagedTerrain_{}_{}".format(*key))
+        node.addShape(BulletHeightfieldShape(image, self.height_scale, ZUp))
+        node.setMass(0)
+        node.setIntoCollideMask(self.collide_mask)
+        # Bullet centers a heightfield on its samples, with heights from 0 to height_scale
+        collider_np = self.root.attach_new_node(node)
+        collider_np.set_pos(self.origin.x + (x0 + x1 - 1) / 2.0 * self.spacing,
+                            self.origin.y + (self.height - (y0 + y1 - 1) / 2.0 - 1) * self.spacing,
+                            self.origin.z + self.height_scale / 2.0)
+        collider_np.set_scale(self.spacing, self.spacing, 1)
+        self.bullet_world.attachRigidBody(node)
+        if chunk.collider_np is not None:
+            self.bullet_world.removeRigidBody(chunk.collider_np.node())
+            self.pick_service.node_removed(chunk.collider_np)
+            chunk.collider_np.remove_node()
+        chunk.collider_np = collider_np
+
+    def unload_chunk(self, key):
+        chunk = self.chunks.pop(key)
+        chunk.node_path.remove_node()
+        if chunk.collider_np is not None:
+            self.bullet_world.removeRigidBody(chunk.collider_np.node())
+            self.pick_service.node_removed(chunk.collider_np)
+            chunk.collider_np.remove_node()
+        self.dirty_chunks.discard(key)
+        self.stroke_chunks.discard(key)
+        # Edits already are in the mapping, write them back without blocking
+        self.requests.put(("flush", key, 0))
+
+    # Editing
+
+    def apply_brush(self, mode, stamp, center_x, center_y, strength=1.0, target=None):
+        """
+        Heightfield.apply_brush on the tile file, see apply_stamps.
+        """
+        return self.apply_stamps(mode, stamp, [(center_x, center_y)], strength, target)
+
+    def apply_stamps(self, mode, stamp, centers, strength=1.0, target=None):
+        """
+        Heightfield.apply_stamps on the tile file, edited in place through the
+        mapping: the window under all the stamps is read and written back
+        once, and resident chunks get the new heights right away.
+        Returns the dirty rectangle in file samples, or None.
+        """
+        if not centers:
+            return None
+        stamp_height, stamp_width = stamp.shape
+        # The window under the stamps, plus one sample around it for smoothing
+        x0 = max(0, min(x for x, _ in centers) - stamp_width // 2 - 1)
+        y0 = max(0, min(y for _, y in centers) - stamp_height // 2 - 1)
+        x1 = min(self.width, max(x for x, _ in centers) - stamp_width // 2 + stamp_width + 1)
+        y1 = min(self.height, max(y for _, y in centers) - stamp_height // 2 + stamp_height + 1)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        window = Heightfield(x1 - x0, y1 - y0, self.tile_file.read_rect((x0, y0, x1, y1)))
+        rect = window.apply_stamps(mode, stamp, [(x - x0, y - y0) for x, y in centers], strength, target)
+        if rect is None:
+            return None
+        rect = (rect[0] + x0, rect[1] + y0, rect[2] + x0, rect[3] + y0)
+        self.tile_file.write_rect(rect, window.data[rect[1] - y0:rect[3] - y0, rect[0] - x0:rect[2] - x0])
+        self.refresh_region(rect)
+        return rect
+
+    def get_stamps_rect(self, stamp, centers):
+        """
+        The rectangle apply_stamps would change, clipped to the borders, or None.
+        """
+        stamp_height, stamp_width = stamp.shape
+        rect = None
+        for center_x, center_y in centers:
+            x0, y0 = max(0, center_x - stamp_width // 2), max(0, center_y - stamp_height // 2)
+            x1 = min(self.width, center_x - stamp_width // 2 + stamp_width)
+            y1 = min(self.height, center_y - stamp_height // 2 + stamp_height)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            if rect is None:
+                rect = (x0, y0, x1, y1)
+            else:
+                rect = (min(rect[0], x0), min(rect[1], y0), max(rect[2], x1), max(rect[3], y1))
+        return rect
+
+    def read_rect(self, rect):
+        return self.tile_file.read_rect(rect)
+
+    def write_rect(self, rect, heights):
+        self.tile_file.write_rect(rect, heights)
+        self.refresh_region(rect)
+
+    def refresh_region(self, rect):
+        """
+        Uploads the heights of rect into the resident chunks overlapping it.
+        """
+        x0, y0, x1, y1 = rect
+        for key in self.get_chunks_in_rect(rect):
+            self.versions[key] = self.versions.get(key, 0) + 1
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                continue
+            cx0, cy0, cx1, cy1 = self.get_chunk_rect(key)
+            ix0, iy0, ix1, iy1 = max(x0, cx0), max(y0, cy0), min(x1, cx1), min(y1, cy1)
+            if ix0 >= ix1 or iy0 >= iy1:
+                continue
+            local = (ix0 - cx0, iy0 - cy0, ix1 - cx0, iy1 - cy0)
+            heights = self.tile_file.read_rect((ix0, iy0, ix1, iy1))
+            chunk.heightfield.write_rect(local, heights)
+            chunk.heightfield.upload_to_texture(chunk.texture, local)
+            if chunk.pyramid is not None:
+                chunk.pyramid.heightfield.write_rect(local, heights)
+                chunk.pyramid.update(local)
+            self.dirty_chunks.add(key)
+            self.stroke_chunks.add(key)
+
+    def ray_intersect(self, origin, direction, max_t=float("inf")):
+        """
+        Distance of the first hit of a ray with the resident chunks, or None.
+        The ray is in file samples (x, y, height in [0, 1]), see HeightPyramid.
+        """
+        best = None
+        for key, chunk in self.chunks.items():
+            x0, y0, x1, y1 = self.get_chunk_rect(key)
+            limit = max_t if best is None else best
+            if HeightPyramid.intersect_box(origin, direction, (x0, y0, 0.0), (x1 - 1, y1 - 1, 1.0), limit) is None:
+                continue
+            if chunk.pyramid is None:
+                # Only the real samples, not the padding of edge chunks
+                chunk.pyramid = HeightPyramid(Heightfield(x1 - x0, y1 - y0, chunk.heightfield.data[:y1 - y0, :x1 - x0]))
+            t = chunk.pyramid.intersect((origin[0] - x0, origin[1] - y0, origin[2]), direction, limit)
+            if t is not None:
+                best = t
+        return best
+
+    def mark_dirty(self, updated_area):
+        for key in self.get_chunks_in_rect(updated_area):
+            if key in self.chunks:
+                self.dirty_chunks.add(key)
+
+    def update_colliders(self, updated_area=None):
+        """
+        Rebuilds the colliders of the dirty resident chunks.
+        """
+        if updated_area is not None:
+            self.mark_dirty(updated_area)
+        for key in sorted(self.dirty_chunks):
+            if key in self.chunks:
+                self.build_collider(key)
+        self.dirty_chunks.clear()
+
+    def finish_stroke(self):
+        """
+        Regenerates the meshes of the chunks edited by the stroke.
+        """
+        for key in self.stroke_chunks:
+            chunk = self.chunks.get(key)
+            if chunk is not None:
+                chunk.node_path.node().generate()
+        self.stroke_chunks.clear()
+
+    def get_resident_count(self):
+        return len(self.chunks)
+
+    def close(self):
+        """
+        Stops the loader thread, writes the edits back and removes the chunks.
+        """
+        self.world.taskMgr.remove(self.paging)
+        self.requests.put(None)
+        self.thread.join()
+        for key in list(self.chunks):
+            self.unload_chunk(key)
+        self.tile_file.flush()
+        self.root.remove_node()
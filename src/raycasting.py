@@ -1,43 +1,391 @@
+import numpy as np
 from panda3d.core import (
     CollisionTraverser, CollisionHandlerQueue, CollisionRay, CollisionNode,
-    BitMask32, GeomNode, Point3
+    BitMask32, GeomNode, Point2, Point3
 )
 from direct.showbase.DirectObject import DirectObject
 from QPanda3D.Panda3DWorld import Panda3DWorld
-class Picker(DirectObject):
+from spatial_index import EntityIndex
+
+
+class PickHit:
+    """
+    One hit of the mouse ray: its distance from the near plane, the point
+    hit (render space), the node path hit, its category and, for collision
+    solids, the CollisionEntry.
+    """
+    __slots__ = ("distance", "point", "node_path", "category", "entry")
+
+    def __init__(self, distance, point, node_path, category, entry=None):
+        self.distance = distance
+        self.point = point
+        self.node_path = node_path
+        self.category = category
+        self.entry = entry
+
+    def __repr__(self):
+        return f"PickHit({self.category}, {self.node_path}, {self.distance:.3f})"
+
+
+class PickService:
+    """
+    Casts the mouse ray for all the editor tools, once per frame.
+
+    Each tool registers the categories it picks (gizmo, terrain, ...) and
+    gets back the collide mask bit to put on its colliders, so the tools no
+    longer hardcode bits that clash. Categories that aren't collision solids
+    under render (the terrain heights, the 2D widgets) add a ray test instead.
+
+    pick() casts on its first call of a frame and hands the later calls, from
+    any tool, the same hits sorted by distance, filtered by category.
+    """
+
+    # Bit 0 and 1 are left to physics, the bits of GeomNode's default mask are skipped
+    first_bit = 2
+
     def __init__(self, world: Panda3DWorld):
-        self.base = world
-        
-        # Set up the collision traverser and handler.
+        self.world = world
+        # name -> collide mask, in registration order
+        self.categories = {}
+        # name -> [ray_test(mouse_pos, p_from, p_to) -> [(distance, point, node_path)]]
+        self.ray_tests = {}
+        # Category of the plain geometry (GeomNodes with the default collide mask)
+        self.geometry_category = None
+        self.next_bit = self.first_bit
+
         self.traverser = CollisionTraverser()
-        self.traverser.showCollisions(base.render)  # Visualize collisions for debugging.
         self.handler = CollisionHandlerQueue()
-        
-        # Create a collision node for the picker ray.
         self.picker_ray = CollisionRay()
         self.picker_node = CollisionNode('mouse_ray')
-        # Disable its into mask so it doesn't register collisions with itself.
-        self.picker_node.set_from_collide_mask(BitMask32.bit(10))
-        self.picker_node.set_into_collide_mask(BitMask32.bit(10))
-        pickerNP = base.camera.attachNewNode(self.picker_node)
-        
-        self.traverser.addCollider(pickerNP, self.handler)
-        # Attach the picker node to the camera.
-        #self.picker_node.set_from_collide_mask(combined_mask)
-        
-        self.picker_node.addSolid(self.picker_ray)
-        # Define collision masks for different categories.
-        self.gizmo_mask  = BitMask32.bit(10)
-        self.terrain_mask = BitMask32.bit(2)
-        self.object_mask = BitMask32.bit(3)
-        self.ui_mask = BitMask32.bit(4)
-        combined_mask = self.gizmo_mask | self.terrain_mask | self.object_mask | self.ui_mask
-        
-        # Set the from collide mask on the picker.
-        
-        # Create and add the collision ray.
+        self.picker_node.add_solid(self.picker_ray)
+        # Nothing picks the ray itself
+        self.picker_node.set_into_collide_mask(BitMask32.all_off())
+        self.picker_node.set_from_collide_mask(BitMask32.all_off())
+        self.picker_np = world.cam.attach_new_node(self.picker_node)
+        self.traverser.add_collider(self.picker_np, self.handler)
+
+        # Bounding volume hierarchy of the pickable nodes: a cast only runs
+        # the collision tests on the nodes whose bounds the ray crosses.
+        self.pickables = EntityIndex(world.render)
+        self.pickables_scanned = False
+        # Moves reported with node_moved are applied once per frame, before the tools pick
+        self.sync_task = world.taskMgr.add(self.sync_task_step, "pick-index-sync", sort=-10)
+        self.synced = 0
+
+        # Hits of the last full cast and the (frame, mouse) they were cast for
+        self.cache_key = None
+        self.cache = []
+        self.casts = 0
+
+    def register_category(self, name, ray_test=None, geometry=False):
+        """
+        Returns the collide mask of category name, allocating a bit the first
+        time. ray_test is added to the category's ray tests; with geometry,
+        visible geometry without collision solids is picked as this category.
+        """
+        mask = self.categories.get(name)
+        if mask is None:
+            while GeomNode.get_default_collide_mask().get_bit(self.next_bit):
+                self.next_bit += 1
+            if self.next_bit >= BitMask32.get_max_num_bits():
+                raise ValueError(f"No collide mask bit left for pick category {name}")
+            mask = BitMask32.bit(self.next_bit)
+            self.next_bit += 1
+            self.categories[name] = mask
+            # Nodes already in the scene may have become pickable
+            self.pickables_scanned = False
+        if ray_test is not None:
+            self.ray_tests.setdefault(name, []).append(ray_test)
+        if geometry:
+            self.geometry_category = name
+        self.cache_key = None
+        return mask
+
+    def remove_ray_test(self, name, ray_test):
+        """
+        Removes a ray test added with register_category, e.g. when the tool
+        that owns it is replaced.
+        """
+        ray_tests = self.ray_tests.get(name)
+        if ray_tests and ray_test in ray_tests:
+            ray_tests.remove(ray_test)
+            if not ray_tests:
+                del self.ray_tests[name]
+            self.cache_key = None
+
+    def unregister_category(self, name):
+        """
+        Drops category name and its ray tests. Its bit is not handed out
+        again, colliders may still carry it.
+        """
+        self.categories.pop(name, None)
+        self.ray_tests.pop(name, None)
+        if self.geometry_category == name:
+            self.geometry_category = None
+        self.cache_key = None
+
+    def get_mask(self, name):
+        return self.categories[name]
+
+    def get_collide_mask(self, categories=None):
+        """
+        Collide mask of the collision solids of categories (all if None).
+        """
+        mask = BitMask32.all_off()
+        for name, category_mask in self.categories.items():
+            if categories is None or name in categories:
+                mask |= category_mask
+        if self.geometry_category is not None and (categories is None or self.geometry_category in categories):
+            mask |= GeomNode.get_default_collide_mask()
+        return mask
+
+    def get_category(self, into_mask):
+        for name, category_mask in self.categories.items():
+            if into_mask & category_mask:
+                return name
+        if into_mask & GeomNode.get_default_collide_mask():
+            return self.geometry_category
+        return None
+
+    def is_pickable(self, node_path):
+        """
+        Entities (nodes with an id) and nodes collidable with a category.
+        """
+        if node_path.has_python_tag("id"):
+            return True
+        mask = BitMask32.all_off()
+        for category_mask in self.categories.values():
+            mask |= category_mask
+        return bool(node_path.node().get_into_collide_mask() & mask)
+
+    def add_pickable(self, node_path):
+        self.pickables.add(node_path)
+
+    def remove_pickable(self, node_path):
+        self.pickables.remove(node_path)
+
+    def node_moved(self, node_path):
+        """
+        Call after moving node_path (or changing its geometry): the index
+        updates it and the pickables below it at the start of the next frame.
+        """
+        self.pickables.mark_dirty(node_path)
+
+    def node_removed(self, node_path):
+        """
+        Call before removing node_path from the scene.
+        """
+        if node_path.is_empty():
+            return
+        for child in node_path.find_all_matches("**"):
+            self.pickables.remove(child)
+        self.cache_key = None
+
+    def invalidate_pickables(self):
+        """
+        Rescans the scene for pickable nodes on the next cast, e.g. after a
+        map is loaded. The rescan also checks every indexed node, for the
+        moves and removals that were not reported.
+        """
+        self.pickables_scanned = False
+
+    def sync_task_step(self, task):
+        self.synced += self.pickables.sync()
+        return task.cont
+
+    def rescan_pickables(self):
+        self.pickables.rescan(self.is_pickable)
+        self.pickables_scanned = True
+
+    def get_stats(self):
+        return {
+            "casts": self.casts,
+            "categories": {name: mask.get_lowest_on_bit() for name, mask in self.categories.items()},
+            "pickables": len(self.pickables),
+            "synced": self.synced,
+        }
+
+    def get_mouse_ray(self, mouse_pos=None):
+        """
+        Near and far points (render space) of the ray under mouse_pos, in
+        -1..1 film coordinates, or under the mouse. None if there is no mouse.
+        """
+        if mouse_pos is None:
+            if not self.world.mouseWatcherNode.hasMouse():
+                return None
+            mouse_pos = self.world.mouseWatcherNode.getMouse()
+        p_from = Point3()
+        p_to = Point3()
+        if not self.world.camLens.extrude(mouse_pos, p_from, p_to):
+            return None
+        render = self.world.render
+        return render.get_relative_point(self.world.cam, p_from), render.get_relative_point(self.world.cam, p_to)
+
+    def get_frustum_planes(self, rect):
+        """
+        Planes of the part of the view frustum inside rect, (x0, y0, x1, y1)
+        in -1..1 film coordinates, as an (6, 4) array of render space planes
+        (a, b, c, d) with a*x + b*y + c*z + d >= 0 inside. None if the lens
+        can't extrude the corners.
+        """
+        x0, y0, x1, y1 = rect
+        near, far = [], []
+        for corner in ((x0, y0), (x1, y0), (x1, y1), (x0, y1)):
+            ray = self.get_mouse_ray(Point2(*corner))
+            if ray is None:
+                return None
+            near.append(np.array(ray[0], dtype=np.float64))
+            far.append(np.array(ray[1], dtype=np.float64))
+        center = (sum(near) + sum(far)) / 8.0
+        faces = [(near[0], near[1], near[2]), (far[0], far[2], far[1])]
+        faces += [(near[i], near[(i + 1) % 4], far[i]) for i in range(4)]
+        planes = np.empty((6, 4))
+        for i, (a, b, c) in enumerate(faces):
+            normal = np.cross(b - a, c - a)
+            normal /= np.linalg.norm(normal)
+            # Face the inside of the volume
+            if normal @ (center - a) < 0:
+                normal = -normal
+            planes[i, :3] = normal
+            planes[i, 3] = -normal @ a
+        return planes
+
+    def pick_rect(self, rect):
+        """
+        Indexed pickable nodes whose bounds are in the part of the view inside
+        rect, (x0, y0, x1, y1) in -1..1 film coordinates, tested all at once.
+        """
+        x0, y0, x1, y1 = rect
+        rect = (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+        if rect[0] == rect[2] or rect[1] == rect[3]:
+            return []
+        planes = self.get_frustum_planes(rect)
+        if planes is None:
+            return []
+        if not self.pickables_scanned:
+            self.rescan_pickables()
+        return self.pickables.query_frustum(planes)
+
+    def pick(self, categories=None, mouse_pos=None):
+        """
+        Hits under the mouse (or under mouse_pos), nearest first, of the
+        given categories or of all of them.
+
+        The full cast is done once per frame and mouse position, whichever
+        tool asks first; a call for other categories or another position
+        (e.g. the mouse path of a stroke) casts for those categories only.
+        """
+        if mouse_pos is None:
+            if not self.world.mouseWatcherNode.hasMouse():
+                return []
+            mouse_pos = self.world.mouseWatcherNode.getMouse()
+        key = (self.world.taskMgr.globalClock.get_frame_count(), mouse_pos[0], mouse_pos[1])
+        if key == self.cache_key:
+            hits = self.cache
+        elif categories is None:
+            hits = self.cache = self.cast(mouse_pos)
+            self.cache_key = key
+        else:
+            return self.cast(mouse_pos, categories)
+        if categories is None:
+            return list(hits)
+        return [hit for hit in hits if hit.category in categories]
+
+    def pick_first(self, category, mouse_pos=None):
+        """
+        Nearest hit of category, or None.
+        """
+        hits = self.pick((category,), mouse_pos)
+        return hits[0] if hits else None
+
+    def cast(self, mouse_pos, categories=None):
+        """
+        Casts the ray under mouse_pos against categories (all if None).
+        Only the nodes whose bounds the ray crosses are traversed, nearest
+        bounds first, until the next bounds start beyond the nearest hit of
+        every category cast for, so each category gets its nearest hit even
+        behind the hits of another one.
+        """
+        ray = self.get_mouse_ray(mouse_pos)
+        if ray is None:
+            return []
+        p_from, p_to = ray
+        self.casts += 1
+        hits = []
+
+        # category -> distance of its nearest hit so far
+        nearest = {}
+        for name, ray_tests in self.ray_tests.items():
+            if categories is None or name in categories:
+                for ray_test in ray_tests:
+                    for distance, point, node_path in ray_test(mouse_pos, p_from, p_to):
+                        hits.append(PickHit(distance, point, node_path, name))
+                        nearest[name] = min(distance, nearest.get(name, distance))
+
+        collide_mask = self.get_collide_mask(categories)
+        if collide_mask:
+            if not self.pickables_scanned:
+                self.rescan_pickables()
+            self.picker_node.set_from_collide_mask(collide_mask)
+            render = self.world.render
+            direction = p_to - p_from
+            length = direction.length()
+            # The ray node hangs under the camera: set it in its own space
+            self.picker_ray.set_origin(self.picker_np.get_relative_point(render, p_from))
+            self.picker_ray.set_direction(self.picker_np.get_relative_vector(render, direction / length))
+            # Categories whose solids the ray is cast against
+            wanted = [name for name in self.categories if categories is None or name in categories]
+            seen = set()
+            for t, node_path in self.pickables.query_ray(p_from, direction / length, length):
+                if all(name in nearest and t > nearest[name] for name in wanted):
+                    break
+                if not self.pickables.is_attached(node_path):
+                    # Removed without node_removed, drop it for the next casts
+                    self.pickables.remove(node_path)
+                    continue
+                self.handler.clear_entries()
+                self.traverser.traverse(node_path)
+                for entry in self.handler.getEntries():
+                    into = entry.getIntoNodePath()
+                    point = entry.get_surface_point(render)
+                    # Nested pickables report the same solids
+                    if (into, point) in seen:
+                        continue
+                    seen.add((into, point))
+                    category = self.get_category(into.get_collide_mask())
+                    if category is None or (categories is not None and category not in categories):
+                        continue
+                    distance = (point - p_from).length()
+                    hits.append(PickHit(distance, point, into, category, entry))
+                    nearest[category] = min(distance, nearest.get(category, distance))
+
+        hits.sort(key=lambda hit: hit.distance)
+        return hits
+
+
+def get_pick_service(world):
+    """
+    The PickService of world, created on first use.
+    """
+    service = getattr(world, "pick_service", None)
+    if service is None:
+        service = world.pick_service = PickService(world)
+        if hasattr(world, "add_stats_source"):
+            world.add_stats_source("picking", service.get_stats)
+    return service
+
+
+class Picker(DirectObject):
+    def __init__(self, world: Panda3DWorld):
+        self.base = world
+        self.pick_service = get_pick_service(world)
         
-        # Add the picker node to the traverser.
+        # Register the categories, in the order they take the click.
+        # Plain geometry is picked as an object.
+        self.gizmo_mask = self.pick_service.register_category("gizmo")
+        self.terrain_mask = self.pick_service.register_category("terrain")
+        self.object_mask = self.pick_service.register_category("object", geometry=True)
+        self.ui_mask = self.pick_service.register_category("ui")
         
         # Accept the mouse click event.
         self.base.accept("mouse1", self.on_mouse_click)
@@ -52,6 +400,9 @@ class Picker(DirectObject):
         # In your case, gizmos_np should be a NodePath containing all gizmo collision objects.
         collider_nodes = gizmos_np.findAllMatches("**/+CollisionNode")
         count = collider_nodes.getNumPaths()
+        for collider_np in collider_nodes:
+            collider_np.node().set_into_collide_mask(self.gizmo_mask)
+            self.pick_service.add_pickable(collider_np)
         print("Number of gizmo colliders added:", count)
     
     def on_mouse_click(self, position):
@@ -65,59 +416,34 @@ class Picker(DirectObject):
     
         # Debug: Check mouse position
         print(f"Normalized Mouse Position: {pMouse}")
-    
-        # Get near and far points in camera space
-        pFrom = Point3()
-        pTo = Point3()
-        base.camLens.extrude(pMouse, pFrom, pTo)
-    
-        # Convert to world space
-        pFrom = render.getRelativePoint(base.cam, pFrom)
-        pTo = render.getRelativePoint(base.cam, pTo)
-    
-        # Debug: Check world space points
-        print(f"World Space Ray Start: {pFrom}, End: {pTo}")
-    
-        # Update the ray's origin and direction
-        self.picker_ray.set_origin(pFrom)
-        self.picker_ray.set_direction((pTo - pFrom).normalized())  # Normalize direction
-    
         
-        # Traverse the scene graph (or your collision root node if you have one).
-        self.handler.clear_entries()
-        self.traverser.traverse(render)
+        # One cast shared with the other tools, hits sorted by distance.
+        hits = self.pick_service.pick()
         
         # Process the collision entries.
-        if self.handler.getNumEntries() > 0:
+        if hits:
             print("Click detected!")
-            self.handler.sortEntries()
-            entries = self.handler.getEntries()
+            # Nearest hit of each category, in one pass.
+            nearest = {}
+            for hit in hits:
+                nearest.setdefault(hit.category, hit)
             
-            # Filter entries based on collision masks.
-            gizmo_entries = [e for e in entries if e.getIntoNodePath().getCollideMask() & self.gizmo_mask]
-            if gizmo_entries:
-                gizmo_entry = gizmo_entries[0]
+            if "gizmo" in nearest:
                 print("Clicked on gizmos")
-                self.base.animator_tab.start_gizmo_drag(gizmo_entry)
+                self.base.animator_tab.start_gizmo_drag(nearest["gizmo"].entry)
                 return
             
-            terrain_entries = [e for e in entries if e.getIntoNodePath().getCollideMask() & self.terrain_mask]
-            if terrain_entries:
-                terrain_entry = terrain_entries[0]
+            if "terrain" in nearest:
                 print("Clicked on terrain")
                 # Handle terrain collision...
                 return
             
-            object_entries = [e for e in entries if e.getIntoNodePath().getCollideMask() & self.object_mask]
-            if object_entries:
-                object_entry = object_entries[0]
+            if "object" in nearest:
                 print("Clicked on object")
                 # Handle object selection...
                 return
             
-            ui_entries = [e for e in entries if e.getIntoNodePath().getCollideMask() & self.ui_mask]
-            if ui_entries:
-                ui_entry = ui_entries[0]
+            if "ui" in nearest:
                 print("Clicked on UI element")
                 # Handle UI selection...
                 return
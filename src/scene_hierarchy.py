@@ -0,0 +1,304 @@
+from PyQt5.QtCore import QAbstractItemModel, QModelIndex, Qt
+
+
+class SceneItem:
+    """
+    A row of the hierarchy: one node path and the part of its children
+    that has been fetched so far.
+    """
+
+    __slots__ = ("node_path", "parent", "row", "name", "children", "complete", "had_children")
+
+    def __init__(self, node_path, parent, row):
+        self.node_path = node_path
+        self.parent = parent
+        self.row = row
+        self.name = node_path.get_name()
+        # None until the view first asks for the children, then always
+        # the first len(children) children of the node, in scene graph order
+        self.children = None
+        # Whether the children list held all the children at the last fetch
+        self.complete = False
+        self.had_children = node_path.get_num_children() > 0
+
+
+class SceneGraphModel(QAbstractItemModel):
+    """
+    Tree model over the scene graph below a root node path.
+
+    Children are only read from the scene graph when the view expands a
+    node (canFetchMore / fetchMore, in batches of fetch_batch_size), so
+    opening the editor on a big scene costs nothing for the parts that are
+    never looked at. Changes to the scene are applied as row insertions and
+    removals on the fetched part only, instead of rebuilding the tree:
+    node_added and node_about_to_be_removed for the changes the caller
+    knows about, sync for "something below here may have changed".
+
+    Qt.UserRole data is the node path, like the items of the old tree widgets.
+    """
+
+    fetch_batch_size = 256
+
+    def __init__(self, root, header_label="", parent=None):
+        super().__init__(parent)
+        self.header_label = header_label
+        self.root = None
+        # Hidden item above the root; its only child is the root's row
+        self.top = None
+        # node path -> item, for every fetched row
+        self.items = {}
+        # Set while the rows are being edited, so views can't fetch in between
+        self.updating = False
+        self.set_root(root)
+
+    def set_root(self, root):
+        self.beginResetModel()
+        self.root = root
+        self.items = {}
+        self.top = SceneItem(root, None, 0)
+        self.top.children = [self.make_item(root, self.top, 0)]
+        self.endResetModel()
+
+    def set_header_label(self, label):
+        self.header_label = label
+        self.headerDataChanged.emit(Qt.Horizontal, 0, 0)
+
+    def make_item(self, node_path, parent, row):
+        item = SceneItem(node_path, parent, row)
+        self.items[node_path] = item
+        return item
+
+    def forget(self, item):
+        """
+        Drops the item and its fetched descendants from the lookup.
+        """
+        stack = [item]
+        while stack:
+            item = stack.pop()
+            if self.items.get(item.node_path) is item:
+                del self.items[item.node_path]
+            if item.children:
+                stack.extend(item.children)
+
+    def item_from_index(self, index):
+        return index.internalPointer() if index.isValid() else self.top
+
+    def index_of_item(self, item):
+        if item is self.top:
+            return QModelIndex()
+        return self.createIndex(item.row, 0, item)
+
+    def index_of(self, node_path):
+        """
+        The index of a node path's row, fetching its ancestors' children as
+        needed; an invalid index if it is not below the root.
+        """
+        item = self.items.get(node_path)
+        if item is not None:
+            return self.index_of_item(item)
+        if node_path.is_empty() or node_path == self.root or not self.root.is_ancestor_of(node_path):
+            return QModelIndex()
+        parent_index = self.index_of(node_path.get_parent())
+        parent_item = self.item_from_index(parent_index)
+        row = node_path.get_parent().node().find_child(node_path.node())
+        while row >= len(parent_item.children or ()) and self.canFetchMore(parent_index):
+            self.fetchMore(parent_index)
+        item = self.items.get(node_path)
+        return self.index_of_item(item) if item is not None else QModelIndex()
+
+    @staticmethod
+    def renumber(children, start):
+        for row in range(start, len(children)):
+            children[row].row = row
+
+    # QAbstractItemModel
+
+    def index(self, row, column, parent=QModelIndex()):
+        item = self.item_from_index(parent)
+        if column != 0 or not item.children or not 0 <= row < len(item.children):
+            return QModelIndex()
+        return self.createIndex(row, 0, item.children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        return self.index_of_item(index.internalPointer().parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        children = self.item_from_index(parent).children
+        return len(children) if children else 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def hasChildren(self, parent=QModelIndex()):
+        item = self.item_from_index(parent)
+        if item.children:
+            return True
+        return not item.node_path.is_empty() and item.node_path.get_num_children() > 0
+
+    def canFetchMore(self, parent):
+        item = self.item_from_index(parent)
+        if self.updating or item is self.top or item.node_path.is_empty():
+            return False
+        fetched = len(item.children) if item.children is not None else 0
+        return fetched < item.node_path.get_num_children()
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        item = self.item_from_index(parent)
+        if item.children is None:
+            item.children = []
+        node_path = item.node_path
+        first = len(item.children)
+        last = min(node_path.get_num_children(), first + self.fetch_batch_size) - 1
+        self.updating = True
+        self.beginInsertRows(parent, first, last)
+        for row in range(first, last + 1):
+            item.children.append(self.make_item(node_path.get_child(row), item, row))
+        item.complete = last == node_path.get_num_children() - 1
+        self.endInsertRows()
+        self.updating = False
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        item = index.internalPointer()
+        if role == Qt.DisplayRole:
+            return item.name
+        if role == Qt.UserRole:
+            return item.node_path
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole and section == 0:
+            return self.header_label
+        return None
+
+    # Scene changes
+
+    def node_added(self, node_path):
+        """
+        Call after node_path was attached (or reparented) into the scene.
+        Only touches the rows of its parent, and nothing if the parent was
+        never fetched.
+        """
+        if node_path.is_empty() or node_path in self.items:
+            return
+        parent_item = self.items.get(node_path.get_parent())
+        if parent_item is None:
+            return
+        children = parent_item.children
+        if children is None:
+            self.update_has_children(parent_item)
+            return
+        row = node_path.get_parent().node().find_child(node_path.node())
+        # Past the fetched prefix the row comes with the next fetchMore
+        if row < 0 or row > len(children) or row == len(children) and not parent_item.complete:
+            return
+        self.insert_row(parent_item, row, node_path)
+
+    def node_about_to_be_removed(self, node_path):
+        """
+        Call before node_path is removed or detached; for a reparent call
+        this first and node_added after.
+        """
+        item = self.items.get(node_path)
+        if item is None or item.parent is self.top:
+            return
+        self.remove_row(item.parent, item.row)
+
+    def node_changed(self, node_path):
+        """
+        Call after renaming node_path.
+        """
+        item = self.items.get(node_path)
+        if item is not None and item.name != node_path.get_name():
+            item.name = node_path.get_name()
+            index = self.index_of_item(item)
+            self.dataChanged.emit(index, index, [Qt.DisplayRole])
+
+    def insert_row(self, parent_item, row, node_path):
+        children = parent_item.children
+        updating, self.updating = self.updating, True
+        self.beginInsertRows(self.index_of_item(parent_item), row, row)
+        children.insert(row, self.make_item(node_path, parent_item, row))
+        self.renumber(children, row + 1)
+        self.endInsertRows()
+        self.updating = updating
+
+    def remove_row(self, parent_item, row):
+        children = parent_item.children
+        updating, self.updating = self.updating, True
+        self.beginRemoveRows(self.index_of_item(parent_item), row, row)
+        self.forget(children.pop(row))
+        self.renumber(children, row)
+        self.endRemoveRows()
+        self.updating = updating
+
+    def update_has_children(self, item):
+        has_children = not item.node_path.is_empty() and item.node_path.get_num_children() > 0
+        if has_children != item.had_children:
+            item.had_children = has_children
+            index = self.index_of_item(item)
+            # Makes the view re-query hasChildren for the expander
+            self.dataChanged.emit(index, index)
+
+    def sync(self, node_path=None):
+        """
+        Brings the fetched rows below node_path (the root by default) in line
+        with the scene graph, for changes made without notifying the model.
+        The cost grows with the number of fetched rows, not the scene size.
+        """
+        item = self.items.get(node_path if node_path is not None else self.root)
+        if item is None:
+            return
+        self.node_changed(item.node_path)
+        stack = [item]
+        self.updating = True
+        try:
+            while stack:
+                item = stack.pop()
+                self.sync_item(item)
+                if item.children:
+                    stack.extend(child for child in item.children if child.children is not None)
+        finally:
+            self.updating = False
+
+    def sync_item(self, item):
+        children = item.children
+        if children is None:
+            self.update_has_children(item)
+            return
+        nodes = list(item.node_path.get_children())
+        positions = {node: position for position, node in enumerate(nodes)}
+        complete = item.complete
+        fetched = len(children)
+
+        # Drop the rows whose node left, or that are out of scene graph order
+        last = -1
+        row = 0
+        while row < len(children):
+            position = positions.get(children[row].node_path)
+            if position is None or position < last:
+                self.remove_row(item, row)
+            else:
+                last = position
+                row += 1
+
+        # Insert the missing nodes, up to as many rows as were fetched before
+        # (or all of them if every child had been fetched)
+        limit = len(nodes) if complete else min(len(nodes), fetched)
+        for row in range(limit):
+            if row < len(children) and children[row].node_path == nodes[row]:
+                continue
+            self.insert_row(item, row, nodes[row])
+        while len(children) > limit:
+            self.remove_row(item, len(children) - 1)
+        item.complete = limit == len(nodes)
+        for child in children:
+            if child.name != child.node_path.get_name():
+                self.node_changed(child.node_path)
@@ -186,25 +186,13 @@ class ScriptInspector(QWidget):
             print("it's canvas")
             def make_label():
                 ui_editor.Drag_and_drop_ui_editor.label(instance, text1="Label 1", parent1=w.render2d)
-                w.hierarchy_tree.clear()
-                w.hierarchy_tree1.clear()
-
-                w.populate_hierarchy(w.hierarchy_tree, w.render)
-                w.populate_hierarchy(w.hierarchy_tree1, w.render2d)
+                w.hierarchy_model1.sync()
             def make_button():
                 ui_editor.Drag_and_drop_ui_editor.button(instance, text="Button 1", parent=w.render2d)
-                w.hierarchy_tree.clear()
-                w.hierarchy_tree1.clear()
-
-                w.populate_hierarchy(w.hierarchy_tree, w.render)
-                w.populate_hierarchy(w.hierarchy_tree1, w.render2d)
+                w.hierarchy_model1.sync()
             def make_image():
                 ui_editor.Drag_and_drop_ui_editor.Frame(instance, image="./python_img.png", parent1=w.render2d)
-                w.hierarchy_tree.clear()
-                w.hierarchy_tree1.clear()
-
-                w.populate_hierarchy(w.hierarchy_tree, w.render)
-                w.populate_hierarchy(w.hierarchy_tree1, w.render2d)
+                w.hierarchy_model1.sync()
 
             create_label = QPushButton("Create Label")
             create_button = QPushButton("Create button")
@@ -0,0 +1,243 @@
+import time
+
+from direct.showbase.DirectObject import DirectObject
+from QPanda3D.Panda3DWorld import Panda3DWorld
+from raycasting import get_pick_service
+
+
+class SelectionSet:
+    """
+    The selected node paths, in selection order; the last one is the active node.
+
+    Every change sends "selection-changed" with the set, for the panels that
+    show it, and keeps world.selected_node (the single selection the rest
+    of the editor uses) on the active node.
+    """
+
+    def __init__(self, world: Panda3DWorld):
+        self.world = world
+        # node path -> None, a dict keeps the order and tests membership in O(1)
+        self.nodes = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(list(self.nodes))
+
+    def __contains__(self, node_path):
+        return node_path in self.nodes
+
+    def get_active(self):
+        return next(reversed(self.nodes)) if self.nodes else None
+
+    def set(self, node_paths):
+        nodes = dict.fromkeys(node_path for node_path in node_paths if not node_path.is_empty())
+        if list(nodes) != list(self.nodes):
+            self.nodes = nodes
+            self.changed()
+
+    def add(self, node_paths):
+        added = False
+        for node_path in node_paths:
+            if node_path not in self.nodes and not node_path.is_empty():
+                self.nodes[node_path] = None
+                added = True
+        if added:
+            self.changed()
+
+    def remove(self, node_paths):
+        removed = False
+        for node_path in node_paths:
+            if node_path in self.nodes:
+                del self.nodes[node_path]
+                removed = True
+        if removed:
+            self.changed()
+
+    def toggle(self, node_paths):
+        for node_path in node_paths:
+            if node_path in self.nodes:
+                del self.nodes[node_path]
+            elif not node_path.is_empty():
+                self.nodes[node_path] = None
+        self.changed()
+
+    def clear(self):
+        if self.nodes:
+            self.nodes = {}
+            self.changed()
+
+    def changed(self):
+        self.world.selected_node = self.get_active()
+        self.world.messenger.send("selection-changed", [self])
+
+
+class MarqueeSelect(DirectObject):
+    """
+    Rectangle selection in the 3D viewport: shift-drag with the left button.
+
+    The rectangle is drawn over the widget while dragging; on release the
+    entities whose bounds are in the part of the view frustum inside it are
+    selected, in one vectorized test over the pick service's index.
+    Holding control as well adds them to the selection instead.
+    """
+
+    # Rectangles smaller than this (in -1..1 film units) are treated as clicks
+    min_size = 0.01
+
+    def __init__(self, world: Panda3DWorld, panda_widget, selection: SelectionSet):
+        super().__init__()
+        self.world = world
+        self.widget = panda_widget
+        self.selection = selection
+        self.pick_service = get_pick_service(world)
+        # Film coordinates of the corner the drag started at, None when not dragging
+        self.start = None
+        self.end = None
+        self.additive = False
+
+        self.accept("shift-mouse1", self.begin)
+        self.accept("shift-control-mouse1", self.begin, [True])
+        self.accept("shift-mouse1-up", self.finish)
+        self.accept("shift-control-mouse1-up", self.finish)
+        self.accept("control-mouse1-up", self.finish)
+        # Shift may be released before the button
+        self.accept("mouse1-up", self.finish)
+
+    def begin(self, position, additive=False):
+        if not self.world.mouseWatcherNode.hasMouse():
+            return
+        mouse = self.world.mouseWatcherNode.getMouse()
+        self.start = self.end = (mouse.x, mouse.y)
+        self.additive = additive
+        self.world.add_task(self.drag_task, "marquee_select_task")
+
+    def drag_task(self, task):
+        if self.start is None:
+            return task.done
+        if self.world.mouseWatcherNode.hasMouse():
+            mouse = self.world.mouseWatcherNode.getMouse()
+            self.end = (mouse.x, mouse.y)
+        self.widget.set_marquee(self.get_widget_rect())
+        return task.cont
+
+    def get_widget_rect(self):
+        """
+        The rectangle in widget pixels, as (left, top, width, height).
+        """
+        width, height = self.widget.width(), self.widget.height()
+        x0, x1 = sorted(((self.start[0] + 1) * 0.5 * width, (self.end[0] + 1) * 0.5 * width))
+        y0, y1 = sorted(((1 - self.start[1]) * 0.5 * height, (1 - self.end[1]) * 0.5 * height))
+        return x0, y0, x1 - x0, y1 - y0
+
+    def finish(self, position):
+        if self.start is None:
+            return
+        self.world.taskMgr.remove("marquee_select_task")
+        self.widget.set_marquee(None)
+        if self.world.mouseWatcherNode.hasMouse():
+            mouse = self.world.mouseWatcherNode.getMouse()
+            self.end = (mouse.x, mouse.y)
+        start, end = self.start, self.end
+        self.start = self.end = None
+        if abs(end[0] - start[0]) < self.min_size or abs(end[1] - start[1]) < self.min_size:
+            return
+        nodes = [node_path for node_path in self.pick_service.pick_rect((start[0], start[1], end[0], end[1]))
+                 if node_path.has_python_tag("id")]
+        if self.additive:
+            self.selection.add(nodes)
+        else:
+            self.selection.set(nodes)
+        print(f"Marquee selected {len(nodes)} nodes")
+
+
+class HoverHighlight(DirectObject):
+    """
+    Tints the entity under the mouse in the 3D viewport.
+
+    The pick is only redone when the mouse or the camera moved, through the
+    pick service (so against its index of pickable nodes, not the whole
+    scene); other frames keep the last result. The time spent per frame,
+    and per re-pick for the frames where the mouse moved, is reported under
+    "hover" in the world's stats.
+    """
+
+    tint = (1.4, 1.4, 1.0, 1.0)
+
+    def __init__(self, world: Panda3DWorld):
+        super().__init__()
+        self.world = world
+        self.pick_service = get_pick_service(world)
+        self.pick_service.register_category("object", geometry=True)
+        self.hovered = None
+        # Color scale of the hovered node before the tint, None if it had none
+        self.saved_color_scale = None
+        # (mouse x, mouse y, camera transform) of the last pick, None without mouse
+        self.last_state = None
+
+        self.frames = 0
+        self.queries = 0
+        self.last_time = 0.0
+        # Exponential moving average of the time per frame, in seconds
+        self.average_time = 0.0
+        # The same for the frames that re-picked only
+        self.last_query_time = 0.0
+        self.average_query_time = 0.0
+
+        self.world.add_task(self.hover_task, "hover_highlight_task")
+        self.world.add_stats_source("hover", self.get_stats)
+
+    def hover_task(self, task):
+        start = time.perf_counter()
+        watcher = self.world.mouseWatcherNode
+        if watcher.hasMouse():
+            mouse = watcher.getMouse()
+            state = (mouse.x, mouse.y, self.world.cam.get_net_transform())
+        else:
+            state = None
+        if state != self.last_state:
+            self.last_state = state
+            self.set_hovered(self.find_hovered() if state is not None else None)
+            self.queries += 1
+            self.last_query_time = time.perf_counter() - start
+            self.average_query_time += (self.last_query_time - self.average_query_time) * 0.05
+        self.last_time = time.perf_counter() - start
+        self.average_time += (self.last_time - self.average_time) * 0.05
+        self.frames += 1
+        return task.cont
+
+    def find_hovered(self):
+        """
+        The entity (node with an id) under the mouse, or None.
+        """
+        hit = self.pick_service.pick_first("object")
+        if hit is None:
+            return None
+        entity = hit.node_path.find_net_python_tag("id")
+        return None if entity.is_empty() else entity
+
+    def set_hovered(self, node_path):
+        if node_path == self.hovered:
+            return
+        if self.hovered is not None and not self.hovered.is_empty():
+            if self.saved_color_scale is None:
+                self.hovered.clear_color_scale()
+            else:
+                self.hovered.set_color_scale(self.saved_color_scale)
+        self.hovered = node_path
+        if node_path is not None:
+            self.saved_color_scale = node_path.get_color_scale() if node_path.has_color_scale() else None
+            color_scale = self.saved_color_scale or (1.0, 1.0, 1.0, 1.0)
+            node_path.set_color_scale(*(c * t for c, t in zip(color_scale, self.tint)))
+
+    def get_stats(self):
+        return {
+            "frames": self.frames,
+            "queries": self.queries,
+            "last_time_us": self.last_time * 1e6,
+            "average_time_us": self.average_time * 1e6,
+            "last_query_time_us": self.last_query_time * 1e6,
+            "average_query_time_us": self.average_query_time * 1e6,
+            "hovered": None if self.hovered is None else self.hovered.get_name(),
+        }
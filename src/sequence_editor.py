@@ -18,6 +18,7 @@ from panda3d.core import (
     Vec3, Point3, CollisionTraverser, CollisionNode, CollisionRay,
     CollisionHandlerQueue, BitMask32, CollisionTube, CollisionSphere, GeomNode
 )
+from raycasting import get_pick_service
 
 def lerp_tuple(start, end, t):
     """Linearly interpolates between two tuples element‐wise."""
@@ -489,8 +490,9 @@ class SequenceEditorTab(QWidget):
             arrow.setTag("gizmo_axis", axis)
             arrow.setTag("arrow", axis)
             self.gizmo_arrows[axis] = arrow
-            arrow_model.set_collide_mask(BitMask32.bit(10))
-            arrow.set_collide_mask(BitMask32.bit(10))
+            gizmo_mask = get_pick_service(self.panda3DWorld).register_category("gizmo")
+            arrow_model.set_collide_mask(gizmo_mask)
+            arrow.set_collide_mask(gizmo_mask)
             print(f"Created gizmo for axis: {axis}")
             bounds = arrow.getBounds()  # This returns a bounding volume (usually a sphere).
             center = bounds.getCenter()  # Center in the arrow's coordinate space.
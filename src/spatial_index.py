@@ -0,0 +1,499 @@
+import numpy as np
+from panda3d.core import BoundingBox, BoundingSphere, NodePath, Point3
+
+
+def surface_area(low, high):
+    dx, dy, dz = high[0] - low[0], high[1] - low[1], high[2] - low[2]
+    return 2.0 * (dx * dy + dy * dz + dz * dx)
+
+
+def union(low_a, high_a, low_b, high_b):
+    return ((min(low_a[0], low_b[0]), min(low_a[1], low_b[1]), min(low_a[2], low_b[2])),
+            (max(high_a[0], high_b[0]), max(high_a[1], high_b[1]), max(high_a[2], high_b[2])))
+
+
+def contains(low_a, high_a, low_b, high_b):
+    return (low_a[0] <= low_b[0] and high_b[0] <= high_a[0] and low_a[1] <= low_b[1] and high_b[1] <= high_a[1]
+            and low_a[2] <= low_b[2] and high_b[2] <= high_a[2])
+
+
+def overlaps(low_a, high_a, low_b, high_b):
+    return (low_a[0] <= high_b[0] and low_b[0] <= high_a[0] and low_a[1] <= high_b[1] and low_b[1] <= high_a[1]
+            and low_a[2] <= high_b[2] and low_b[2] <= high_a[2])
+
+
+def intersect_ray(origin, direction, low, high, max_t):
+    """
+    Entry distance of a ray into the box low..high (0 if it starts inside), or None.
+    """
+    t_near, t_far = 0.0, max_t
+    for axis in range(3):
+        if direction[axis] == 0.0:
+            if origin[axis] < low[axis] or origin[axis] > high[axis]:
+                return None
+            continue
+        t0 = (low[axis] - origin[axis]) / direction[axis]
+        t1 = (high[axis] - origin[axis]) / direction[axis]
+        if t0 > t1:
+            t0, t1 = t1, t0
+        t_near, t_far = max(t_near, t0), min(t_far, t1)
+        if t_near > t_far:
+            return None
+    return t_near
+
+
+class TreeNode:
+    __slots__ = ("low", "high", "parent", "left", "right", "item", "height")
+
+    def __init__(self):
+        self.low = self.high = None
+        self.parent = self.left = self.right = None
+        self.item = None
+        self.height = 0
+
+    def is_leaf(self):
+        return self.left is None
+
+
+class AABBTree:
+    """
+    Dynamic bounding volume hierarchy of axis-aligned boxes.
+
+    Leaves keep their box enlarged by `margin`, so an item moving less than
+    that doesn't touch the tree. A new leaf goes down toward the sibling that
+    grows the total surface area the least (the cost used by Box2D's dynamic
+    tree), and its ancestors are refitted on the way back up.
+    """
+
+    def __init__(self, margin=0.1):
+        self.margin = margin
+        self.root = None
+        self.leaf_count = 0
+
+    def insert(self, item, low, high):
+        """
+        Adds item with the box low..high, returns the leaf to pass to move/remove.
+        """
+        leaf = TreeNode()
+        leaf.item = item
+        self.set_fat_box(leaf, low, high)
+        self.insert_leaf(leaf)
+        self.leaf_count += 1
+        return leaf
+
+    def remove(self, leaf):
+        self.remove_leaf(leaf)
+        self.leaf_count -= 1
+
+    def move(self, leaf, low, high):
+        """
+        Updates the box of a leaf; returns True if it had to be reinserted.
+        """
+        if contains(leaf.low, leaf.high, low, high):
+            return False
+        self.remove_leaf(leaf)
+        self.set_fat_box(leaf, low, high)
+        self.insert_leaf(leaf)
+        return True
+
+    def set_fat_box(self, leaf, low, high):
+        margin = self.margin
+        leaf.low = (low[0] - margin, low[1] - margin, low[2] - margin)
+        leaf.high = (high[0] + margin, high[1] + margin, high[2] + margin)
+
+    def insert_leaf(self, leaf):
+        if self.root is None:
+            self.root = leaf
+            leaf.parent = None
+            return
+
+        # Find the best sibling
+        node = self.root
+        while not node.is_leaf():
+            area = surface_area(node.low, node.high)
+            combined = surface_area(*union(node.low, node.high, leaf.low, leaf.high))
+            # Cost of making a new parent for this node and the leaf
+            cost = 2.0 * combined
+            # Minimum cost of pushing the leaf further down
+            inheritance = 2.0 * (combined - area)
+
+            def descend_cost(child):
+                grown = surface_area(*union(child.low, child.high, leaf.low, leaf.high))
+                if child.is_leaf():
+                    return grown + inheritance
+                return grown - surface_area(child.low, child.high) + inheritance
+
+            cost_left = descend_cost(node.left)
+            cost_right = descend_cost(node.right)
+            if cost < cost_left and cost < cost_right:
+                break
+            node = node.left if cost_left < cost_right else node.right
+
+        sibling = node
+        old_parent = sibling.parent
+        new_parent = TreeNode()
+        new_parent.parent = old_parent
+        new_parent.low, new_parent.high = union(sibling.low, sibling.high, leaf.low, leaf.high)
+        new_parent.height = sibling.height + 1
+        new_parent.left = sibling
+        new_parent.right = leaf
+        sibling.parent = new_parent
+        leaf.parent = new_parent
+        if old_parent is None:
+            self.root = new_parent
+        elif old_parent.left is sibling:
+            old_parent.left = new_parent
+        else:
+            old_parent.right = new_parent
+        self.refit(new_parent.parent)
+
+    def remove_leaf(self, leaf):
+        if leaf is self.root:
+            self.root = None
+            return
+        parent = leaf.parent
+        grand_parent = parent.parent
+        sibling = parent.right if parent.left is leaf else parent.left
+        sibling.parent = grand_parent
+        if grand_parent is None:
+            self.root = sibling
+        else:
+            if grand_parent.left is parent:
+                grand_parent.left = sibling
+            else:
+                grand_parent.right = sibling
+            self.refit(grand_parent)
+        leaf.parent = None
+
+    def refit(self, node):
+        while node is not None:
+            node = self.balance(node)
+            self.fit(node)
+            node = node.parent
+
+    def fit(self, node):
+        node.low, node.high = union(node.left.low, node.left.high, node.right.low, node.right.high)
+        node.height = 1 + max(node.left.height, node.right.height)
+
+    def balance(self, node):
+        """
+        Rotates the taller child of node above it if the children's heights
+        differ by more than one (as in Box2D), returns the node now in its place.
+        """
+        if node.is_leaf() or node.height < 2:
+            return node
+        left, right = node.left, node.right
+        difference = right.height - left.height
+        if -1 <= difference <= 1:
+            return node
+        # The taller child takes node's place, node takes the child's shorter grandchild
+        child = right if difference > 1 else left
+        tall, short = ((child.left, child.right) if child.left.height > child.right.height
+                       else (child.right, child.left))
+
+        child.parent = node.parent
+        if node.parent is None:
+            self.root = child
+        elif node.parent.left is node:
+            node.parent.left = child
+        else:
+            node.parent.right = child
+        node.parent = child
+        if child.left is tall:
+            child.right = node
+        else:
+            child.left = node
+
+        if child is right:
+            node.right = short
+        else:
+            node.left = short
+        short.parent = node
+        self.fit(node)
+        self.fit(child)
+        return child
+
+    def query_ray(self, origin, direction, max_t=float("inf")):
+        """
+        Items whose box the ray crosses before max_t, as (entry distance, item)
+        sorted nearest first. Distances are in units of direction.
+        """
+        hits = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            t = intersect_ray(origin, direction, node.low, node.high, max_t)
+            if t is None:
+                continue
+            if node.is_leaf():
+                hits.append((t, node.item))
+            else:
+                stack.append(node.left)
+                stack.append(node.right)
+        hits.sort(key=lambda hit: hit[0])
+        return hits
+
+    def query_box(self, low, high):
+        """
+        Items whose box overlaps low..high.
+        """
+        items = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            if not overlaps(node.low, node.high, low, high):
+                continue
+            if node.left is None:
+                items.append(node.item)
+            else:
+                stack.append(node.left)
+                stack.append(node.right)
+        return items
+
+
+class EntityIndex:
+    """
+    An AABBTree over the world-space bounds of node paths under root.
+
+    Node paths are added and removed explicitly (or found by rescan). Code
+    that moves or detaches nodes reports it with mark_dirty(), and sync()
+    updates the indexed node paths under the dirty nodes only, so its cost
+    follows what changed, not the size of the index. Queries don't sync:
+    the owner runs sync() once per frame. sync_all() checks every entry,
+    for changes nobody reported.
+
+    The exact boxes are also kept as numpy arrays, rebuilt after changes,
+    for the queries that test every box at once (query_frustum).
+    """
+
+    def __init__(self, root: NodePath, margin=0.5):
+        self.root = root
+        self.tree = AABBTree(margin)
+        # node path -> [leaf, net transform the leaf was computed with, exact box]
+        self.entries = {}
+        # (node paths, lows, highs) of the entries, None when out of date
+        self.box_arrays = None
+        # Node paths moved or detached since the last sync, with their subtrees
+        self.dirty = set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, node_path):
+        return node_path in self.entries
+
+    def get_world_box(self, node_path):
+        """
+        World-space box of the node path and everything below it, or None if it has no bounds.
+        """
+        bounds = node_path.get_bounds()
+        if bounds.is_empty() or bounds.is_infinite():
+            return None
+        bounds = bounds.make_copy()
+        bounds.xform(node_path.get_parent().get_mat(self.root) if node_path.has_parent() else node_path.get_mat(self.root))
+        if isinstance(bounds, BoundingSphere):
+            center, radius = bounds.get_center(), bounds.get_radius()
+            return ((center.x - radius, center.y - radius, center.z - radius),
+                    (center.x + radius, center.y + radius, center.z + radius))
+        if isinstance(bounds, BoundingBox):
+            low, high = bounds.get_min(), bounds.get_max()
+            return (low.x, low.y, low.z), (high.x, high.y, high.z)
+        return None
+
+    def add(self, node_path):
+        if node_path in self.entries or node_path.is_empty():
+            return
+        box = self.get_world_box(node_path)
+        if box is None:
+            return
+        self.entries[node_path] = [self.tree.insert(node_path, *box), node_path.get_net_transform(), box]
+        self.box_arrays = None
+
+    def remove(self, node_path):
+        entry = self.entries.pop(node_path, None)
+        if entry is not None:
+            self.tree.remove(entry[0])
+            self.box_arrays = None
+
+    def update(self, node_path):
+        """
+        Refreshes the box of a node path, e.g. after its geometry changed.
+        """
+        entry = self.entries.get(node_path)
+        if entry is None:
+            self.add(node_path)
+            return
+        box = self.get_world_box(node_path)
+        if box is None:
+            self.remove(node_path)
+            return
+        self.tree.move(entry[0], *box)
+        entry[1] = node_path.get_net_transform()
+        entry[2] = box
+        self.box_arrays = None
+
+    def is_attached(self, node_path):
+        return not node_path.is_empty() and (node_path == self.root or self.root.is_ancestor_of(node_path))
+
+    def mark_dirty(self, node_path):
+        """
+        Reports that node_path moved or was detached: the next sync() updates
+        it and the indexed node paths below it.
+        """
+        if not node_path.is_empty():
+            self.dirty.add(node_path)
+
+    def is_stale(self, node_path):
+        return node_path.get_net_transform() != self.entries[node_path][1]
+
+    def check(self, node_path):
+        """
+        Drops the node path if it was detached from root, moves it if it
+        changed. Returns whether it did either.
+        """
+        if not self.is_attached(node_path):
+            self.remove(node_path)
+            return True
+        if self.is_stale(node_path):
+            self.update(node_path)
+            return True
+        return False
+
+    def sync(self):
+        """
+        Brings the entries under the nodes marked dirty since the last call
+        up to date. Returns how many were updated.
+        """
+        dirty, self.dirty = self.dirty, set()
+        changed = 0
+        checked = set()
+        for node_path in dirty:
+            if node_path.is_empty():
+                continue
+            if node_path.get_num_children():
+                found = [child for child in node_path.find_all_matches("**") if child in self.entries]
+            else:
+                found = [node_path] if node_path in self.entries else []
+            # The leaves hold the objects that were added (widgets rather than plain node paths)
+            for child in (self.entries[child][0].item for child in found):
+                if child not in checked:
+                    checked.add(child)
+                    changed += self.check(child)
+        return changed
+
+    def sync_all(self):
+        """
+        Checks every entry, for nodes moved or removed without mark_dirty().
+        Returns how many were updated.
+        """
+        self.dirty.clear()
+        # A removed node path is empty and can't be looked up anymore
+        removed = [entry for node_path, entry in self.entries.items() if node_path.is_empty()]
+        if removed:
+            for entry in removed:
+                self.tree.remove(entry[0])
+            self.entries = {node_path: entry for node_path, entry in self.entries.items() if not node_path.is_empty()}
+            self.box_arrays = None
+        return len(removed) + sum(self.check(node_path) for node_path in list(self.entries))
+
+    def rescan(self, predicate):
+        """
+        Indexes every node path under root for which predicate(node_path) is true.
+        """
+        self.sync_all()
+        for node_path in self.root.find_all_matches("**"):
+            if node_path not in self.entries and predicate(node_path):
+                self.add(node_path)
+
+    def query_ray(self, origin, direction, max_t=float("inf")):
+        return self.tree.query_ray(tuple(origin), tuple(direction), max_t)
+
+    def query_box(self, low, high):
+        return self.tree.query_box(tuple(low), tuple(high))
+
+    def get_box_arrays(self):
+        """
+        The indexed node paths with their exact boxes, as (list, lows, highs)
+        where lows and highs are (n, 3) arrays.
+        """
+        if self.box_arrays is None:
+            node_paths = list(self.entries)
+            boxes = np.array([self.entries[node_path][2] for node_path in node_paths], dtype=np.float64).reshape(-1, 2, 3)
+            self.box_arrays = (node_paths, boxes[:, 0], boxes[:, 1])
+        return self.box_arrays
+
+    def query_frustum(self, planes):
+        """
+        Node paths whose box is inside or crosses the convex volume bounded by
+        planes, an (n, 4) array of (a, b, c, d) with a*x + b*y + c*z + d >= 0
+        inside. Boxes near the edges may be reported when only their corner
+        region is outside, like any plane-by-plane box test.
+        """
+        node_paths, lows, highs = self.get_box_arrays()
+        inside = np.ones(len(node_paths), dtype=bool)
+        for plane in np.asarray(planes, dtype=np.float64):
+            normal = plane[:3]
+            # Corner of each box the furthest along the normal
+            corners = np.where(normal >= 0, highs, lows)
+            inside &= corners @ normal + plane[3] >= 0
+        return [node_paths[i] for i in np.flatnonzero(inside)]
+
+
+class WidgetIndex(EntityIndex):
+    """
+    An EntityIndex over the frames of DirectGui widgets under root
+    (render2d), for 2D hit tests in its x/z plane.
+
+    The boxes come from the PGItem frames, the areas Panda itself tests the
+    mouse against, not from the geometry, so text or images overflowing a
+    frame don't count. A widget resized in place is marked dirty like a
+    moved one. Hit tests don't sync: call sync() before them (it only looks
+    at the dirty widgets) and update() for a widget being dragged.
+    """
+
+    def __init__(self, root: NodePath, margin=0.0):
+        super().__init__(root, margin)
+        # widget -> (left, right, bottom, top) its box was computed with
+        self.frames = {}
+        # widget -> insertion number, later widgets are drawn on top
+        self.order = {}
+        self.next_order = 0
+
+    def get_frame(self, widget):
+        frame = widget.guiItem.getFrame()
+        return frame[0], frame[1], frame[2], frame[3]
+
+    def get_world_box(self, widget):
+        left, right, bottom, top = self.frames[widget] = self.get_frame(widget)
+        mat = widget.get_mat(self.root)
+        # A widget without a frame is kept as a point, it can't be hit
+        points = [mat.xform_point(Point3(x, 0, z)) for x in (left, right) for z in (bottom, top)]
+        return (tuple(min(point[i] for point in points) for i in range(3)),
+                tuple(max(point[i] for point in points) for i in range(3)))
+
+    def add(self, widget):
+        if widget not in self.order:
+            self.order[widget] = self.next_order
+            self.next_order += 1
+        super().add(widget)
+
+    def remove(self, widget):
+        super().remove(widget)
+        self.frames.pop(widget, None)
+        self.order.pop(widget, None)
+
+    def is_stale(self, widget):
+        return super().is_stale(widget) or self.get_frame(widget) != self.frames.get(widget)
+
+    def contains(self, widget, x, z):
+        left, right, bottom, top = self.frames[widget]
+        point = widget.get_relative_point(self.root, Point3(x, 0, z))
+        return left <= point.x <= right and bottom <= point.z <= top
+
+    def hit_test(self, x, z):
+        """
+        The topmost widget whose frame contains the point (x, z) of root, or None.
+        """
+        candidates = self.tree.query_box((x, float("-inf"), z), (x, float("inf"), z))
+        hits = [widget for widget in candidates if self.contains(widget, x, z)]
+        return max(hits, key=self.order.__getitem__) if hits else None
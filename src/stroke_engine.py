@@ -0,0 +1,65 @@
+import math
+
+
+class StrokeEngine:
+    """
+    Turns the path of a brush stroke into evenly spaced stamp centers.
+
+    Points (heightmap coordinates) are added as the mouse moves, stamps are
+    placed every `spacing` samples along the polyline they form, and the
+    distance left over carries to the next points, so the stamps stay evenly
+    spaced whatever the frame rate or mouse speed. take_stamps() hands out
+    the centers placed since the last call, to be applied as one batch.
+    """
+
+    def __init__(self, spacing=1.0):
+        self.spacing = spacing
+        self.last_point = None
+        # Distance along the path since the last stamp
+        self.travelled = 0.0
+        self.pending = []
+        self.stamp_count = 0
+
+    def begin(self, spacing=None):
+        if spacing is not None:
+            self.spacing = spacing
+        self.last_point = None
+        self.travelled = 0.0
+        self.pending = []
+        self.stamp_count = 0
+
+    def add_point(self, x, y):
+        if self.last_point is None:
+            # The stroke starts with a stamp under the cursor
+            self.last_point = (x, y)
+            self.add_stamp(x, y)
+            return
+        last_x, last_y = self.last_point
+        dx, dy = x - last_x, y - last_y
+        length = math.hypot(dx, dy)
+        if length == 0:
+            return
+        spacing = max(self.spacing, 1e-3)
+        position = spacing - self.travelled
+        while position <= length:
+            self.add_stamp(last_x + dx * position / length, last_y + dy * position / length)
+            position += spacing
+        self.travelled = length - (position - spacing)
+        self.last_point = (x, y)
+
+    def add_stamp(self, x, y):
+        center = (int(round(x)), int(round(y)))
+        # Close stamps can round to the same sample
+        if not self.pending or self.pending[-1] != center:
+            self.pending.append(center)
+            self.stamp_count += 1
+
+    def take_stamps(self):
+        stamps = self.pending
+        self.pending = []
+        return stamps
+
+    def end(self):
+        self.last_point = None
+        self.travelled = 0.0
+        self.pending = []
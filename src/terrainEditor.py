@@ -19,6 +19,11 @@ load_prc_file_data('', '')
 
 from direct.showbase.DirectObject import DirectObject
 from QPanda3D.Panda3DWorld import Panda3DWorld
+from brush_stamps import BrushStampCache
+from heightfield import Heightfield, HeightPyramid
+from raycasting import get_pick_service
+from stroke_engine import StrokeEngine
+from terrain_history import TerrainHistory
 
 
 from panda3d.core import (
@@ -29,7 +34,7 @@ from panda3d.bullet import (
 )
 
 class TerrainCollider:
-    def __init__(self, terrain_size, subdivisions, terrain):
+    def __init__(self, terrain_size, subdivisions, terrain, tile_size=64):
         self.terrain_size = terrain_size
         self.subdivisions = subdivisions
 
@@ -45,44 +50,104 @@ class TerrainCollider:
         self.bullet_world.setGravity((0, 0, -9.81))
         
         self.terrain = terrain
+        # The tiles are picked as the pick service's terrain category
+        self.pick_service = get_pick_service(terrain.world)
+        self.collide_mask = self.pick_service.get_mask("terrain")
 
         # Load the initial heightmap.
-        self.heightmap = PNMImage()
-        # Check if terrain.heightmap_image is a string or a PNMImage.
-        if isinstance(terrain.heightmap_image, str):
+        if isinstance(getattr(terrain, "heightfield", None), Heightfield):
+            # The painter's heightfield, tiles are rebuilt from it when it changes
+            self.heightfield = terrain.heightfield
+        elif isinstance(terrain.heightmap_image, str):
             # If it is a filename, load from file.
-            if not self.heightmap.read(Filename(terrain.heightmap_image)):
+            try:
+                self.heightfield = Heightfield.from_file(terrain.heightmap_image)
+            except IOError:
                 print("❌ Failed to load heightmap")
                 return
         elif isinstance(terrain.heightmap_image, PNMImage):
             # Otherwise, copy the provided PNMImage.
-            self.heightmap = terrain.heightmap_image
+            self.heightfield = Heightfield.from_image(terrain.heightmap_image)
         else:
             print("❌ Unrecognized type for heightmap_image")
             return
 
         print("✅ Heightmap loaded successfully")
 
-        # Create the Bullet Heightfield Shape.
-        self.max_height = 10.0  # Maximum height scale.
-        self.terrain_shape = BulletHeightfieldShape(self.heightmap, self.max_height, ZUp)
-        
-        # Create the Bullet rigid body node for the terrain.
-        self.terrain_node = BulletRigidBodyNode('Terrain')
-        
-        
-        self.terrain_node.addShape(self.terrain_shape)
-        self.terrain_node.setMass(0)  # Static terrain.
-        
-        # Attach the terrain collision node to the scene.
-        self.terrain_np = render.attachNewNode(self.terrain_node)
-        self.terrain_np.setPos(0, 0, 0)
-        
-        # Set a collision mask so that picking (or other systems) detect it.
-        self.terrain_np.node().setIntoCollideMask(BitMask32.bit(2))
+        # Place the collision where the visual terrain is: terrain_np spans its
+        # x/y scale over the heightmap, and heights 0..1 map to 0..z scale.
+        terrain_np = getattr(terrain, "terrain_np", None)
+        if terrain_np is not None:
+            origin = terrain_np.get_pos(render)
+            scale = terrain_np.get_scale(render)
+            self.origin = Point3(origin.x, origin.y, origin.z)
+            self.spacing = scale.x / self.heightfield.width
+            self.max_height = scale.z
+        else:
+            self.max_height = 10.0  # Maximum height scale.
+            self.spacing = 1.0
+            self.origin = Point3(-(self.heightfield.width - 1) / 2.0, -(self.heightfield.height - 1) / 2.0,
+                                 -self.max_height / 2.0)
+
+        # The terrain is split into tile_size x tile_size quads, each its own
+        # Bullet heightfield (neighbour tiles share their edge samples), so a
+        # brush stroke only rebuilds the tiles it touched.
+        self.tile_size = tile_size
+        self.tiles_x = max(1, -(-(self.heightfield.width - 1) // tile_size))
+        self.tiles_y = max(1, -(-(self.heightfield.height - 1) // tile_size))
+        self.tiles = {}
+        self.dirty_tiles = set()
+        for tile_y in range(self.tiles_y):
+            for tile_x in range(self.tiles_x):
+                self.build_tile(tile_x, tile_y)
+
+    def get_tile_rect(self, tile_x, tile_y):
+        """
+        Heightmap rectangle (x0, y0, x1, y1), end exclusive, sampled by a tile.
+        """
+        x0 = tile_x * self.tile_size
+        y0 = tile_y * self.tile_size
+        return (x0, y0, min(x0 + self.tile_size + 1, self.heightfield.width),
+                min(y0 + self.tile_size + 1, self.heightfield.height))
+
+    def build_tile(self, tile_x, tile_y):
+        """
+        (Re)builds the Bullet heightfield of one tile. The new body is attached
+        before the old one is removed, so rays always hit one of them.
+        """
+        x0, y0, x1, y1 = self.get_tile_rect(tile_x, tile_y)
+        shape = BulletHeightfieldShape(self.heightfield.to_image((x0, y0, x1, y1)), self.max_height, ZUp)
 
-        # Add the terrain rigid body to the Bullet world.
-        self.bullet_world.attachRigidBody(self.terrain_node)
+        node = BulletRigidBodyNode('Terrain_{}_{}'.format(tile_x, tile_y))
+        node.addShape(shape)
+        node.setMass(0)  # Static terrain.
+        # Set a collision mask so that picking (or other systems) detect it.
+        node.setIntoCollideMask(self.collide_mask)
+
+        # Bullet centers a heightfield on its samples, with heights from 0 to max_height
+        tile_np = self.root.attachNewNode(node)
+        tile_np.setPos(self.origin.x + (x0 + x1 - 1) / 2.0 * self.spacing,
+                       self.origin.y + (self.heightfield.height - (y0 + y1 - 1) / 2.0 - 1) * self.spacing,
+                       self.origin.z + self.max_height / 2.0)
+        tile_np.setScale(self.spacing, self.spacing, 1)
+
+        self.bullet_world.attachRigidBody(node)
+        old_np = self.tiles.get((tile_x, tile_y))
+        self.tiles[(tile_x, tile_y)] = tile_np
+        if old_np is not None:
+            self.bullet_world.removeRigidBody(old_np.node())
+            self.pick_service.node_removed(old_np)
+            old_np.removeNode()
+
+    def mark_dirty(self, updated_area):
+        """
+        Flags the tiles sampling the heightmap rectangle (x0, y0, x1, y1) for a rebuild.
+        """
+        x0, y0, x1, y1 = updated_area
+        # A sample on a tile edge belongs to both tiles
+        for tile_y in range(max(0, (y0 - 1) // self.tile_size), min(self.tiles_y, (y1 - 1) // self.tile_size + 1)):
+            for tile_x in range(max(0, (x0 - 1) // self.tile_size), min(self.tiles_x, (x1 - 1) // self.tile_size + 1)):
+                self.dirty_tiles.add((tile_x, tile_y))
 
     def create_collider_tree(self):
         """
@@ -112,35 +177,30 @@ class TerrainCollider:
         """
         pass  # Currently, we do nothing here.
 
-    def update_colliders(self, updated_area):
+    def update_colliders(self, updated_area=None):
         """
-        Update the terrain collision shape in-place without creating a new BulletRigidBodyNode.
-        The 'updated_area' parameter can be used to indicate which portion was changed.
+        Rebuilds the tiles overlapping updated_area and the ones already marked
+        dirty. Tiles are swapped one at a time, the others are left untouched.
         """
-        print(f"Updating colliders in area: {updated_area}")
-
-        # Create a new heightfield shape from the updated heightmap.
-        new_shape = BulletHeightfieldShape(self.heightmap, self.max_height, ZUp)
-
-        # Remove all existing shapes from the rigid body.
-        # (Assuming BulletRigidBodyNode supports removeShape or a similar method.)
-        num_shapes = self.terrain_node.getNumShapes()
-        for _ in range(num_shapes):
-            # Always remove the first shape (index 0) until none remain.
-            self.terrain_node.removeShape(self.terrain_node.getShape(0))
-
-        # Add the updated shape.
-        self.terrain_node.addShape(new_shape)
-
-        # (Optional) Reapply the collision mask if needed.
-        #self.terrain_node.setIntoCollideMask(BitMask32.bit(1))
-        self.terrain_node.setIntoCollideMask(BitMask32.bit(2))
+        if updated_area is not None:
+            self.mark_dirty(updated_area)
+        if not self.dirty_tiles:
+            return
+        print(f"Updating {len(self.dirty_tiles)} collider tiles")
+        for tile_x, tile_y in sorted(self.dirty_tiles):
+            self.build_tile(tile_x, tile_y)
+        self.dirty_tiles.clear()
 
 class TerrainPainterApp(DirectObject):
-    def __init__(self, world: Panda3DWorld, panda_widget):
+    def __init__(self, world: Panda3DWorld, panda_widget, paged_terrain=None):
+        """
+        paged_terrain : a PagedTerrain to paint instead of the 512x512
+            in-memory terrain, for worlds too large to keep resident
+        """
         super().__init__()
         self.world = world
         self.widget = panda_widget
+        self.paged_terrain = paged_terrain
         self.holding = False
         
         # Collision update throttling variables:
@@ -155,7 +215,7 @@ class TerrainPainterApp(DirectObject):
         self.terrain_height = 1.0
 
         # Add a task to handle collision updates
-        #self.world.add_task(self.update_collision_task, "update_collision_task")
+        self.collision_task = self.world.add_task(self.update_collision_task, "update_collision_task")
 
         # Create the brush visual
 
@@ -163,38 +223,58 @@ class TerrainPainterApp(DirectObject):
         #self.world.add_task(self.update_brush_visual_task, "update_brush_visual_task")
 
 
-        self.world.add_task(self.update_brush_visual_task, "update_brush_visual_task")
-
-
-        # Load the heightmap image as a PNMImage
-        self.heightmap_image = PNMImage(Filename("./images/Heightmap.png"))
-
-        self.heightmap_image = PNMImage(512, 512)  # Resize to 512x512
-
-        # Create a texture for the heightmap and load the PNMImage into it
-        self.heightmap_texture = Texture()
-        self.heightmap_texture.load(self.heightmap_image)
-
-        self.terrain_node = ShaderTerrainMesh()
-        self.terrain_node.heightfield = base.loader.loadTexture("./images/Heightmap.png")
-        self.terrain_node.target_triangle_width = 10.0
-        self.terrain_node.generate()
-        
+        self.brush_visual_task = self.world.add_task(self.update_brush_visual_task, "update_brush_visual_task")
+
+
+        # Brush operation (see Heightfield.modes) and the height set_height/flatten move toward
+        self.brush_mode = "set_height"
+        self.brush_target = 1.0
+        # Painting only uploads the dirty rectangle of the heights. The mesh is
+        # regenerated at the end of a stroke, and only if some heights left the
+        # bounds it was generated with (tracked per bounds_cell_size cell).
+        self.bounds_cell_size = 32
+        self.generated_bounds = None
+        self.stroke_area = None
+        self.pyramid_area = None
+        # Bumped on every height change, the brush cursor recasts when it moves
+        self.heights_version = 0
+        self.brush_visual_state = None
+
+        if paged_terrain is not None:
+            # The heights live in the tile file, the chunks inherit the shader
+            # and textures set on the paged terrain's root below
+            self.heightfield = None
+            self.heightmap_texture = None
+            self.terrain_node = None
+            self.terrain_np = paged_terrain.root
+        else:
+            # The heights being painted, as floats in [0, 1]
+            self.heightfield = Heightfield(512, 512)
+            # Min/max pyramid the brush cursor ray marches, updated lazily
+            # over the area painted since the last cast
+            self.height_pyramid = HeightPyramid(self.heightfield)
+
+            # Create a texture for the heightmap, uploaded from the heightfield
+            self.heightmap_texture = self.heightfield.to_texture()
+
+            self.terrain_node = ShaderTerrainMesh()
+            self.terrain_node.heightfield = base.loader.loadTexture("./images/Heightmap.png")
+            self.terrain_node.target_triangle_width = 10.0
+            self.terrain_node.generate()
 
-        self.terrain_np = base.render.attach_new_node(self.terrain_node)
-        self.terrain_np.set_scale(512, 512, 100)
-        self.terrain_np.set_pos(-512 // 2, -512 // 2, -70.0)
+            self.terrain_np = base.render.attach_new_node(self.terrain_node)
+            self.terrain_np.set_scale(512, 512, 100)
+            self.terrain_np.set_pos(-512 // 2, -512 // 2, -70.0)
 
         self.terrain_np.set_python_tag("isTerrain", True)
+        # Lets the map Save/Load find the painter owning the heights
+        self.terrain_np.set_python_tag("terrain_painter", self)
 
         grass_tex = base.loader.loadTexture("./images/Grass.png")
         grass_tex.set_minfilter(SamplerState.FT_linear_mipmap_linear)
         grass_tex.set_anisotropic_degree(16)
         self.terrain_np.set_texture(grass_tex)
 
-        self.collision_traverser = CollisionTraverser()
-        self.collision_handler = CollisionHandlerQueue()
-
         # Load and set the terrain shader with the USE_BRUSH preprocessor directive
         terrain_shader = Shader.load(Shader.SL_GLSL, "terrain.vert.glsl", "terrain.frag.glsl")
         self.terrain_np.set_shader_input("USE_BRUSH", True)
@@ -206,23 +286,13 @@ class TerrainPainterApp(DirectObject):
         
         base.accept("f3", base.toggleWireframe)
 
-        # Define collision masks for different categories.
-        self.gizmo_mask = BitMask32.bit(10)
-        self.terrain_mask = BitMask32.bit(2)
-        self.object_mask = BitMask32.bit(3)
-        self.ui_mask = BitMask32.bit(5)
-        combimed_mask = self.gizmo_mask | self.terrain_mask | self.object_mask | self.ui_mask
-        
-        self.mouse_ray = CollisionRay()
-        self.mouse_node = CollisionNode('./images/mouse_ray')
-        self.mouse_node.add_solid(self.mouse_ray)
-        self.mouse_node.set_from_collide_mask(BitMask32.bit(2))
-        self.mouse_node.set_into_collide_mask(BitMask32.bit(2))
-        self.mouse_node_path = base.camera.attach_new_node(self.mouse_node)
-
-        self.collision_traverser.add_collider(self.mouse_node_path, self.collision_handler)
-        
-        #self.terrain_np.set_collide_mask(BitMask32.bit(1))
+        # The mouse ray is cast by the world's pick service, shared with the
+        # other tools; the terrain is picked on its heights.
+        self.pick_service = get_pick_service(self.world)
+        self.gizmo_mask = self.pick_service.register_category("gizmo")
+        self.terrain_mask = self.pick_service.register_category("terrain", ray_test=self.ray_test_terrain)
+        self.object_mask = self.pick_service.register_category("object", geometry=True)
+        self.ui_mask = self.pick_service.register_category("ui")
 
 
         self.accept('mouse1', self.start_holding)
@@ -230,9 +300,27 @@ class TerrainPainterApp(DirectObject):
         self.accept("mouse-move", self.mouse_move)
         self.mx, self.my = 0,0
 
-        self.terrain_collider = TerrainCollider(1024, 100, self)
+        if paged_terrain is not None:
+            # Collision tiles are paged in and out with the chunks
+            self.terrain_collider = paged_terrain
+        else:
+            self.terrain_collider = TerrainCollider(1024, 100, self)
 
         self.brush_selection = "./images/b0.png"  #current brush Path
+        self.brush_falloff = 1.0  # exponent applied to the brush alpha
+        # Scaled and weighted brush stamps, rebuilt only when a brush parameter changes
+        self.brush_stamps = BrushStampCache()
+        # Collects the mouse path of a stroke and spaces the stamps along it,
+        # brush_spacing is the distance between stamps in brush widths
+        self.stroke = StrokeEngine()
+        self.brush_spacing = 0.25
+        # Undo/redo of strokes, as compressed diffs of the tiles they changed.
+        # It belongs to the terrain, not to a brush: changing tools keeps it.
+        self.history = TerrainHistory()
+        # TerrainTileStreamer loading a saved terrain into this one, None when idle
+        self.terrain_streamer = None
+        self.accept("control-z", self.undo)
+        self.accept("control-y", self.redo)
 
         self.intensity = 0.2  # out of a 100 2/100
 
@@ -265,65 +353,119 @@ class TerrainPainterApp(DirectObject):
         self.terrain_np.set_shader_input("brush_size", self.brush_size)
 
     def update_brush_visual_task(self, task):
-        if self.world.mouseWatcherNode.has_mouse():
+        if not self.world.mouseWatcherNode.hasMouse():
             return task.cont
         mouse_pos = self.world.mouseWatcherNode.getMouse()
+        # Only recast when the mouse, the camera or the heights changed
+        state = (mouse_pos, self.world.cam.get_mat(self.world.render), self.heights_version)
+        if state == self.brush_visual_state:
+            return task.cont
+        self.brush_visual_state = state
+
         pFrom = Point3()
         pTo = Point3()
         self.world.camLens.extrude(mouse_pos, pFrom, pTo)
         pFrom = self.world.render.get_relative_point(self.world.cam, pFrom)
         pTo = self.world.render.get_relative_point(self.world.cam, pTo)
-        
-        result = self.terrain_collider.bullet_world.rayTestClosest(pFrom, pTo)
-        if result.hasHit():
-            hit_pos = result.getHitPos()
-            self.update_brush_visual(hit_pos)
-        else:
-            self.update_brush_visual(None)
+        self.update_brush_visual(self.intersect_heights(pFrom, pTo))
         return task.cont
 
+    def ray_test_terrain(self, mouse_pos, p_from, p_to):
+        """
+        Ray test of the "terrain" pick category.
+        """
+        hit_pos = self.intersect_heights(p_from, p_to)
+        if hit_pos is None:
+            return []
+        return [((hit_pos - p_from).length(), hit_pos, self.terrain_np)]
+
+    def pick_terrain(self, mouse_pos=None):
+        """
+        Nearest hit of this terrain under the mouse (or mouse_pos), or None.
+        """
+        for hit in self.pick_service.pick(("terrain",), mouse_pos):
+            if hit.node_path == self.terrain_np:
+                return hit
+        return None
+
+    def intersect_heights(self, p_from, p_to):
+        """
+        First point of the segment p_from..p_to (render space) on the terrain
+        heights, or None. Marches the heights themselves, so it doesn't
+        depend on the collision tiles being up to date.
+        """
+        if self.paged_terrain is not None:
+            paged = self.paged_terrain
+            origin, spacing = paged.origin, (paged.spacing, paged.spacing)
+            height_scale, width, height = paged.height_scale, paged.width, paged.height
+        else:
+            origin = self.terrain_np.get_pos(self.world.render)
+            scale = self.terrain_np.get_scale(self.world.render)
+            width, height = self.heightfield.width, self.heightfield.height
+            # Same mapping as world_to_heightmap
+            spacing, height_scale = (scale.x / width, scale.y / height), scale.z
+        # The mapping is affine, distances along the ray are the same in both spaces
+        start = ((p_from.x - origin.x) / spacing[0], height - 1 - (p_from.y - origin.y) / spacing[1],
+                 (p_from.z - origin.z) / height_scale)
+        direction = ((p_to.x - p_from.x) / spacing[0], -(p_to.y - p_from.y) / spacing[1],
+                     (p_to.z - p_from.z) / height_scale)
+
+        if self.paged_terrain is not None:
+            t = self.paged_terrain.ray_intersect(start, direction, 1.0)
+        else:
+            if self.pyramid_area is not None:
+                self.height_pyramid.update(self.pyramid_area)
+                self.pyramid_area = None
+            t = self.height_pyramid.intersect(start, direction, 1.0)
+        if t is None:
+            return None
+        return p_from + (p_to - p_from) * t
+
+    def is_loading(self):
+        return self.terrain_streamer is not None
+
     def start_holding(self, position):
         self.mx, self.my = position['x'], position['y']
+        if self.is_loading():
+            print("⚠️ The terrain is still loading, painting is disabled until it is done")
         self.world.add_task(self.on_mouse_click, "on_mouse_click", appendTask=True)
         self.height = 0.0
         self.holding = True
+        self.stroke.begin(max(1.0, self.get_brush_width() * self.brush_spacing))
+        self.history.begin(self.brush_mode)
+        self.world.begin_interaction("terrain-brush")
         self.world.uiEditor.start_holding(position)
 
     def stop_holding(self, position):
         self.holding = False
+        self.stroke.end()
+        self.history.commit(self.get_heights())
+        self.finish_stroke()
+        # The stroke is over, bring the collision up to date right away
+        if self.collision_update_needed:
+            self.update_collision()
+        self.world.end_interaction("terrain-brush")
         self.world.uiEditor.stop_drag(position)
 
+    def update_collision_task(self, task):
+        """
+        Rebuilds the dirty collider tiles at most every collision_update_interval seconds.
+        """
+        now = self.world.taskMgr.globalClock.get_frame_time()
+        if self.collision_update_needed and now - self.last_collision_update_time >= self.collision_update_interval:
+            self.update_collision()
+        return task.cont
+
+    def update_collision(self):
+        self.terrain_collider.update_colliders()
+        self.collision_update_needed = False
+        self.last_collision_update_time = self.world.taskMgr.globalClock.get_frame_time()
+
     def mouse_move(self, evt: dict):
         self.mx, self.my = evt['x'], evt['y']
         self.world.uiEditor.mouse_move(evt)
         
 
-    def adjust_speed_of_brush(self, brush_image, speed_factor):
-        # Create a new PNMImage with the same size and data as the original
-        new_brush_image = PNMImage(brush_image.get_x_size(), brush_image.get_y_size())
-        new_brush_image.copy_sub_image(brush_image, 0, 0, 0, 0, brush_image.get_x_size(), brush_image.get_y_size())
-
-        # Modify pixel values based on speed_factor
-        for x in range(new_brush_image.get_x_size()):
-            for y in range(new_brush_image.get_y_size()):
-                # Get the pixel value at (x, y)
-                r, g, b = new_brush_image.get_xel(x, y)
-
-                # Adjust pixel intensity based on speed_factor
-                r = int(r * speed_factor)
-                g = int(g * speed_factor)
-                b = int(b * speed_factor)
-
-                # Ensure pixel values stay within the valid range (0-255)
-                r = min(max(r, 0), 255)
-                g = min(max(g, 0), 255)
-                b = min(max(b, 0), 255)
-
-                # Set the new pixel value
-                new_brush_image.set_xel(x, y, r, g, b)
-
-        return new_brush_image
-
     def highlight_object(self, object_entry):
         object_n = object_entry.get_into_node_path()
         object_n.set_color(1, 0, 0, 1)
@@ -335,102 +477,45 @@ class TerrainPainterApp(DirectObject):
             print("Mouse not detected.")
             return Task.cont
     
-        pMouse = self.world.mouseWatcherNode.getMouse()
-        #pMouse = self.mx, self.my
-        pFrom = Point3()
-        pTo = Point3()
-        base.camLens.extrude(pMouse, pFrom, pTo)
-        pFrom = render.getRelativePoint(base.cam, pFrom)
-        pTo = render.getRelativePoint(base.cam, pTo)
-        
-        # let's not...
-        # Use Bullet's rayTestClosest to test against the Bullet world.
-        result = self.terrain_collider.bullet_world.rayTestClosest(pFrom, pTo)
-        self.terrain_collider.update_colliders(None)
-        
-        # update ray's origin and direction
-        self.mouse_ray.set_origin(pFrom)
-        self.mouse_ray.set_direction((pTo - pFrom).normalized())
-        # traverse the scene graph
-        self.collision_handler.clear_entries()
-        self.collision_traverser.traverse(render)
-
-        
+        # Cast once per frame for all the tools, hits sorted by distance
+        hits = self.pick_service.pick()
 
         if not self.height >= self.max_height:
             self.height += 0.02
 
-        # Check for collisions
-        if result.hasHit():
-            hit_pos = result.getHitPos()
-            print("Bullet collision detected at:", hit_pos)
-            #self.paint_on_terrain(hit_pos)
-        else:
-            print("No collision detected.")
-
-        if result.hasHit():
-            hit_pos = result.getHitPos()
+        if hits:
             print("Click detected!")
-            # Use Bullet's rayTestAll to get all collision results.
-            results = self.terrain_collider.bullet_world.rayTestAll(pFrom, pTo)
-            entries = results.getHits()
-
-            # Filter entries based on collision masks.
-            gizmo_entries = [e for e in entries if e.getNode().get_into_collide_mask() & self.gizmo_mask]
-            if gizmo_entries:
-                gizmo_entry = gizmo_entries[0]
+            # Nearest hit of each category, in one pass.
+            nearest = {}
+            for hit in hits:
+                nearest.setdefault(hit.category, hit)
+
+            if "gizmo" in nearest:
                 print("Clicked on gizmos")
-                self.base.animator_tab.start_gizmo_drag(gizmo_entry)
+                self.world.animator_tab.start_gizmo_drag(nearest["gizmo"].entry)
                 return Task.done
-            terrain_entries = [e for e in entries if e.getNode().get_into_collide_mask() & self.terrain_mask]
-            if terrain_entries:
-                terrain_entry = terrain_entries[0]
-                self.paint_on_terrain(hit_pos)
+            if "terrain" in nearest:
+                self.paint_stroke()
                 # Handle terrain collision...
                 return Task.cont if self.holding else Task.done
-            object_entries = [e for e in entries if e.getNode().get_into_collide_mask() & self.object_mask]
-            if object_entries:
-                object_entry = object_entries[0]
+            if "object" in nearest:
                 print("Click on a object")
                 # Handle object selection
-                self.selected_object = object_entry.get_into_node_path()
-                self.highlight_object(object_entry)
+                self.selected_object = nearest["object"].node_path
+                self.highlight_object(nearest["object"].entry)
                 return Task.done
-            ui_entries = [e for e in entries if e.getNode().get_into_collide_mask() & self.ui_mask]
-            if ui_entries:
-                ui_entry = ui_entries[0]
+            if "ui" in nearest:
                 print("Clicked on UI")
                 # Handle UI interaction...
                 return Task.done
+        else:
+            print("No collision detected.")
     
     
         #return Task.cont if self.holding else Task.done
 
 
 
-    def adjust_brightness_pillow(self, brush_image_path, brightness_factor):
-        from PIL import Image
-        # Open the brush image and ensure it has an alpha channel.
-        brush_image = Image.open(brush_image_path).convert('RGBA')
-        
-        # Split into individual channels.
-        r, g, b, a = brush_image.split()
-        
-        # Adjust the alpha channel.
-        # brightness_factor here is treated as an opacity multiplier.
-        # For example, a brightness_factor of 0.5 will make the image 50% as opaque.
-        a = a.point(lambda i: int(i * brightness_factor))
-        
-        # Merge channels back together.
-        brush_image = Image.merge('RGBA', (r, g, b, a))
-        
-        # Save the modified image temporarily.
-        brush_image.save("./images/Temp_Brush.png")
-        
-        # Convert it back to a PNMImage.
-        pnm_brush_image = PNMImage(Filename("./images/Temp_Brush.png"))
-        return pnm_brush_image
-    
     def update_brush_size(self, size):
         
         self.brush_size = size
@@ -447,61 +532,182 @@ class TerrainPainterApp(DirectObject):
         
     
 
+    def world_to_heightmap(self, pos):
+        """
+        Heightmap sample (x, y) under a world position, may be out of bounds.
+        """
+        if self.paged_terrain is not None:
+            return self.paged_terrain.world_to_sample(pos)
+        # terrain_np spans its x/y scale over the heightmap, row 0 is the far (+y) edge
+        origin = self.terrain_np.get_pos(self.world.render)
+        scale = self.terrain_np.get_scale(self.world.render)
+        terrain_x = int((pos.x - origin.x) / scale.x * self.heightfield.width)
+        terrain_y = int((pos.y - origin.y) / scale.y * self.heightfield.height)
+        return terrain_x, self.heightfield.height - terrain_y - 1
+
+    def get_brush_width(self):
+        # brush_size is a percentage of the brush image size
+        return max(1, int(self.brush_stamps.get_native_size(self.brush_selection) * self.brush_size / 100))
+
+    def paint_stroke(self):
+        """
+        Extends the stroke along the mouse path since the last frame and
+        applies the stamps spaced along it as one batch.
+        """
+        for mouse_pos in self.world.mouseWatcherNode.getMousePath():
+            hit = self.pick_terrain(mouse_pos)
+            if hit is not None:
+                self.stroke.add_point(*self.world_to_heightmap(hit.point))
+        self.paint_stamps(self.stroke.take_stamps())
+
     def paint_on_terrain(self, hit_pos):
-        # Map world position to heightmap coordinates.
-        terrain_x = int((hit_pos.x + 256) / 512 * self.heightmap_image.get_x_size())
-        terrain_y = int((hit_pos.y + 256) / 512 * self.heightmap_image.get_y_size())
-
-        # Flip the Y-axis if necessary.
-        terrain_y = self.heightmap_image.get_y_size() - terrain_y - 1
-
-        if 0 <= terrain_x < self.heightmap_image.get_x_size() and 0 <= terrain_y < self.heightmap_image.get_y_size():
-            print(f"Painting at heightmap coords: ({terrain_x}, {terrain_y})")
-
-            # (Optional) Adjust brightness of the brush image.
-            self.adjust_brightness_pillow(self.brush_selection, self.height)
-
-            # Load the brush image.
-            brush_image = PNMImage(Filename("./images/Temp_Brush.png"))
-            brush_width = brush_image.get_x_size()
-            brush_height = brush_image.get_y_size()
-            
-
-            # (Optional) Adjust the brush speed/intensity.
-            self.adjust_speed_of_brush(brush_image, self.intensity)
-
-            # Calculate the top-left corner to center the brush.
-            start_x = terrain_x - brush_width // 2
-            start_y = terrain_y - brush_height // 2
-
-            # Apply (blend) the brush to the heightmap.
-            scaled_brush_width = int(brush_width * (self.brush_size / 10))
-            scaled_brush_height = int(brush_height * (self.brush_size / 10))
-            
-            
-
-            self.heightmap_image.blend_sub_image(
-                brush_image,
-                max(0, start_x),  # Clamp to ensure valid position.
-                max(0, start_y),
-                0,  # Brush offset X.
-                0,  # Brush offset Y.
-                min(scaled_brush_width, self.heightmap_image.get_x_size() - start_x),  # Brush width.
-                min(scaled_brush_height, self.heightmap_image.get_y_size() - start_y)  # Brush height.
-            )
-
-            # Update the heightmap texture with the modified heightmap.
-            self.heightmap_texture.load(self.heightmap_image)
-
-            # Update the visual terrain mesh.
+        self.paint_stamps([self.world_to_heightmap(hit_pos)])
+
+    def paint_stamps(self, centers):
+        """
+        Applies the brush at each heightmap sample of centers, then uploads and
+        flags for collision the area they changed, once for the whole batch.
+        """
+        # Tiles still to load would overwrite the strokes
+        if self.is_loading():
+            return
+        heights = self.get_heights()
+        centers = [(x, y) for x, y in centers if 0 <= x < heights.width and 0 <= y < heights.height]
+        if not centers:
+            return
+
+        # Brush stamp at the current size and intensity, cached in memory.
+        stamp = self.brush_stamps.get_stamp(self.brush_selection, self.get_brush_width(),
+                                            self.height * self.brush_intensity, self.brush_falloff)
+
+        # Save the tiles about to change for undo, then apply the brush to
+        # the heights under the stamps only.
+        rect = heights.get_stamps_rect(stamp, centers)
+        if rect is not None:
+            self.history.record(heights, rect)
+        updated_area = heights.apply_stamps(self.brush_mode, stamp, centers, target=self.brush_target)
+        if updated_area is None:
+            return
+        self.upload_heights(updated_area)
+
+    def get_heights(self):
+        # A paged terrain edits its tile file and resident chunks itself
+        return self.paged_terrain if self.paged_terrain is not None else self.heightfield
+
+    def upload_heights(self, updated_area):
+        """
+        Shows the heights changed inside updated_area and flags their collision for a rebuild.
+        """
+        if self.paged_terrain is None and self.terrain_node.heightfield != self.heightmap_texture:
+            # First stroke: the mesh switches over to the painted heights.
+            self.heightfield.to_texture(self.heightmap_texture)
             self.terrain_node.heightfield = self.heightmap_texture
-            self.terrain_node.generate()
+            self.regenerate_terrain()
+        elif self.paged_terrain is None:
+            # Only the heights changed, upload the stamped rectangle.
+            self.heightfield.upload_to_texture(self.heightmap_texture, updated_area)
+            self.stroke_area = self.merge_areas(self.stroke_area, updated_area)
+
+        if self.paged_terrain is None:
+            self.pyramid_area = self.merge_areas(self.pyramid_area, updated_area)
+        self.heights_version += 1
+
+        # Mark that a collision update is needed and set the updated area.
+        self.collision_update_needed = True
+        self.updated_area = updated_area
+        self.terrain_collider.mark_dirty(updated_area)
+
+    def undo(self):
+        """
+        Reverts the last stroke, re-uploading only the tiles it changed.
+        """
+        if not self.holding and not self.is_loading():
+            self.refresh_heights(self.history.undo(self.get_heights()))
+
+    def redo(self):
+        if not self.holding and not self.is_loading():
+            self.refresh_heights(self.history.redo(self.get_heights()))
 
-            # Mark that a collision update is needed and set the updated area.
-            self.collision_update_needed = True
-            self.updated_area = (max(0, start_x), max(0, start_y), min(self.heightmap_image.get_x_size(), start_x + brush_width), min(self.heightmap_image.get_y_size(), start_y + brush_height))
+    def refresh_heights(self, updated_area):
+        if updated_area is None:
+            return
+        self.upload_heights(updated_area)
+        self.finish_stroke()
+        self.update_collision()
+
+    def resize_heightfield(self, width, height):
+        """
+        Replaces the painted heights by flat ones of another size, and rebuilds
+        the texture, mesh and collision around them (e.g. before a saved
+        terrain is loaded). The history doesn't apply anymore and is cleared.
+        """
+        if self.paged_terrain is not None:
+            raise ValueError("The size of a paged terrain is the size of its tile file")
+        self.heightfield = Heightfield(width, height)
+        self.height_pyramid = HeightPyramid(self.heightfield)
+        self.pyramid_area = None
+        self.heights_version += 1
+        self.heightfield.to_texture(self.heightmap_texture)
+        self.terrain_node.heightfield = self.heightmap_texture
+        self.regenerate_terrain()
+
+        self.terrain_collider.root.removeNode()
+        self.terrain_collider = TerrainCollider(1024, 100, self)
+        self.terrain_collider.bullet_world.setDebugNode(self.debug_np.node())
+
+    def close(self):
+        """
+        Removes the terrain from the scene and stops its tasks and event
+        handlers, when another terrain replaces it. A paged terrain is closed
+        too, which writes its edits back to the tile file.
+        """
+        self.ignore_all()
+        if self.terrain_streamer is not None:
+            self.terrain_streamer.stop()
+        self.pick_service.remove_ray_test("terrain", self.ray_test_terrain)
+        self.world.taskMgr.remove(self.collision_task)
+        self.world.taskMgr.remove(self.brush_visual_task)
+        self.debug_np.remove_node()
+        if self.paged_terrain is not None:
+            # Its root is terrain_np, the colliders are under it
+            self.paged_terrain.close()
         else:
-            print("Click outside terrain bounds.")
+            self.pick_service.node_removed(self.terrain_collider.root)
+            self.terrain_collider.root.remove_node()
+            self.terrain_np.remove_node()
+        self.collision_update_needed = False
+        self.history.clear()
+
+    @staticmethod
+    def merge_areas(area, other):
+        if area is None:
+            return other
+        return (min(area[0], other[0]), min(area[1], other[1]), max(area[2], other[2]), max(area[3], other[3]))
+
+    def regenerate_terrain(self):
+        self.terrain_node.generate()
+        self.generated_bounds = self.heightfield.get_cell_bounds(self.bounds_cell_size)
+
+    def finish_stroke(self):
+        """
+        Regenerates the terrain mesh if the stroke moved heights out of the
+        chunk bounds the mesh was generated with.
+        """
+        if self.paged_terrain is not None:
+            self.paged_terrain.finish_stroke()
+            return
+        area = self.stroke_area
+        self.stroke_area = None
+        if area is None or self.generated_bounds is None:
+            return
+        cell = self.bounds_cell_size
+        x0, y0, x1, y1 = area[0] // cell, area[1] // cell, -(-area[2] // cell), -(-area[3] // cell)
+        mins, maxs = self.heightfield.get_cell_bounds(cell)
+        generated_mins, generated_maxs = self.generated_bounds
+        window = (slice(y0, y1), slice(x0, x1))
+        if ((mins[window] < generated_mins[window]).any() or
+                (maxs[window] > generated_maxs[window]).any()):
+            self.regenerate_terrain()
 
     def enable_bullet_debug(self):
         debug_node = BulletDebugNode('Debug')
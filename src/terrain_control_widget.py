@@ -1,10 +1,16 @@
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLabel, QSlider, QPushButton
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLabel, QSlider, QPushButton, QComboBox, QSpinBox, QApplication
 from PyQt5.QtCore import Qt
 
+from TerrainGeneration import GenerateTerrain
+
 class TerrainControlWidget(QWidget):
     def __init__(self, terrain_painter_app):
         super().__init__()
         self.terrain_painter_app = terrain_painter_app
+        # Kept for the whole session, it reuses its worker processes
+        self.generator = GenerateTerrain()
+        self.generating = False
+        QApplication.instance().aboutToQuit.connect(self.generator.close)
 
         self.init_ui()
         
@@ -43,6 +49,31 @@ class TerrainControlWidget(QWidget):
         layout.addWidget(self.terrain_height_label)
         layout.addWidget(self.terrain_height_slider)
 
+        # Procedural generation, replaces the heights of the terrain
+        self.noise_label = QLabel("Noise")
+        self.noise_combo = QComboBox()
+        self.noise_combo.addItems(GenerateTerrain.noises)
+        layout.addWidget(self.noise_label)
+        layout.addWidget(self.noise_combo)
+
+        self.seed_label = QLabel("Seed")
+        self.seed_spin = QSpinBox()
+        self.seed_spin.setRange(0, 2 ** 31 - 1)
+        layout.addWidget(self.seed_label)
+        layout.addWidget(self.seed_spin)
+
+        self.erosion_label = QLabel("Erosion Iterations")
+        self.erosion_spin = QSpinBox()
+        self.erosion_spin.setRange(0, 500)
+        self.erosion_spin.setValue(self.generator.hydraulic_iterations)
+        layout.addWidget(self.erosion_label)
+        layout.addWidget(self.erosion_spin)
+
+        self.generate_button = QPushButton("Generate Terrain")
+        self.generate_button.clicked.connect(self.generate_terrain)
+        layout.addWidget(self.generate_button)
+        self.update_generate_button()
+
         # Apply button
         self.apply_button = QPushButton("Apply")
         self.apply_button.clicked.connect(self.apply_changes)
@@ -50,6 +81,23 @@ class TerrainControlWidget(QWidget):
 
         self.setLayout(layout)
 
+    def set_painter(self, terrain_painter_app):
+        """
+        Switches the controls over to another terrain, keeping their values.
+        """
+        self.terrain_painter_app = terrain_painter_app
+        self.update_brush_size(self.brush_size_slider.value())
+        self.update_brush_intensity(self.brush_intensity_slider.value())
+        self.update_terrain_height(self.terrain_height_slider.value())
+        self.update_generate_button()
+
+    def update_generate_button(self):
+        # Generation works on the whole heightfield in memory, which a
+        # paged terrain is too large for
+        paged = getattr(self.terrain_painter_app, "paged_terrain", None) is not None
+        self.generate_button.setEnabled(not self.generating and not paged)
+        self.generate_button.setToolTip("Not available for paged terrains" if paged else "")
+
     def update_brush_size(self, value):
         self.brush_size_label.setText(f"Brush Size: {value}")
         self.terrain_painter_app.brush_size = value / 100.0
@@ -65,6 +113,18 @@ class TerrainControlWidget(QWidget):
         self.terrain_height_label.setText(f"Terrain Height: {height}")
         self.terrain_painter_app.terrain_height = height
 
+    def generate_terrain(self):
+        self.generator.noise = self.noise_combo.currentText()
+        self.generator.seed = self.seed_spin.value()
+        self.generator.hydraulic_iterations = self.erosion_spin.value()
+        self.generating = True
+        self.update_generate_button()
+        self.generator.apply_async(self.terrain_painter_app, on_done=self.generation_done)
+
+    def generation_done(self, heights):
+        self.generating = False
+        self.update_generate_button()
+
     def apply_changes(self):
         # Apply changes to the terrain painter app
         self.terrain_painter_app.apply_changes()
\ No newline at end of file
@@ -0,0 +1,138 @@
+import zlib
+
+import numpy as np
+
+
+class TerrainEdit:
+    """
+    One undoable terrain edit: the tiles it changed, each with its rectangle
+    and zlib-compressed float32 heights before and after the edit.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.tiles = []
+        self.size = 0
+
+    def add_tile(self, rect, before, after):
+        before = zlib.compress(before.tobytes(), 1)
+        after = zlib.compress(after.tobytes(), 1)
+        self.tiles.append((rect, before, after))
+        self.size += len(before) + len(after)
+
+    def get_area(self):
+        return (min(rect[0] for rect, _, _ in self.tiles), min(rect[1] for rect, _, _ in self.tiles),
+                max(rect[2] for rect, _, _ in self.tiles), max(rect[3] for rect, _, _ in self.tiles))
+
+
+class TerrainHistory:
+    """
+    Undo/redo of terrain edits, kept as tile diffs.
+
+    Edits record the tiles they are about to change with record(); commit()
+    keeps the tiles whose heights actually changed, compressed, so a stroke
+    costs memory in proportion to the area it touched, not to the terrain.
+    Once the history goes over memory_limit bytes, the oldest edits are dropped.
+
+    `heights` is anything with read_rect/write_rect((x0, y0, x1, y1)),
+    width and height: a Heightfield or a PagedTerrain.
+    """
+
+    def __init__(self, tile_size=64, memory_limit=64 * 1024 * 1024):
+        self.tile_size = tile_size
+        self.memory_limit = memory_limit
+        self.undo_stack = []
+        self.redo_stack = []
+        # Tiles saved by the edit in progress: (tile_x, tile_y) -> (rect, heights before)
+        self.pending = None
+        self.pending_name = None
+
+    @property
+    def memory_used(self):
+        return sum(edit.size for edit in self.undo_stack) + sum(edit.size for edit in self.redo_stack)
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def begin(self, name="edit"):
+        self.pending = {}
+        self.pending_name = name
+
+    def record(self, heights, rect):
+        """
+        Saves the tiles overlapping rect that the current edit hasn't saved
+        yet. Call it before changing the heights in rect.
+        """
+        if self.pending is None:
+            return
+        x0, y0, x1, y1 = rect
+        size = self.tile_size
+        for tile_y in range(max(0, y0) // size, (min(y1, heights.height) - 1) // size + 1):
+            for tile_x in range(max(0, x0) // size, (min(x1, heights.width) - 1) // size + 1):
+                if (tile_x, tile_y) in self.pending:
+                    continue
+                tile_rect = (tile_x * size, tile_y * size,
+                             min((tile_x + 1) * size, heights.width), min((tile_y + 1) * size, heights.height))
+                self.pending[(tile_x, tile_y)] = (tile_rect, np.array(heights.read_rect(tile_rect), dtype=np.float32))
+
+    def commit(self, heights):
+        """
+        Ends the current edit and pushes it, if it changed anything.
+        Returns the edit, or None.
+        """
+        pending = self.pending
+        self.pending = None
+        if not pending:
+            return None
+        edit = TerrainEdit(self.pending_name)
+        for key in sorted(pending):
+            rect, before = pending[key]
+            after = np.array(heights.read_rect(rect), dtype=np.float32)
+            if not np.array_equal(before, after):
+                edit.add_tile(rect, before, after)
+        if not edit.tiles:
+            return None
+        self.undo_stack.append(edit)
+        self.redo_stack.clear()
+        self.evict()
+        return edit
+
+    def evict(self):
+        memory_used = self.memory_used
+        while memory_used > self.memory_limit and self.undo_stack:
+            memory_used -= self.undo_stack.pop(0).size
+
+    def restore(self, heights, edit, index):
+        for rect, *states in edit.tiles:
+            shape = (rect[3] - rect[1], rect[2] - rect[0])
+            heights.write_rect(rect, np.frombuffer(zlib.decompress(states[index]), dtype=np.float32).reshape(shape))
+        return edit.get_area()
+
+    def undo(self, heights):
+        """
+        Puts back the heights from before the last edit.
+        Returns the rectangle that changed, or None if there is nothing to undo.
+        """
+        if not self.undo_stack:
+            return None
+        edit = self.undo_stack.pop()
+        self.redo_stack.append(edit)
+        return self.restore(heights, edit, 0)
+
+    def redo(self, heights):
+        """
+        Applies the last undone edit again, returns the rectangle that changed or None.
+        """
+        if not self.redo_stack:
+            return None
+        edit = self.redo_stack.pop()
+        self.undo_stack.append(edit)
+        return self.restore(heights, edit, 1)
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.pending = None
@@ -1,5 +1,5 @@
 from direct.gui.DirectGui import DirectButton, DirectLabel, DirectFrame
-from panda3d.core import Point3, CollisionTraverser, CollisionHandlerQueue, CollisionRay, CollisionNode
+from panda3d.core import Point3, CollisionNode
 from QPanda3D.Panda3DWorld import Panda3DWorld
 from direct.gui import DirectGuiGlobals as DGG
 from panda3d.core import *
@@ -8,6 +8,8 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 import scirpt_inspector
 import entity_editor
+from raycasting import get_pick_service
+from spatial_index import WidgetIndex
 from QPanda3D.QPanda3DWidget import QPanda3DWidget
 from file_explorer import FileExplorer
 import entity_editor
@@ -17,22 +19,17 @@ class Drag_and_drop_ui_editor:
         self.world = world
         self.widget = panda_widget
         self.widgets = []
+        # Frames of the widgets in render2d, for hit testing the mouse
+        self.widget_index = WidgetIndex(self.world.render2d)
         self.task_drag = None  # Initialize task_drag once
         
         self.draggable = False
         self.is_moving = False
         
-        self.collision_traverser = CollisionTraverser()
-        self.collision_handler = CollisionHandlerQueue()
-        
-        self.mouse_ray = CollisionRay()
-        self.mouse_node = CollisionNode('mouse_ray')
-        self.mouse_node.add_solid(self.mouse_ray)
-        self.mouse_node.set_from_collide_mask(BitMask32.bit(5))
-        self.mouse_node.set_into_collide_mask(BitMask32.bit(5))
-        self.mouse_node_path = self.world.camera.attach_new_node(self.mouse_node)
-
-        self.collision_traverser.add_collider(self.mouse_node_path, self.collision_handler)
+        # The widgets are picked through the world's pick service, as its
+        # "ui" category, hit tested against the widget index.
+        self.pick_service = get_pick_service(self.world)
+        self.ui_mask = self.pick_service.register_category("ui", ray_test=self.ray_test_widgets)
     
         self.world.accept("mouse1", self.start_holding)
         self.world.accept('mouse1-up', self.stop_drag)
@@ -99,7 +96,7 @@ class Drag_and_drop_ui_editor:
         right_panel = QWidget()
         right_panel.setLayout(QVBoxLayout())
 
-        world.hierarchy_tree1.setHeaderLabel("Scene Hierarchy")
+        world.hierarchy_model1.set_header_label("Scene Hierarchy")
         world.hierarchy_tree1.setDragEnabled(True)
         world.hierarchy_tree1.setAcceptDrops(True)
         right_panel.layout().addWidget(world.hierarchy_tree1)
@@ -149,7 +146,7 @@ class Drag_and_drop_ui_editor:
         collisionNode.addSolid(polygon)
         
         # Set collision masks to match the ray's settings.
-        collisionNode.set_into_collide_mask(BitMask32.bit(5))
+        collisionNode.set_into_collide_mask(self.ui_mask)
         
         # Attach collision node to the widget
         collisionNP = widget.attachNewNode(collisionNode)
@@ -211,6 +208,7 @@ class Drag_and_drop_ui_editor:
         ui_reference1.setPythonTag("isLabel", True)
         ui_reference1.setPythonTag("isButton", False)
         self.widgets.append(ui_reference1)
+        self.widget_index.add(ui_reference1)
         #label1.set_python_tag("widget_type", "l")
         return ui_reference1
         
@@ -263,6 +261,7 @@ class Drag_and_drop_ui_editor:
         ui_reference1.setPythonTag("isLabel", False)
         ui_reference1.setPythonTag("isButton", True)
         self.widgets.append(ui_reference1)
+        self.widget_index.add(ui_reference1)
         # Bind events for dragging (for both elements)
         #self.draggable_button.bind(DGG.B1PRESS, self.start_drag, extraArgs=[self.draggable_button, self.label1])
         #self.label1.bind(DGG.B1PRESS, self.start_drag, extraArgs=[self.draggable_button, self.label1])
@@ -290,6 +289,7 @@ class Drag_and_drop_ui_editor:
         ui_reference1.setPythonTag("isButton", False)
         ui_reference1.setPythonTag("isFrame", True)
         self.widgets.append(ui_reference1)
+        self.widget_index.add(ui_reference1)
         return ui_reference1
 
     def get_all_2d_nodes(self):
@@ -313,57 +313,27 @@ class Drag_and_drop_ui_editor:
     
     
     
+    def get_widget_under_mouse(self, world):
+        """
+        The topmost widget under the mouse, or None.
+        """
+        if not world.mouseWatcherNode.hasMouse():
+            return None
+        # In a default render2d setup, normalized mouse coordinates correspond directly to render2d space
+        mouse_norm = world.mouseWatcherNode.getMouse()
+        self.widget_index.sync()
+        return self.widget_index.hit_test(mouse_norm.getX(), mouse_norm.getY())
+
     def is_mouse_over_widget(self, world):
-        for widget in self.widgets:
-            if widget is None:
-                continue  # Skip invalid entries
-            else:
-                print(self.widgets)
-                
-                
-                # Check if mouse is available
-                if not world.mouseWatcherNode.hasMouse():
-                    return False
-
-                # Retrieve normalized mouse position from the mouse watcher node
-                mouse_norm = world.mouseWatcherNode.getMouse()  # Vec2
-
-                # Convert normalized mouse coordinates to render2d coordinates
-                # In a default render2d setup, normalized mouse coordinates correspond directly to render2d space
-                mouse_x = mouse_norm.getX()
-                mouse_z = mouse_norm.getY()  # Using z-axis for vertical in render2d
-
-                # Get widget's position relative to render2d
-                pos = widget.getPos()  # Returns an LVecBase3f
-                wx = pos.x
-                wz = pos.z  # For 2D, x and z coordinates are used (assuming y is depth which is constant)
-
-                # Get widget's scale (assuming uniform scaling for width and height)
-                scale = widget.getScale()
-                # Estimate width and height based on known base dimensions and widget scale.
-                # You may need to adjust these factors to match the actual visual size of your widget.
-                base_width = 2   # Base width for a scale of 1; adjust as needed
-                base_height = 1  # Base height for a scale of 1; adjust as needed
-                width = base_width * scale.x
-                height = base_height * scale.z  # assuming z-scale affects height in render2d
-
-                # Define boundaries of the widget
-                left = wx - width
-                right = wx + width
-                bottom = wz - height
-                top = wz + height
-
-                print(left, mouse_x, right, pos.z)
-
-                # Check if mouse position lies within these boundaries
-                if (left <= mouse_x <= right) and (bottom <= mouse_z <= top):
-                    self.draggable = True
-                    if self.draggable and self.is_moving:
-                        self.world.add_task(self.move_widget, "move_widget", appendTask=True, extraArgs = [widget])
-                        self.draggable = False
-                        self.is_moving = False
-                    return True
-        return False
+        widget = self.get_widget_under_mouse(world)
+        if widget is None:
+            return False
+        self.draggable = True
+        if self.draggable and self.is_moving:
+            self.world.add_task(self.move_widget, "move_widget", appendTask=True, extraArgs = [widget])
+            self.draggable = False
+            self.is_moving = False
+        return True
     def drag_task(self, task):
         if self.is_mouse_over_widget(self.world):
             print("test!!!!!")
@@ -398,8 +368,21 @@ class Drag_and_drop_ui_editor:
         snap_y = round(pMouse[1] / grid_size) * grid_size
         hit_node_path.setPos(Vec3(snap_x, 0, snap_y))
         hit_node_path.getParent().setPos(Vec3(pMouse[0], 0, pMouse[1]))
+        self.widget_index.update(hit_node_path)
         return task.cont if self.holding else task.done
     
+    def ray_test_widgets(self, mouse_pos, p_from, p_to):
+        """
+        Ray test of the "ui" pick category: the topmost widget under the
+        mouse in render2d, from the widget index. Widgets are drawn over
+        the 3D view, so at distance 0.
+        """
+        self.widget_index.sync()
+        widget = self.widget_index.hit_test(mouse_pos[0], mouse_pos[1])
+        if widget is None:
+            return []
+        return [(0.0, Point3(mouse_pos[0], 0, mouse_pos[1]), widget)]
+
     def start_holding(self, position):
         self.mx, self.my = position['x'], position['y']
         self.is_moving = True
@@ -21,7 +21,10 @@ class ui_editor_properties(MonoBehavior):
         ui_editor.Drag_and_drop_ui_editor.label("Label 1", parent=self.node)
     
     def update_label(self):
-        self.node['text'] = self.current_text
+        if self.node['text'] != self.current_text:
+            self.node['text'] = self.current_text
+            # The frame follows the text
+            base.uiEditor.widget_index.mark_dirty(self.node)
     def update(self, dt):
         if self._private_isCanvas:
             self.button = {